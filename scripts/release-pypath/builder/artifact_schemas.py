@@ -6,7 +6,14 @@ import tempfile
 from pathlib import Path
 from .common import EnvironmentInformation, ReleaseFile
 from .git import ArtifactSchemaRepository
-from .cmd import stream_output, collect_output
+from .cmd import (
+    CommandExecutor,
+    GIT_NETWORK,
+    iter_output,
+    run_with_retry,
+    stream_output,
+)
+from .trace import traced
 from .virtualenvs import SchemaArtifactEnv
 from urllib.request import urlopen
 from typing import List
@@ -118,13 +125,14 @@ footer {{
     )
 
 
+@traced
 def check_artifact_schema(args=None):
     env = EnvironmentInformation()
     artifact_env = SchemaArtifactEnv(env.dbt_dir / "requirements.txt")
     artifact_env.create(env.schemas_venv)
-    pip = str(env.schemas_venv / "bin/pip")
-    cmd = [pip, "install", "-r", "requirements.txt"]
-    stream_output(cmd, cwd=env.dbt_dir)
+    artifact_schema_repo = ArtifactSchemaRepository(env.schemas_checkout_path)
+    run_with_retry(artifact_schema_repo.clone_command(), GIT_NETWORK)
+    artifact_schema_repo.finish_clone()
 
     python_path = env.schemas_venv / "bin/python"
     schemas_dest_dir = env.build_dir / "schemas"
@@ -138,9 +146,6 @@ def check_artifact_schema(args=None):
         cwd=env.dbt_dir,
     )
 
-    artifact_schema_repo = ArtifactSchemaRepository(env.schemas_checkout_path)
-    artifact_schema_repo.clone()
-
     deep_diff_path = str(env.schemas_venv / "bin/deep")
     schema_files = schemas_dest_dir.glob("**/*.json")
     for schema_file_path in schema_files:
@@ -169,7 +174,7 @@ def check_artifact_schema(args=None):
                     "\\['generated_at'\\]\\['default'\\]|\\['description'\\]|"
                     "\\['dbt_schema_version'\\]\\['default'\\]",
                 ]
-                results = collect_output(cmd).strip()
+                results = "\n".join(iter_output(cmd)).strip()
                 if results != "{}":
                     raise ValueError(
                         f"There are breaking changes to artifact schema {relative_path}:"
@@ -179,17 +184,15 @@ def check_artifact_schema(args=None):
     print("No breaking changes!")
 
 
+@traced
 def publish_artifact_schema(args=None):
     env = EnvironmentInformation()
     release = ReleaseFile.from_artifacts(env)
     artifact_env = SchemaArtifactEnv(env.dbt_dir / "requirements.txt")
     artifact_env.create(env.schemas_venv)
-    pip = str(env.schemas_venv / "bin/pip")
-    cmd = [pip, "install", "-r", "requirements.txt"]
-    stream_output(cmd, cwd=env.dbt_dir)
-
     artifact_schema_repo = ArtifactSchemaRepository(env.schemas_checkout_path)
-    artifact_schema_repo.clone()
+    run_with_retry(artifact_schema_repo.clone_command(), GIT_NETWORK)
+    artifact_schema_repo.finish_clone()
 
     python_path = str(env.schemas_venv / "bin/python")
     stream_output(
@@ -206,12 +209,17 @@ def publish_artifact_schema(args=None):
     generate_schema_doc_path = str(env.schemas_venv / "bin/generate-schema-doc")
     schema_files = (env.schemas_checkout_path / "dbt").glob("**/*.json")
     schema_data = []
+    executor = CommandExecutor()
     for schema_file_path in schema_files:
         schema_dir_path = schema_file_path.with_suffix("")
         schema_dir_path.mkdir(exist_ok=True)
         schema_docs_path = schema_dir_path / "index.html"
         cmd = [generate_schema_doc_path, schema_file_path, schema_docs_path]
-        stream_output(cmd, cwd=env.schemas_checkout_path)
+        executor.submit(
+            cmd,
+            cwd=env.schemas_checkout_path,
+            name=str(schema_file_path.relative_to(env.schemas_checkout_path)),
+        )
         schema_data.append(
             SchemaInfo(
                 name=str(schema_file_path.relative_to(env.schemas_checkout_path)),
@@ -220,6 +228,8 @@ def publish_artifact_schema(args=None):
             )
         )
 
+    executor.run()
+
     index_file = env.schemas_checkout_path / "index.html"
     index_file.write_text(schema_artifacts_to_html(schema_data))
 
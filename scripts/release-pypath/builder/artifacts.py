@@ -0,0 +1,129 @@
+"""Content-addressed storage for the files passed between release jobs.
+
+File contents are stored once per SHA-256 digest under `objects/`, and
+`index.json` maps logical names such as "release.txt" or
+"dist/dbt-core-0.21.0.tar.gz" to a digest. Each name is also kept as a plain
+file at `<root>/<name>` so tools like docker can use the artifacts directory
+directly; those files are only rewritten when their contents changed.
+
+The named file shares storage with its object (as a reflink or a hardlink),
+so each artifact is only stored once. That means named files must never be
+rewritten in place: write them with `ArtifactStore.write`, which replaces the
+file and records it.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional
+import json
+import os
+import tempfile
+
+from .staging import new_file_mode, same_file, sha256_file, stage_file
+
+
+class ArtifactStore:
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.objects_dir = root / "objects"
+        self.index_path = root / "index.json"
+
+    def _load_index(self) -> Dict[str, Dict[str, object]]:
+        if not self.index_path.exists():
+            return {}
+        with self.index_path.open() as fp:
+            return json.load(fp)
+
+    def _save_index(self, index: Dict[str, Dict[str, object]]) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(index, fp, indent=2, sort_keys=True)
+        os.chmod(tmp, new_file_mode())
+        os.replace(tmp, self.index_path)
+
+    def _object_path(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest
+
+    def digest(self, name: str) -> Optional[str]:
+        entry = self._load_index().get(name)
+        if entry is None:
+            return None
+        return str(entry["sha256"])
+
+    def names(self, prefix: str = "") -> List[str]:
+        return sorted(n for n in self._load_index() if n.startswith(prefix))
+
+    def _is_current(self, path: Path, digest: str, size: int) -> bool:
+        if not path.is_file():
+            return False
+        if same_file(path, self._object_path(digest)):
+            return True
+        return path.stat().st_size == size and sha256_file(path) == digest
+
+    def put(self, name: str, source: Path) -> str:
+        """Store the contents of source as name and return its digest. The
+        contents are only staged where they aren't already present, and
+        source must not be changed in place afterwards.
+        """
+        digest = sha256_file(source)
+        size = source.stat().st_size
+        obj = self._object_path(digest)
+        if not obj.exists():
+            stage_file(source, obj, digest=digest)
+        dest = self.root / name
+        if not same_file(dest, obj):
+            stage_file(obj, dest, digest=digest)
+        index = self._load_index()
+        entry = {"sha256": digest, "size": size}
+        if index.get(name) != entry:
+            index[name] = entry
+            self._save_index(index)
+        return digest
+
+    def record(self, path: Path) -> str:
+        """Store a file that was written under the store's root."""
+        name = path.absolute().relative_to(self.root.absolute()).as_posix()
+        return self.put(name, path)
+
+    @contextmanager
+    def write(self, path: Path, mode: str = "w") -> Iterator[IO]:
+        """Open a new file that replaces path under the store's root once the
+        block finishes, and record it.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, mode) as fp:
+                yield fp
+            os.chmod(tmp, new_file_mode())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self.record(path)
+
+    def get(self, name: str) -> Path:
+        """Return the path of the named artifact, restoring it from the object
+        store if it's missing or has changed. Artifacts written before the
+        store existed are returned as-is.
+        """
+        dest = self.root / name
+        entry = self._load_index().get(name)
+        if entry is None:
+            if dest.exists():
+                return dest
+            raise KeyError(f"No artifact named {name} in {self.root}")
+        digest = str(entry["sha256"])
+        if not self._is_current(dest, digest, int(entry["size"])):
+            obj = self._object_path(digest)
+            if not obj.exists():
+                raise KeyError(f"Artifact {name} is missing object {digest}")
+            stage_file(obj, dest, digest=digest)
+        return dest
+
+    def checkout(self, prefix: str = "") -> List[Path]:
+        """Make sure every artifact whose name starts with prefix is present,
+        and return their paths.
+        """
+        return [self.get(name) for name in self.names(prefix)]
@@ -0,0 +1,72 @@
+"""A cache of built sdists and wheels, so rebuilding a package whose sources
+haven't changed just restores its previous build.
+
+Builds are keyed by a hash of the package's tracked files plus the versions
+of the build backend. Only the most recent `keep` builds of each package are
+kept.
+"""
+from pathlib import Path
+from typing import Iterator
+import hashlib
+import os
+import shutil
+
+from .cmd import collect_output
+from .staging import sha256_file, stage_file
+
+
+class BuildCache:
+    """Built sdists and wheels, keyed by a hash of the package's tracked
+    source files and the versions of the build backend.
+    """
+
+    def __init__(self, cache_dir: Path, keep: int = 5):
+        self.cache_dir = cache_dir
+        self.keep = keep
+
+    @staticmethod
+    def source_key(path: Path, backend: str) -> str:
+        value = hashlib.sha256(backend.encode("utf-8"))
+        output = collect_output(["git", "ls-files", "-z"], cwd=path)
+        for name in sorted(n for n in output.split("\0") if n):
+            file_path = path / name
+            value.update(name.encode("utf-8") + b"\0")
+            if file_path.is_file():
+                value.update(sha256_file(file_path).encode("utf-8"))
+        return value.hexdigest()
+
+    def _entry(self, name: str, key: str) -> Path:
+        return self.cache_dir / name.replace("/", "-") / key
+
+    def restore(self, name: str, key: str, dist_path: Path) -> bool:
+        entry = self._entry(name, key)
+        if not entry.is_dir():
+            return False
+        dist_path.mkdir(parents=True, exist_ok=True)
+        for cached in sorted(entry.iterdir()):
+            stage_file(cached, dist_path / cached.name)
+        # mark it as recently used
+        os.utime(entry)
+        return True
+
+    def store(self, name: str, key: str, packages: Iterator[Path]) -> None:
+        entry = self._entry(name, key)
+        tmp = entry.with_name(entry.name + ".tmp")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        for package in packages:
+            stage_file(package, tmp / package.name)
+        if entry.exists():
+            shutil.rmtree(entry)
+        tmp.rename(entry)
+        self._evict(entry.parent)
+
+    def _evict(self, package_dir: Path) -> None:
+        entries = sorted(
+            (p for p in package_dir.iterdir() if p.is_dir()),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for old in entries[self.keep :]:
+            shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,113 @@
+"""Set the version of a checkout the way `bumpversion --new-version` would,
+without a venv that has bumpversion installed.
+
+This covers the parts of `.bumpversion.cfg` that dbt uses: `current_version`,
+plus `bumpversion:file:` sections with optional `search` and `replace`
+templates. The templates default to `{current_version}` and `{new_version}`.
+Nothing is committed. The caller decides what goes into the release commit.
+"""
+from configparser import ConfigParser
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+import re
+
+CONFIG_NAME = ".bumpversion.cfg"
+FILE_PREFIX = "bumpversion:file:"
+
+_CURRENT_VERSION = re.compile(r"^(current_version\s*=\s*)(.*)$", re.MULTILINE)
+
+
+@dataclass
+class VersionFile:
+    path: str
+    search: str
+    replace: str
+
+
+@dataclass
+class BumpversionConfig:
+    path: Path
+    current_version: str
+    files: List[VersionFile]
+
+    @classmethod
+    def from_dir(cls, root: Path) -> "BumpversionConfig":
+        path = root / CONFIG_NAME
+        # bumpversion doesn't interpolate, and templates may contain '%'
+        config = ConfigParser(interpolation=None)
+        if not config.read(path):
+            raise ValueError(f"No {CONFIG_NAME} found in {root}")
+        if not config.has_option("bumpversion", "current_version"):
+            raise ValueError(f"No current_version in {path}")
+        main = config["bumpversion"]
+        files = []
+        for section in config.sections():
+            if not section.startswith(FILE_PREFIX):
+                continue
+            options = config[section]
+            files.append(
+                VersionFile(
+                    path=section[len(FILE_PREFIX) :],
+                    search=options.get(
+                        "search", main.get("search", "{current_version}")
+                    ),
+                    replace=options.get(
+                        "replace", main.get("replace", "{new_version}")
+                    ),
+                )
+            )
+        return cls(path=path, current_version=main["current_version"], files=files)
+
+
+def _read(path: Path) -> str:
+    # keep line endings as they are
+    with path.open(newline="") as fp:
+        return fp.read()
+
+
+def _write(path: Path, text: str) -> None:
+    with path.open("w", newline="") as fp:
+        fp.write(text)
+
+
+def _render(template: str, context: Dict[str, str], path: str) -> str:
+    try:
+        return template.format(**context)
+    except KeyError as exc:
+        raise ValueError(
+            f"Unsupported variable {exc} in the template for {path}: {template}"
+        ) from None
+
+
+def set_version(root: Path, new_version: str) -> List[Path]:
+    """Replace the current version with new_version in every file listed in
+    the checkout's .bumpversion.cfg and in the config itself. Return the files
+    that were changed.
+    """
+    config = BumpversionConfig.from_dir(root)
+    context = {
+        "current_version": config.current_version,
+        "new_version": new_version,
+    }
+    # check every file before writing any of them, like bumpversion does
+    updates: Dict[Path, str] = {}
+    for version_file in config.files:
+        path = root / version_file.path
+        search = _render(version_file.search, context, version_file.path)
+        replace = _render(version_file.replace, context, version_file.path)
+        text = updates.get(path, _read(path)) if path.exists() else None
+        if text is None or search not in text:
+            raise ValueError(f"Did not find {search!r} in {path}")
+        updates[path] = text.replace(search, replace)
+
+    text, count = _CURRENT_VERSION.subn(
+        lambda m: m.group(1) + new_version, _read(config.path), count=1
+    )
+    if count != 1:
+        raise ValueError(f"No current_version line in {config.path}")
+    updates[config.path] = text
+
+    for path, text in updates.items():
+        _write(path, text)
+    return list(updates)
@@ -1,11 +1,24 @@
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+import asyncio
+import os
+import random
+import re
 import subprocess
 import sys
+import threading
+import time
+
+from .trace import TRACER, Span, describe_cmd, span
 
 
 def stream_output(cmd, cwd=None) -> None:
     """Stream the output to stdout as the command is running"""
     try:
-        subprocess.run(cmd, cwd=cwd, check=True, stdout=None, stderr=None)
+        with span(describe_cmd(cmd), "cmd", cmd=[str(c) for c in cmd]):
+            subprocess.run(cmd, cwd=cwd, check=True, stdout=None, stderr=None)
     except subprocess.CalledProcessError as exc:
         print(f"Command {exc.cmd} failed")
         if exc.output:
@@ -15,12 +28,23 @@ def stream_output(cmd, cwd=None) -> None:
         raise
 
 
-def collect_output(cmd, cwd=None, stderr=subprocess.PIPE, check=True) -> str:
-    """Collect stdout and return it as a str"""
+def collect_output(
+    cmd, cwd=None, stderr=subprocess.PIPE, check=True, input: Optional[str] = None
+) -> str:
+    """Collect stdout and return it as a str, optionally writing input to
+    stdin first.
+    """
+    data = None if input is None else input.encode("utf-8")
     try:
-        result = subprocess.run(
-            cmd, cwd=cwd, check=check, stdout=subprocess.PIPE, stderr=stderr
-        )
+        with span(describe_cmd(cmd), "cmd", cmd=[str(c) for c in cmd]):
+            result = subprocess.run(
+                cmd,
+                cwd=cwd,
+                check=check,
+                input=data,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
     except subprocess.CalledProcessError as exc:
         print(f"Command {exc.cmd} failed")
         if exc.output:
@@ -29,3 +53,368 @@ def collect_output(cmd, cwd=None, stderr=subprocess.PIPE, check=True) -> str:
             print(exc.stderr.decode("utf-8"), file=sys.stderr)
         raise
     return result.stdout.decode("utf-8")
+
+
+def iter_output(
+    cmd, cwd=None, check=True, stderr_lines: int = 50, merge_stderr: bool = False
+) -> Iterator[str]:
+    """Yield decoded lines of stdout as the command writes them.
+
+    Only the last `stderr_lines` lines of stderr are kept, for error reporting,
+    so memory use doesn't grow with the size of the output. With merge_stderr,
+    stderr is yielded along with stdout instead. If the caller stops iterating
+    early, the command is killed.
+    """
+    stderr_tail: deque = deque(maxlen=stderr_lines)
+    with span(describe_cmd(cmd), "cmd", cmd=[str(c) for c in cmd]):
+        proc = subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace",
+        )
+        assert proc.stdout is not None
+        reader = None
+        if proc.stderr is not None:
+            # drain stderr in the background so a chatty command can't block
+            # on a full pipe while we're reading stdout
+            reader = threading.Thread(
+                target=lambda: stderr_tail.extend(proc.stderr), daemon=True
+            )
+            reader.start()
+        try:
+            for line in proc.stdout:
+                yield line.rstrip("\n")
+            proc.wait()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if reader is not None:
+                reader.join()
+            proc.stdout.close()
+            if proc.stderr is not None:
+                proc.stderr.close()
+    if check and proc.returncode != 0:
+        stderr = "".join(stderr_tail)
+        print(f"Command {cmd} failed")
+        if stderr:
+            print(stderr, file=sys.stderr)
+        raise subprocess.CalledProcessError(
+            proc.returncode, cmd, stderr=stderr.encode("utf-8")
+        )
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """When and how often to retry a failed command.
+
+    A failure is retried if its exit code is in `exit_codes` (any non-zero
+    code if that's empty) and the tail of its stderr matches one of
+    `patterns` (any stderr if that's empty). Delays grow exponentially from
+    `base_delay` with full jitter, and no retry starts once `budget` seconds
+    have passed since the first attempt.
+    """
+
+    name: str
+    max_attempts: int = 4
+    base_delay: float = 2.0
+    max_delay: float = 60.0
+    budget: float = 300.0
+    exit_codes: Tuple[int, ...] = ()
+    patterns: Tuple[str, ...] = ()
+
+    def is_retryable(self, returncode: int, stderr: str) -> bool:
+        if returncode == 0:
+            return False
+        if self.exit_codes and returncode not in self.exit_codes:
+            return False
+        if not self.patterns:
+            return True
+        return any(re.search(p, stderr, re.IGNORECASE) for p in self.patterns)
+
+    def delay(self, attempt: int) -> float:
+        """The time to sleep after the given (1-based) failed attempt."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def next_delay(self, attempt: int, started: float) -> Optional[float]:
+        """Return how long to wait before retrying, or None to give up."""
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.delay(attempt)
+        if time.monotonic() - started + delay > self.budget:
+            return None
+        return delay
+
+
+_CONNECTION_ERRORS = (
+    r"could not resolve host",
+    r"temporary failure in name resolution",
+    r"connection (timed out|reset|refused|aborted)",
+    r"operation timed out",
+    r"network is unreachable",
+)
+
+GIT_NETWORK = RetryPolicy(
+    name="git",
+    exit_codes=(128,),
+    patterns=_CONNECTION_ERRORS
+    + (
+        r"early EOF",
+        r"the remote end hung up unexpectedly",
+        r"RPC failed",
+        r"unable to access",
+        r"(kex|ssh)_exchange_identification",
+        r"Could not read from remote repository",
+    ),
+)
+
+PIP_NETWORK = RetryPolicy(
+    name="pip",
+    exit_codes=(1, 2),
+    patterns=_CONNECTION_ERRORS
+    + (
+        r"ReadTimeoutError",
+        r"ConnectionError",
+        r"Max retries exceeded",
+        r"HTTP error 5\d\d",
+        r"ProtocolError",
+    ),
+)
+
+TWINE_UPLOAD = RetryPolicy(
+    name="twine",
+    max_attempts=3,
+    base_delay=5.0,
+    exit_codes=(1,),
+    patterns=_CONNECTION_ERRORS
+    + (
+        r"HTTPError: 5\d\d",
+        r"Read timed out",
+        r"ConnectionError",
+    ),
+)
+
+DOCKER_PUSH = RetryPolicy(
+    name="docker",
+    base_delay=5.0,
+    budget=600.0,
+    exit_codes=(1,),
+    patterns=_CONNECTION_ERRORS
+    + (
+        r"i/o timeout",
+        r"TLS handshake timeout",
+        r"unexpected HTTP status: 5\d\d",
+        r"net/http: request canceled",
+    ),
+)
+
+
+def _run_teeing_stderr(cmd, cwd, tail_lines: int = 50) -> Tuple[int, str]:
+    """Run cmd with stdout and stderr going to the terminal as usual, but keep
+    the tail of stderr around so failures can be classified.
+    """
+    stderr_tail: deque = deque(maxlen=tail_lines)
+    proc = subprocess.Popen(
+        cmd, cwd=cwd, stderr=subprocess.PIPE, encoding="utf-8", errors="replace"
+    )
+    assert proc.stderr is not None
+    for line in proc.stderr:
+        sys.stderr.write(line)
+        stderr_tail.append(line)
+    proc.stderr.close()
+    return proc.wait(), "".join(stderr_tail)
+
+
+def run_with_retry(cmd, policy: RetryPolicy, cwd=None) -> None:
+    """Like stream_output, but retry failures that policy considers
+    transient.
+    """
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        with span(
+            describe_cmd(cmd), "cmd", cmd=[str(c) for c in cmd], attempt=attempt
+        ) as args:
+            returncode, stderr = _run_teeing_stderr(cmd, cwd)
+            args["returncode"] = returncode
+        if returncode == 0:
+            return
+        delay = None
+        if policy.is_retryable(returncode, stderr):
+            delay = policy.next_delay(attempt, started)
+        if delay is None:
+            print(f"Command {cmd} failed after {attempt} attempt(s)")
+            raise subprocess.CalledProcessError(
+                returncode, cmd, stderr=stderr.encode("utf-8")
+            )
+        print(
+            f"Command {cmd} failed with a transient {policy.name} error, "
+            f"retrying in {delay:.1f}s (attempt {attempt}/{policy.max_attempts})"
+        )
+        time.sleep(delay)
+
+
+@dataclass
+class CommandResult:
+    name: str
+    cmd: List[str]
+    returncode: int
+    duration: float
+    tail: List[str]
+    attempts: int = 1
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+@dataclass
+class _Submitted:
+    name: str
+    cmd: List[str]
+    cwd: Optional[Path]
+    retry: Optional[RetryPolicy]
+    on_line: Optional[Callable[[str], None]]
+    on_exit: Optional[Callable[[CommandResult], None]]
+
+
+class CommandExecutor:
+    """Run independent commands concurrently, at most `max_workers` at a time.
+
+    Output from all commands is interleaved on stdout as it is produced, each
+    line prefixed with the name of the command that wrote it. Only the last
+    `tail_lines` lines (stdout and stderr combined) of each command are kept.
+    """
+
+    # asyncio's default of 64KiB is too small for some pip/pytest lines
+    _LINE_LIMIT = 1024 * 1024
+
+    def __init__(self, max_workers: Optional[int] = None, tail_lines: int = 50):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.tail_lines = tail_lines
+        self._pending: List[_Submitted] = []
+
+    def submit(
+        self,
+        cmd,
+        cwd=None,
+        name: Optional[str] = None,
+        retry: Optional[RetryPolicy] = None,
+        on_line: Optional[Callable[[str], None]] = None,
+        on_exit: Optional[Callable[[CommandResult], None]] = None,
+    ) -> None:
+        """Queue cmd to be run. If on_line is given, it's called with every
+        line of output. If on_exit is given, it's called with the result as
+        soon as cmd has finished, before the others are done.
+        """
+        args = [str(c) for c in cmd]
+        if name is None:
+            name = f"{Path(args[0]).name}-{len(self._pending)}"
+        self._pending.append(_Submitted(name, args, cwd, retry, on_line, on_exit))
+
+    async def _attempt(self, item: _Submitted) -> Tuple[int, List[str]]:
+        print(f"[{item.name}] running cmd: {item.cmd}", flush=True)
+        trace_start = TRACER.now()
+        proc = await asyncio.create_subprocess_exec(
+            *item.cmd,
+            cwd=item.cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=self._LINE_LIMIT,
+        )
+        assert proc.stdout is not None
+        tail: deque = deque(maxlen=self.tail_lines)
+        async for raw in proc.stdout:
+            line = raw.decode("utf-8", errors="replace").rstrip("\n")
+            tail.append(line)
+            print(f"[{item.name}] {line}", flush=True)
+            if item.on_line is not None:
+                item.on_line(line)
+        returncode = await proc.wait()
+        # commands overlap, so each one gets its own track in the trace
+        TRACER.add(
+            Span(
+                name=describe_cmd(item.cmd),
+                category="cmd",
+                start=trace_start,
+                duration=TRACER.now() - trace_start,
+                tid=TRACER.track(("cmd", item.name), item.name),
+                args={"cmd": item.cmd, "returncode": returncode},
+            )
+        )
+        return returncode, list(tail)
+
+    async def _run_one(
+        self, semaphore: asyncio.Semaphore, item: _Submitted
+    ) -> CommandResult:
+        start = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            async with semaphore:
+                if attempt == 1:
+                    # waiting for the first slot doesn't count
+                    start = time.monotonic()
+                returncode, tail = await self._attempt(item)
+            if returncode == 0 or item.retry is None:
+                break
+            if not item.retry.is_retryable(returncode, "\n".join(tail)):
+                break
+            delay = item.retry.next_delay(attempt, start)
+            if delay is None:
+                break
+            print(
+                f"[{item.name}] transient {item.retry.name} error, "
+                f"retrying in {delay:.1f}s",
+                flush=True,
+            )
+            # give up the slot while waiting, so other commands can run
+            await asyncio.sleep(delay)
+        duration = time.monotonic() - start
+        print(
+            f"[{item.name}] exited with {returncode} after {duration:.1f}s",
+            flush=True,
+        )
+        result = CommandResult(
+            name=item.name,
+            cmd=item.cmd,
+            returncode=returncode,
+            duration=duration,
+            tail=tail,
+            attempts=attempt,
+        )
+        if item.on_exit is not None:
+            item.on_exit(result)
+        return result
+
+    async def _run_all(self, pending: List[_Submitted]) -> List[CommandResult]:
+        semaphore = asyncio.Semaphore(self.max_workers)
+        tasks = [self._run_one(semaphore, item) for item in pending]
+        return list(await asyncio.gather(*tasks))
+
+    def run(self, check: bool = True) -> List[CommandResult]:
+        """Run everything submitted so far and return the results in submission
+        order. If check is set, raise CalledProcessError for the first failed
+        command after all of them have finished.
+        """
+        pending, self._pending = self._pending, []
+        results = asyncio.run(self._run_all(pending))
+        failed = [r for r in results if not r.ok]
+        for result in failed:
+            print(f"Command {result.cmd} failed, last output:")
+            print("\n".join(result.tail), file=sys.stderr)
+        if check and failed:
+            first = failed[0]
+            raise subprocess.CalledProcessError(
+                first.returncode,
+                first.cmd,
+                output="\n".join(first.tail).encode("utf-8"),
+            )
+        return results
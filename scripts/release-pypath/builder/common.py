@@ -1,18 +1,20 @@
 from dataclasses import dataclass
 from enum import Enum
+from operator import attrgetter
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
 import re
 import sys
-import json
-from urllib.request import urlopen
 
-from .cmd import stream_output, collect_output
+from .artifacts import ArtifactStore
+from .cmd import CommandExecutor, iter_output
+from .timings import DurationCollector, DurationHistory, xdist_workers
+from .pypi import PypiMetadataCache
 
 
 DBT_REPO = "git@github.com:fishtown-analytics/dbt.git"
 HOMEBREW_DBT_REPO = "git@github.com:fishtown-analytics/homebrew-dbt.git"
-PYPI_DBT_VERSION_URL = "https://pypi.org/pypi/dbt/json"
 
 # This should match the pattern in .bumpversion.cfg
 VERSION_PATTERN_STR = (
@@ -25,27 +27,84 @@ VERSION_PATTERN_STR = (
 VERSION_PATTERN = re.compile(VERSION_PATTERN_STR)
 
 
+# PEP 440 spellings of the prerelease phases, normalized to the short form
+PRERELEASE_ALIASES = {
+    "a": "a",
+    "alpha": "a",
+    "b": "b",
+    "beta": "b",
+    "c": "rc",
+    "pre": "rc",
+    "preview": "rc",
+    "rc": "rc",
+}
+
+# a < b < rc < final
+_PRERELEASE_RANKS = {"a": 0, "b": 1, "rc": 2}
+_FINAL_RANK = 3
+
+
 class Version:
+    """An immutable, hashable dbt version.
+
+    The sort key is computed once when the version is parsed, so comparisons
+    and sorts don't build tuples. Final releases sort after their prereleases.
+    """
+
+    __slots__ = ("raw", "major", "minor", "patch", "prerelease", "num", "sort_key")
+
+    raw: str
+    major: int
+    minor: int
+    patch: int
+    prerelease: Optional[str]
+    num: Optional[int]
+    sort_key: Tuple[int, int, int, int, int]
+
     def __init__(self, raw: str) -> None:
-        self.raw = raw
-        match = VERSION_PATTERN.match(self.raw)
+        match = VERSION_PATTERN.match(raw)
         if match is None:
-            raise ValueError(f"Invalid version: {self.raw}")
+            raise ValueError(f"Invalid version: {raw}")
         groups = match.groupdict()
 
-        self.major: int = int(groups["major"])
-        self.minor: int = int(groups["minor"])
-        self.patch: int = int(groups["patch"])
-        self.prerelease: Optional[str] = None
-        self.num: Optional[int] = None
+        major = int(groups["major"])
+        minor = int(groups["minor"])
+        patch = int(groups["patch"])
+        prerelease: Optional[str] = None
+        num: Optional[int] = None
+        rank = _FINAL_RANK
 
         if groups["num"] is not None:
-            self.prerelease = groups["prerelease"]
-            self.num = int(groups["num"])
+            prerelease = groups["prerelease"]
+            num = int(groups["num"])
+            if prerelease not in PRERELEASE_ALIASES:
+                raise ValueError(f"Invalid prerelease {prerelease!r} in version: {raw}")
+            rank = _PRERELEASE_RANKS[PRERELEASE_ALIASES[prerelease]]
+
+        set_ = object.__setattr__
+        set_(self, "raw", raw)
+        set_(self, "major", major)
+        set_(self, "minor", minor)
+        set_(self, "patch", patch)
+        set_(self, "prerelease", prerelease)
+        set_(self, "num", num)
+        set_(self, "sort_key", (major, minor, patch, rank, num or 0))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return (type(self), (self.raw,))
 
     def __str__(self):
         return self.raw
 
+    def __repr__(self):
+        return f"{type(self).__name__}({self.raw!r})"
+
     def homebrew_class_name(self) -> str:
         name = f"DbtAT{self.major}{self.minor}{self.patch}"
         if self.prerelease is not None and self.num is not None:
@@ -61,78 +120,143 @@ class Version:
     @classmethod
     def get_latest_dbt_version(cls) -> "Optional[Version]":
         try:
-            fp = urlopen(PYPI_DBT_VERSION_URL)
+            data = EnvironmentInformation().pypi_metadata().get("dbt")
         except Exception as exc:
             print(f"Could not get pypi info for dbt: {exc}")
             raise
-        try:
-            data = json.load(fp)
-        finally:
-            fp.close()
 
-        version_string = data["info"]["version"]
+        # the highest final release in the listing that has files
+        listed = (raw for raw, files in data.get("releases", {}).items() if files)
+        versions = unique_versions(parse_versions(listed, skip_invalid=True))
+        finals = [version for version in versions if version.prerelease is None]
+        if finals:
+            return finals[-1]
+        return cls(data["info"]["version"])
 
-        return cls(version_string)
+    def __hash__(self):
+        return hash(self.sort_key)
 
     def __eq__(self, other):
-        return (self.major, self.minor, self.patch, self.prerelease, self.num) == (
-            other.major,
-            other.minor,
-            other.patch,
-            other.prerelease,
-            other.num,
-        )
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key == other.sort_key
 
     def __ne__(self, other):
-        return (self.major, self.minor, self.patch, self.prerelease, self.num) != (
-            other.major,
-            other.minor,
-            other.patch,
-            other.prerelease,
-            other.num,
-        )
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key != other.sort_key
 
     def __lt__(self, other):
-        return (self.major, self.minor, self.patch, self.prerelease, self.num) < (
-            other.major,
-            other.minor,
-            other.patch,
-            other.prerelease,
-            other.num,
-        )
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key < other.sort_key
 
     def __le__(self, other):
-        return (self.major, self.minor, self.patch, self.prerelease, self.num) <= (
-            other.major,
-            other.minor,
-            other.patch,
-            other.prerelease,
-            other.num,
-        )
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key <= other.sort_key
 
     def __gt__(self, other):
-        return (self.major, self.minor, self.patch, self.prerelease, self.num) > (
-            other.major,
-            other.minor,
-            other.patch,
-            other.prerelease,
-            other.num,
-        )
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key > other.sort_key
 
     def __ge__(self, other):
-        return (self.major, self.minor, self.patch, self.prerelease, self.num) >= (
-            other.major,
-            other.minor,
-            other.patch,
-            other.prerelease,
-            other.num,
-        )
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key >= other.sort_key
+
+
+def parse_versions(raws: Iterable[str], skip_invalid: bool = False) -> List[Version]:
+    """Parse many version strings, e.g. the keys of a PyPI "releases" listing.
+    With skip_invalid, strings that aren't dbt-style versions are dropped
+    instead of raising.
+    """
+    versions = []
+    for raw in raws:
+        try:
+            versions.append(Version(raw))
+        except ValueError:
+            if not skip_invalid:
+                raise
+    return versions
+
+
+def sort_versions(versions: Iterable[Version], reverse: bool = False) -> List[Version]:
+    return sorted(versions, key=attrgetter("sort_key"), reverse=reverse)
+
+
+def unique_versions(versions: Iterable[Version]) -> List[Version]:
+    """Sort versions, keeping the first of any that compare equal."""
+    unique: Dict[Tuple[int, ...], Version] = {}
+    for version in versions:
+        unique.setdefault(version.sort_key, version)
+    return sort_versions(unique.values())
+
+
+def max_version(versions: Iterable[Version]) -> Optional[Version]:
+    return max(versions, key=attrgetter("sort_key"), default=None)
 
 
 class EnvironmentInformation:
     def __init__(self):
         self.artifacts_dir = Path.cwd() / "artifacts"
         self.build_dir = Path.cwd() / "build"
+        # caches outlive a single checkout, so they don't go in build/
+        self.cache_dir = Path(
+            os.getenv("DBT_RELEASE_CACHE_DIR", Path.home() / ".cache/dbt-release")
+        )
+
+    @property
+    def pypi_cache_dir(self) -> Path:
+        return self.cache_dir / "pypi"
+
+    def pypi_metadata(self) -> PypiMetadataCache:
+        return PypiMetadataCache(self.pypi_cache_dir)
+
+    @property
+    def build_cache_dir(self) -> Path:
+        return self.cache_dir / "builds"
+
+    @property
+    def git_mirror_dir(self) -> Path:
+        return self.cache_dir / "git"
+
+    @property
+    def wheelhouse_dir(self) -> Path:
+        return self.cache_dir / "wheelhouse"
+
+    @property
+    def venv_template_dir(self) -> Path:
+        return self.cache_dir / "venv-templates"
+
+    @property
+    def requirements_cache_dir(self) -> Path:
+        return self.cache_dir / "requirements"
+
+    @property
+    def package_log_dir(self) -> Path:
+        return self.build_dir / "package_logs"
+
+    @property
+    def releases_dir(self) -> Path:
+        return Path.cwd() / "releases"
+
+    @property
+    def test_impact_file(self) -> Path:
+        return self.artifacts_dir / "test_impact.json"
+
+    @property
+    def upload_progress_file(self) -> Path:
+        return self.artifacts_dir / "upload_progress.json"
+
+    @property
+    def test_durations_file(self) -> Path:
+        return self.cache_dir / "test_durations.json"
+
+    @property
+    def artifact_store(self) -> ArtifactStore:
+        return ArtifactStore(self.artifacts_dir)
 
     @property
     def dbt_dir(self) -> Path:
@@ -198,6 +322,9 @@ class EnvironmentInformation:
     def schemas_venv(self) -> Path:
         return self.build_dir / "schemas_venv"
 
+    def trace_path(self, stage: str) -> Path:
+        return self.artifacts_dir / f"trace.{stage}.json"
+
     def get_dbt_requirements_file(self, version: str) -> Path:
         return self.docker_dir / f"requirements/requirements.{version}.txt"
 
@@ -256,10 +383,9 @@ class ReleaseFile:
     @staticmethod
     def _git_modified_files_last_commit() -> List[Path]:
         cmd = ["git", "diff", "--name-status", "HEAD~1", "HEAD"]
-        result = collect_output(cmd)
         paths = []
-        for line in result.strip().split("\n"):
-            if line[0] not in "AM":
+        for line in iter_output(cmd):
+            if not line or line[0] not in "AM":
                 continue
             match = re.match(r"^[AM]\s*(releases/.*)", line)
             if match is None:
@@ -292,18 +418,32 @@ class ReleaseFile:
 
     def store_artifacts(self, env: EnvironmentInformation):
         print(f"Storing release file in {env.artifacts_dir}")
-        env.artifacts_dir.mkdir(parents=True, exist_ok=True)
-        dest = env.release_file
-        with dest.open("w") as fp:
+        with env.artifact_store.write(env.release_file) as fp:
             fp.write(f"commit: {self.commit}\n")
             fp.write(f"version: {self.version}\n")
             fp.write(f"branch: {self.branch}\n")
             fp.write("\n")
             fp.write(self.notes)
 
+    def previous_release(self, releases_dir: Path) -> "Optional[ReleaseFile]":
+        """Find the release in releases_dir with the highest version below
+        this one.
+        """
+        releases: Dict[Version, ReleaseFile] = {}
+        for path in sorted(releases_dir.glob("**/*.txt")):
+            try:
+                release = self.from_path(path)
+            except ValueError:
+                continue
+            releases.setdefault(release.version, release)
+        previous = max_version(v for v in releases if v < self.version)
+        if previous is None:
+            return None
+        return releases[previous]
+
     @classmethod
     def from_artifacts(cls, env: EnvironmentInformation) -> "ReleaseFile":
-        return cls.from_path(env.release_file)
+        return cls.from_path(env.artifact_store.get("release.txt"))
 
     @property
     def release_branch_name(self) -> str:
@@ -329,33 +469,134 @@ class PackageType(Enum):
 
 
 class PytestRunner:
-    def __init__(self, env_path: Path, dbt_path: Path):
+    """Run the smoke test suites against an installed dbt.
+
+    If a duration history is given, the durations pytest reports are recorded
+    in it, and the tests are run slowest first. With a shard of (index, count),
+    only that shard of each suite is run. Every shard has to compute the same
+    split, so it's balanced by shard_durations, which all of them must share
+    (e.g. a committed file), rather than by the history on this host. Without
+    shard_durations, the tests are split evenly by count.
+    """
+
+    def __init__(
+        self,
+        env_path: Path,
+        dbt_path: Path,
+        history: Optional[DurationHistory] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        workers: Optional[int] = None,
+        shard_durations: Optional[DurationHistory] = None,
+    ):
         self.env_path = env_path
         self.dbt_path = dbt_path
+        self.history = history
+        self.shard = shard
+        self.workers = workers
+        if shard_durations is None:
+            shard_durations = DurationHistory()
+        self.shard_durations = shard_durations
+
+    @property
+    def _python(self) -> Path:
+        return (self.env_path / "bin/python").absolute()
 
-    def _pytest_cmd(self, *extra: str):
-        test_python_path = (self.env_path / "bin/python").absolute()
-        cmd = [test_python_path, "-m", "pytest", "--durations", "0", "-v", "-n4"]
+    def _pytest_cmd(self, *extra: str, workers: int = 4):
+        cmd = [self._python, "-m", "pytest", "--durations", "0", "-v", f"-n{workers}"]
         cmd.extend(extra)
         return cmd
 
+    @staticmethod
+    def _suite(name: str) -> Tuple[List[str], List[str]]:
+        """The options and paths that select the tests for name."""
+        if name == "rpc":
+            return [], ["test/rpc"]
+        # we already ran integration tests, we just want to make sure the
+        # package we built is functional.
+        return ["-m", f"profile_{name}"], ["test/integration/029_docs_generate_tests"]
+
+    def _collect(self, options: List[str], paths: List[str]) -> List[str]:
+        cmd = [self._python, "-m", "pytest", "--collect-only", "-q"]
+        cmd.extend(options + paths)
+        return [line for line in iter_output(cmd, cwd=self.dbt_path) if "::" in line]
+
+    def _test_cmd(self, name: str, *extra: str, concurrent_suites: int = 1):
+        """Build the pytest command for name, or return None if this shard has
+        no tests from it.
+        """
+        options, paths = self._suite(name)
+        has_history = self.history is not None and self.history.durations
+        if self.shard is not None or has_history:
+            nodeids = self._collect(options, paths)
+            if self.shard is not None:
+                nodeids = self.shard_durations.shard(nodeids, *self.shard)
+            if self.history is not None:
+                nodeids = self.history.slowest_first(nodeids)
+            if not nodeids:
+                return None
+            paths = nodeids
+        workers = self.workers
+        if workers is None:
+            workers = xdist_workers(concurrent_suites)
+        return self._pytest_cmd(*extra, *options, *paths, workers=workers)
+
+    def _record(self, durations: Dict[str, float]) -> None:
+        if self.history is not None and durations:
+            self.history.update(durations)
+            self.history.save()
+
     def test(self, name: str):
         if name == "rpc":
             # RPC tests first
-            cmd = self._pytest_cmd("test/rpc")
             startmsg = "Running RPC tests"
             endmsg = "RPC tests passed"
         else:
-            cmd = self._pytest_cmd(
-                "-m",
-                f"profile_{name}",
-                # we already ran integration tests, we just want to make sure
-                # the package we built is functional.
-                "test/integration/029_docs_generate_tests",
-            )
             startmsg = f"Running tests for plugin: {name}"
             endmsg = f"Tests for plugin: {name} passed"
 
+        cmd = self._test_cmd(name)
+        if cmd is None:
+            print(f"No tests for {name} in shard {self.shard}, skipping")
+            return
         print(startmsg)
-        stream_output(cmd, cwd=self.dbt_path)
+        collector = DurationCollector()
+        try:
+            for line in iter_output(cmd, cwd=self.dbt_path, merge_stderr=True):
+                print(line, flush=True)
+                collector(line)
+        finally:
+            self._record(collector.durations)
         print(endmsg)
+
+    def test_matrix(self, names: List[str], max_workers: Optional[int] = None):
+        """Run the suites for all the given names at once, each in its own
+        pytest process, and fail after all of them finished if any failed.
+        """
+        if len(names) == 1:
+            return self.test(names[0])
+        print(f"Running tests for: {', '.join(names)}")
+        if max_workers is None:
+            max_workers = len(names)
+        executor = CommandExecutor(max_workers=max_workers)
+        collector = DurationCollector()
+        for name in names:
+            # the suites share a checkout, so don't let them race on the
+            # pytest cache
+            cmd = self._test_cmd(
+                name, "-p", "no:cacheprovider", concurrent_suites=max_workers
+            )
+            if cmd is None:
+                print(f"No tests for {name} in shard {self.shard}, skipping")
+                continue
+            executor.submit(cmd, cwd=self.dbt_path, name=name, on_line=collector)
+        results = executor.run(check=False)
+        self._record(collector.durations)
+
+        print("Test results:")
+        for result in results:
+            status = "passed" if result.ok else f"FAILED ({result.returncode})"
+            print(f"  {result.name}: {status} in {result.duration:.1f}s")
+        failed = [r.name for r in results if not r.ok]
+        if failed:
+            raise ValueError(f"Tests failed for: {', '.join(failed)}")
+        print(f"Tests for {', '.join(names)} passed")
@@ -1,14 +1,17 @@
 from pathlib import Path
-from .cmd import stream_output
+from .cmd import DOCKER_PUSH, run_with_retry, stream_output
 from .common import EnvironmentInformation, ReleaseFile
+from .trace import traced
 
 
+@traced
 def build_docker(args=None):
     env = EnvironmentInformation()
     release = ReleaseFile.from_artifacts(env)
 
     requirements_path = env.get_dbt_requirements_file(str(release.version))
-    wheel_requirements_path = env.wheel_file
+    env.artifact_store.checkout("dist/")
+    wheel_requirements_path = env.artifact_store.get(env.wheel_file.name)
     dist_dir_path = env.dist_dir
     dockerfile_path = env.dockerfile_path
     if requirements_path == requirements_path.absolute():
@@ -48,7 +51,7 @@ def build_docker(args=None):
 def push_docker(remote_tag: str):
     cmd = ["docker", "push", remote_tag]
 
-    stream_output(cmd)
+    run_with_retry(cmd, DOCKER_PUSH)
 
 
 def add_docker_parsers(subparsers):
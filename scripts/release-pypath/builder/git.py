@@ -1,48 +1,286 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import date
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterator, List, Optional, Tuple
+import hashlib
 import io
+import os
 import re
 import shutil
+import subprocess
+import tempfile
 
-from .cmd import collect_output, stream_output
-from .common import ReleaseFile
+from . import bumpversion
+from .cmd import GIT_NETWORK, collect_output, run_with_retry, stream_output
+from .common import EnvironmentInformation, ReleaseFile
+from .trace import traced
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+
+def github_url(name: str) -> str:
+    """The URL of a GitHub repository such as "fishtown-analytics/dbt.git".
+    Set DBT_RELEASE_GIT_BASE_URL to use somewhere else, e.g. a directory of
+    local bare repositories for testing.
+    """
+    return os.getenv("DBT_RELEASE_GIT_BASE_URL", "git@github.com:") + name
+
+
+@dataclass(frozen=True)
+class CloneProfile:
+    """How much of a repository a stage needs: the last `depth` commits (or
+    all of them), whether blobs are only fetched as they're checked out
+    (`--filter=blob:none`), and which directories to check out (all if
+    `sparse` is empty).
+    """
+
+    depth: Optional[int] = None
+    filter_blobs: bool = False
+    sparse: Tuple[str, ...] = ()
+
+    @property
+    def is_full(self) -> bool:
+        return self == FULL_CLONE
+
+    def clone_args(self) -> List[str]:
+        args = []
+        if self.depth is not None:
+            args.extend(["--depth", str(self.depth)])
+        if self.filter_blobs:
+            args.append("--filter=blob:none")
+        if self.sparse:
+            args.append("--sparse")
+        return args
+
+
+FULL_CLONE = CloneProfile()
+# the version bump edits files all over the tree, but later stages only need
+# the history (for test selection), not old blobs
+RELEASE_COMMIT_CLONE = CloneProfile(filter_blobs=True)
+# merging needs the history back to the merge base
+MERGE_CLONE = CloneProfile(filter_blobs=True)
+# these only add a commit on top of the default branch
+HOMEBREW_CLONE = CloneProfile(depth=1)
+SCHEMAS_CLONE = CloneProfile(depth=1, filter_blobs=True, sparse=("dbt",))
+
+
+class GitMirror:
+    """A bare repository in the cache that has every object of a remote.
+
+    Stages check out their branch as a detached `git worktree` of it, so they
+    share one object store per remote and setting one up only writes the
+    working tree.
+    Clones can also borrow objects from it with --reference/--dissociate, so
+    only objects that are newer than the mirror come over the network. It's a
+    plain repository with remote-tracking branches rather than a `--mirror`
+    clone, so nothing in it can be pushed by accident.
+    """
+
+    def __init__(self, root: Path, url: str) -> None:
+        self.url = url
+        name = url.rstrip("/").rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+        name = re.sub(r"\.git$", "", name)
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+        self.path = root / f"{name}-{digest}.git"
+
+    def exists(self) -> bool:
+        return (self.path / "HEAD").exists()
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """Keep other builds on this host out of the mirror while updating."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_suffix(".lock"), "w") as fp:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            yield
+
+    def _init(self) -> None:
+        tmp = Path(tempfile.mkdtemp(dir=self.path.parent, prefix=".init."))
+        try:
+            stream_output(["git", "init", "--quiet", "--bare", str(tmp)])
+            stream_output(["git", "remote", "add", "origin", self.url], cwd=tmp)
+            os.rename(tmp, self.path)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp)
+
+    def update(self) -> None:
+        """Fetch whatever is new on the remote, creating the mirror first if
+        needed.
+        """
+        with self.lock():
+            if not self.exists():
+                print(f"Creating a mirror of {self.url} in {self.path}")
+                self._init()
+            cmd = ["git", "fetch", "--quiet", "--prune", "--tags", "origin"]
+            run_with_retry(cmd, GIT_NETWORK, cwd=self.path)
+            cmd = ["git", "remote", "set-head", "origin", "--auto"]
+            run_with_retry(cmd, GIT_NETWORK, cwd=self.path)
+
+    def default_branch(self) -> str:
+        cmd = ["git", "symbolic-ref", "--short", "refs/remotes/origin/HEAD"]
+        ref = collect_output(cmd, cwd=self.path).strip()
+        return ref[len("origin/") :]
+
+    def _remove_worktree(self, path: Path) -> None:
+        if path.exists():
+            cmd = ["git", "worktree", "remove", "--force", str(path)]
+            collect_output(cmd, cwd=self.path, check=False)
+        if path.exists():
+            shutil.rmtree(path)
+        # forget worktrees whose directories are gone, like old build/ dirs
+        stream_output(["git", "worktree", "prune"], cwd=self.path)
+
+    def _enable_worktree_config(self) -> None:
+        # keep settings like sparse-checkout out of the config that every
+        # worktree shares. core.bare has to move too or the worktrees would
+        # think they're bare, which is what `git sparse-checkout` does itself
+        # in newer versions of git.
+        cmd = ["git", "config", "--get", "extensions.worktreeConfig"]
+        if collect_output(cmd, cwd=self.path, check=False).strip() == "true":
+            return
+        cmd = ["git", "config", "extensions.worktreeConfig", "true"]
+        stream_output(cmd, cwd=self.path)
+        cmd = ["git", "config", "--worktree", "core.bare", "true"]
+        stream_output(cmd, cwd=self.path)
+        stream_output(["git", "config", "--unset", "core.bare"], cwd=self.path)
+
+    def add_worktree(self, path: Path, branch: Optional[str] = None) -> str:
+        """Check out the remote's branch (by default its default branch) at
+        path on a detached HEAD, replacing whatever is there, and return the
+        branch name. No local branch is created, since it would be shared with
+        every other worktree of the mirror.
+        """
+        with self.lock():
+            self._enable_worktree_config()
+            self._remove_worktree(path.absolute())
+            if branch is None:
+                branch = self.default_branch()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            cmd = ["git", "worktree", "add", "--quiet", "--detach"]
+            cmd.extend([str(path.absolute()), f"origin/{branch}"])
+            collect_output(cmd, cwd=self.path)
+            return branch
 
 
 class Repository:
-    def __init__(self, path: Path, repository_url: str):
+    default_profile = FULL_CLONE
+
+    def __init__(
+        self,
+        path: Path,
+        repository_url: str,
+        use_mirror: bool = True,
+        use_worktrees: bool = True,
+    ):
         self.path = path
         self.repository_url = repository_url
+        self.profile = self.default_profile
+        self.use_worktrees = use_worktrees
+        self.is_worktree = False
+        # the branch that push_updates() pushes HEAD to by default
+        self.branch: Optional[str] = None
+        self.mirror: Optional[GitMirror] = None
+        if use_mirror:
+            root = EnvironmentInformation().git_mirror_dir
+            self.mirror = GitMirror(root, repository_url)
 
-    def clone(self, branch: Optional[str] = None):
-        """Clone the given branch into path. Initialize the dbt user so commits
-        work.
+    def clone_command(
+        self, branch: Optional[str] = None, profile: Optional[CloneProfile] = None
+    ) -> List[str]:
+        """Prepare path for a clone of the given branch and return the command
+        that performs it, so callers can run it alongside other work. Run
+        finish_clone() once it's done. The command borrows objects from the
+        mirror as it is; clone() updates it first.
         """
+        if profile is not None:
+            self.profile = profile
+        self.is_worktree = False
         if self.path.exists():
             shutil.rmtree(self.path)
         self.path.parent.mkdir(parents=True, exist_ok=True)
         cmd = ["git", "clone"]
+        if self.mirror is not None and self.mirror.exists():
+            cmd.extend(["--reference-if-able", str(self.mirror.path), "--dissociate"])
+        cmd.extend(self.profile.clone_args())
         if branch is not None:
             cmd.extend(["--branch", branch])
         cmd.extend([self.repository_url, str(self.path)])
-        stream_output(cmd)
+        return cmd
+
+    def finish_clone(self) -> None:
+        """Check out the directories of a sparse clone or worktree."""
+        if self.profile.sparse:
+            cmd = ["git", "sparse-checkout", "set", "--cone"]
+            cmd.extend(self.profile.sparse)
+            run_with_retry(cmd, GIT_NETWORK, cwd=self.path)
+        if not self.is_worktree:
+            cmd = ["git", "symbolic-ref", "--short", "HEAD"]
+            self.branch = collect_output(cmd, cwd=self.path).strip()
+
+    def clone(
+        self, branch: Optional[str] = None, profile: Optional[CloneProfile] = None
+    ):
+        """Check out the given branch at path, as a worktree of the mirror if
+        possible, or else as a clone that fetches only what profile (by
+        default the repository's) needs. Either way only the profile's sparse
+        directories are checked out.
+
+        A partial clone only updates the mirror if there already is one,
+        since creating it means fetching everything. After that, its depth
+        and blob filter don't matter: the worktree doesn't fetch anything.
+        """
+        if profile is not None:
+            self.profile = profile
+        mirror = self.mirror
+        if mirror is not None and (self.profile.is_full or mirror.exists()):
+            mirror.update()
+            if self.use_worktrees:
+                try:
+                    self.branch = mirror.add_worktree(self.path, branch)
+                except subprocess.CalledProcessError:
+                    print(f"Could not add a worktree at {self.path}, cloning")
+                else:
+                    self.is_worktree = True
+                    self.finish_clone()
+                    return
+        run_with_retry(self.clone_command(branch), GIT_NETWORK)
+        self.finish_clone()
 
     def checkout_branch(self, branch: str, *, new: bool = False):
-        cmd = ["git", "checkout"]
-        if new:
-            cmd.append("-b")
-        cmd.append(branch)
-        stream_output(cmd, cwd=self.path)
+        """Switch to branch, or start it at HEAD if new. A worktree stays on a
+        detached HEAD, since its branches live in the mirror where other
+        builds on this host could move them; push_updates() pushes HEAD to
+        the branch by name either way.
+        """
+        if self.is_worktree:
+            if not new:
+                cmd = ["git", "checkout", "--quiet", "--detach", f"origin/{branch}"]
+                stream_output(cmd, cwd=self.path)
+        else:
+            cmd = ["git", "checkout"]
+            if new:
+                cmd.append("-b")
+            cmd.append(branch)
+            stream_output(cmd, cwd=self.path)
+        self.branch = branch
 
     def _rev_parse(self, commitish: str) -> str:
         cmd = ["git", "rev-parse", commitish]
         return collect_output(cmd, cwd=self.path).strip()
 
     def push_updates(self, *, origin_name: Optional[str] = None):
-        cmd = ["git", "push"]
-        if origin_name:
-            cmd.extend(["origin", origin_name])
-        stream_output(cmd, cwd=self.path)
+        """Push HEAD to origin_name, by default the branch that's checked out."""
+        branch = origin_name or self.branch
+        if branch is None:
+            raise ValueError(f"No branch to push from {self.path}")
+        cmd = ["git", "push", "origin", f"HEAD:refs/heads/{branch}"]
+        run_with_retry(cmd, GIT_NETWORK, cwd=self.path)
 
     def merge(self, merge_from: str):
         # if something has merged during our build, we should fail.
@@ -52,12 +290,13 @@ class Repository:
 
 class DbtRepository(Repository):
     def __init__(self, path: Path):
-        url = "git@github.com:fishtown-analytics/dbt.git"
+        url = github_url("fishtown-analytics/dbt.git")
         super().__init__(path=path, repository_url=url)
 
     def ensure_matching_commits(self, release: ReleaseFile):
         commit_result = self._rev_parse(release.commit)
-        branch_result = self._rev_parse(release.branch)
+        # worktrees don't have a local branch
+        branch_result = self._rev_parse(f"origin/{release.branch}")
         if commit_result != branch_result:
             raise ValueError(
                 f"Commit {release.commit} points to sha {commit_result}, "
@@ -68,29 +307,11 @@ class DbtRepository(Repository):
                 f"Sha {commit_result} does not start with {release.commit}"
             )
 
-    def set_version(self, release: ReleaseFile, env_path: Path) -> None:
-        bin_path = env_path / "bin/bumpversion"
-        # if we always set the version to major, this appears to always work...
-        cmd = [
-            bin_path.absolute(),
-            "--commit",
-            "--no-tag",
-            "--new-version",
-            str(release.version),
-            "major",
-        ]
+    def set_version(self, release: ReleaseFile) -> List[Path]:
         print(f"bumping version to {release.version}")
-        print(f"running cmd: {cmd}")
-        stream_output(cmd, cwd=self.path)
+        paths = bumpversion.set_version(self.path, str(release.version))
         print(f"bumped version to {release.version}")
-
-    def add_requirements_txt(self, requirements_path: Path) -> None:
-        print(f"Adding requirements file at {requirements_path}")
-        cmd = ["git", "add", str(requirements_path)]
-        stream_output(cmd, cwd=self.path)
-        cmd = ["git", "commit", "-m", "Add requirements file"]
-        stream_output(cmd, cwd=self.path)
-        print("Added requirements file")
+        return paths
 
     def get_commit_hash(self) -> str:
         # get the commit hash out
@@ -98,7 +319,7 @@ class DbtRepository(Repository):
         new_commit_hash = collect_output(cmd, cwd=self.path).strip()
         return new_commit_hash
 
-    def update_changelog(self, release: ReleaseFile):
+    def update_changelog(self, release: ReleaseFile) -> Path:
         path = self.path / "CHANGELOG.md"
 
         nextver = re.compile(r"^## dbt [0-9]+\.[0-9]+\.[0-9]+ \((Release TBD)\)")
@@ -126,44 +347,70 @@ class DbtRepository(Repository):
 
         with open(path, "w") as fp:
             fp.write(newdata.getvalue())
+        print("Updated the changelog")
+        return path
 
-        print("Adding changelog update")
-        cmd = ["git", "add", "CHANGELOG.md"]
-        stream_output(cmd, cwd=self.path)
-
-        print("Committing changelog update")
-        cmd = ["git", "commit", "-m", "update CHANGELOG.md"]
-        stream_output(cmd, cwd=self.path)
-        print("Committed changelog update")
+    def commit_files(self, paths: List[Path], message: str) -> None:
+        """Commit the working tree contents of paths on top of HEAD, using git
+        plumbing instead of `git add` and `git commit`. The index is updated
+        too, so the checkout is clean afterwards.
+        """
+        root = self.path.absolute()
+        names = sorted({str(p.absolute().relative_to(root)) for p in paths})
+        cmd = ["git", "hash-object", "-w", "--stdin-paths"]
+        blobs = collect_output(cmd, cwd=self.path, input="\n".join(names) + "\n")
+        # keep the modes git has for tracked files, whatever is on disk
+        modes: Dict[str, str] = {}
+        cmd = ["git", "ls-files", "--stage", "-z", "--"] + names
+        for entry in collect_output(cmd, cwd=self.path).split("\0"):
+            if entry:
+                info, name = entry.split("\t", 1)
+                modes[name] = info.split()[0]
+        index_info = ""
+        for name, blob in zip(names, blobs.split()):
+            mode = modes.get(name)
+            if mode is None:
+                mode = "100755" if os.access(root / name, os.X_OK) else "100644"
+            index_info += f"{mode} {blob}\t{name}\n"
+        cmd = ["git", "update-index", "--add", "--index-info"]
+        collect_output(cmd, cwd=self.path, input=index_info)
 
-    def merge_commits_with_version(self, release: ReleaseFile):
-        cmd = ["git", "reset", "--soft", "HEAD~3"]
-        stream_output(cmd, cwd=self.path)
-        cmd = ["git", "commit", "-m", f"Release dbt v{release.version}"]
-        stream_output(cmd, cwd=self.path)
+        tree = collect_output(["git", "write-tree"], cwd=self.path).strip()
+        parent = self._rev_parse("HEAD")
+        cmd = ["git", "commit-tree", tree, "-p", parent, "-m", message]
+        commit = collect_output(cmd, cwd=self.path).strip()
+        # fails if HEAD moved in the meantime
+        cmd = ["git", "update-ref", "-m", f"commit: {message}", "HEAD", commit, parent]
+        collect_output(cmd, cwd=self.path)
 
+    @traced
     def perform_version_update(
-        self, release: ReleaseFile, requirements_path: Path, packaging_venv: Path
+        self, release: ReleaseFile, requirements_path: Path
     ) -> str:
         """Perform the git-tracked tasks involved in a version update and
         return the new commit hash.
         """
         # make sure things are reasonable
         self.ensure_matching_commits(release)
-        self.set_version(release, packaging_venv)
-        self.update_changelog(release)
-        self.add_requirements_txt(requirements_path)
-        self.merge_commits_with_version(release)
+        paths = self.set_version(release)
+        paths.append(self.update_changelog(release))
+        print(f"Adding requirements file at {requirements_path}")
+        paths.append(requirements_path)
+        self.commit_files(paths, f"Release dbt v{release.version}")
         return self.get_commit_hash()
 
 
 class HomebrewRepository(Repository):
+    default_profile = HOMEBREW_CLONE
+
     def __init__(self, path: Path):
-        url = "git@github.com:fishtown-analytics/homebrew-dbt.git"
+        url = github_url("fishtown-analytics/homebrew-dbt.git")
         super().__init__(path=path, repository_url=url)
 
 
 class ArtifactSchemaRepository(Repository):
+    default_profile = SCHEMAS_CLONE
+
     def __init__(self, path: Path):
-        url = "git@github.com:fishtown-analytics/schemas.getdbt.com.git"
+        url = github_url("fishtown-analytics/schemas.getdbt.com.git")
         super().__init__(path=path, repository_url=url)
@@ -4,6 +4,7 @@ from typing import Union, Dict
 from urllib.request import urlopen, Request
 
 from .common import ReleaseFile, EnvironmentInformation
+from .trace import traced
 
 
 def make_post(release: ReleaseFile):
@@ -33,6 +34,7 @@ def make_post(release: ReleaseFile):
     print(f"Github response:\n{resp_data}")
 
 
+@traced
 def make_github_release(args=None):
     env = EnvironmentInformation()
     release = ReleaseFile.from_artifacts(env)
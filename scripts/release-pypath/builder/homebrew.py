@@ -1,11 +1,11 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import List, Iterator, Tuple
+from typing import Callable, Deque, List, Iterator, Tuple, TypeVar
 from urllib.error import HTTPError
-from urllib.request import urlopen
 import abc
 import hashlib
-import json
 import os
 import pickle
 import tarfile
@@ -13,7 +13,7 @@ import textwrap
 import time
 
 
-from .cmd import collect_output, stream_output
+from .cmd import PIP_NETWORK, iter_output, run_with_retry, stream_output
 from .common import (
     PackageType,
     Version,
@@ -22,6 +22,7 @@ from .common import (
     PytestRunner,
 )
 from .git import HomebrewRepository
+from .trace import traced
 from .virtualenvs import DBTPackageEnv
 
 
@@ -174,21 +175,59 @@ class HomebrewTemplate:
         )
 
     def store_artifacts(self, env: EnvironmentInformation) -> None:
-        with open(env.homebrew_template_pickle, "wb") as fp:
+        with env.artifact_store.write(env.homebrew_template_pickle, "wb") as fp:
             pickle.dump(self, fp)
 
     @classmethod
     def from_artifacts(cls, env: EnvironmentInformation) -> "HomebrewTemplate":
-        with open(env.homebrew_template_pickle, "rb") as fp:
+        path = env.artifact_store.get(env.homebrew_template_pickle.name)
+        with open(path, "rb") as fp:
             template = pickle.load(fp)
         return template
 
 
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def map_concurrently(
+    func: Callable[[T], R],
+    items: List[T],
+    max_workers: int,
+    describe: Callable[[T], str] = str,
+) -> List[R]:
+    """Call func on every item with a bounded pool of threads and return the
+    results in the order of items. Every call runs to completion, and all
+    failures are reported together.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(func, item) for item in items]
+    failed = []
+    for item, future in zip(items, futures):
+        exc = future.exception()
+        if exc is not None:
+            print(f"Lookup for {describe(item)} failed: {exc}")
+            failed.append((item, exc))
+    if failed:
+        raise ValueError(
+            f"{len(failed)} of {len(items)} lookups failed: "
+            + ", ".join(describe(item) for item, _ in failed)
+        ) from failed[0][1]
+    return [f.result() for f in futures]
+
+
+def _describe_pin(pin: Tuple[str, str]) -> str:
+    return "==".join(pin)
+
+
 # we have two builders: The local builder files with `file://` URLs pointing to
 # the dists, and updates the hash. The Pypi builder updates that
 
 
 class BaseHomebrewBuilder(metaclass=abc.ABCMeta):
+    # PyPI lookups to run at once
+    max_workers = 8
+
     def __init__(self, version: Version, env_path: Path, homebrew_path: Path):
         self.version = version
         self.env_path = env_path
@@ -202,17 +241,16 @@ class BaseHomebrewBuilder(metaclass=abc.ABCMeta):
     def default_formula_path(self) -> Path:
         return self.homebrew_path / "Formula/dbt.rb"
 
-    def get_pypi_info(self, pkg: str, version: str) -> Tuple[str, str]:
-        url = f"https://pypi.org/pypi/{pkg}/{version}/json"
+    def get_pypi_info(
+        self, pkg: str, version: str, refresh: bool = False
+    ) -> Tuple[str, str]:
+        metadata = EnvironmentInformation().pypi_metadata()
         try:
-            fp = urlopen(url)
+            data = metadata.get(pkg, version, refresh=refresh)
         except Exception as exc:
+            url = metadata.url_for(pkg, version)
             print(f"Could not get pypi info for url {url}: {exc}")
             raise
-        try:
-            data = json.load(fp)
-        finally:
-            fp.close()
         assert "urls" in data
         for pkginfo in data["urls"]:
             assert "packagetype" in pkginfo
@@ -223,6 +261,9 @@ class BaseHomebrewBuilder(metaclass=abc.ABCMeta):
                 url = pkginfo["url"]
                 sha256 = pkginfo["digests"]["sha256"]
                 return url, sha256
+        if not refresh:
+            # the sdist may have been uploaded after we cached this release
+            return self.get_pypi_info(pkg, version, refresh=True)
         raise ValueError(f"Never got a valid sdist for {pkg}=={version}")
 
     def wait_for_pypi_info(self, pkg: str, version: str) -> Tuple[str, str]:
@@ -237,17 +278,23 @@ class BaseHomebrewBuilder(metaclass=abc.ABCMeta):
                 return self.get_pypi_info(pkg=pkg, version=version)
             except HTTPError as exc:
                 if exc.code == 404 and attempts:
-                    print(f"retrying failed query, {attempts} attempts remaining")
+                    print(
+                        f"retrying failed query for {pkg}, "
+                        f"{attempts} attempts remaining"
+                    )
                     time.sleep(sleeptime)
                     continue
                 else:
                     raise
 
+    def _pypi_dependency(self, name: str, version: str) -> HomebrewDependency:
+        url, sha256 = self.get_pypi_info(name, version)
+        return HomebrewDependency(name=name, url=url, sha256=sha256, version=version)
+
     def get_pip_versions(self, env_path: Path) -> Iterator[Tuple[str, str]]:
         pip = env_path / "bin/pip"
         cmd = [pip, "freeze", "-l"]
-        raw = collect_output(cmd).split("\n")
-        for line in raw:
+        for line in iter_output(cmd):
             if not line:
                 continue
             parts = line.split("==")
@@ -271,7 +318,7 @@ class BaseHomebrewBuilder(metaclass=abc.ABCMeta):
         path = os.path.normpath(formula_path)
         stream_output(["brew", "uninstall", "--force", "--formula", path])
         versions = []
-        for line in collect_output(["brew", "list", "--formula"]).split("\n"):
+        for line in iter_output(["brew", "list", "--formula"]):
             line = line.strip()
             if line.startswith("dbt@") or line == "dbt":
                 versions.append(line)
@@ -285,10 +332,12 @@ class BaseHomebrewBuilder(metaclass=abc.ABCMeta):
     def _get_env_python_path(self) -> Path:
         magic = "python path: "
         # this is expected to return non-zero (no profile or project yml)
-        output = collect_output(["dbt", "debug"], check=False)
-        for line in output.split("\n"):
+        seen: Deque[str] = deque(maxlen=100)
+        for line in iter_output(["dbt", "debug"], check=False):
             if line.startswith(magic):
                 return Path(line[len(magic) :])
+            seen.append(line)
+        output = "\n".join(seen)
         raise ValueError(f'Never found "{magic}" in output:\n{output}')
 
     @abc.abstractmethod
@@ -334,6 +383,7 @@ class HomebrewLocalBuilder(BaseHomebrewBuilder):
         env = DBTPackageEnv(package_dir=self.package_dir, ext=PackageType.Sdist)
         env.create(path)
 
+    @traced
     def get_template(self) -> HomebrewTemplate:
         self.make_venv(self.env_path)
         print("done setting up virtualenv")
@@ -349,27 +399,35 @@ class HomebrewLocalBuilder(BaseHomebrewBuilder):
     def get_packages(self) -> Iterator[HomebrewDependency]:
         dbt_tgzs = {_tgz_to_name(w): w for w in self.package_dir.glob("*.tar.gz")}
 
-        for name, version in self.get_pip_versions(self.env_path):
-            if name in dbt_tgzs:
-                path = dbt_tgzs[name].absolute()
-                url = f"file://{path}"
-                sha256 = self._sha256_at_path(path)
-            else:
-                url, sha256 = self.get_pypi_info(name, version)
-            dep = HomebrewDependency(name=name, url=url, sha256=sha256, version=version)
-            yield dep
+        def get_dependency(pin: Tuple[str, str]) -> HomebrewDependency:
+            name, version = pin
+            if name not in dbt_tgzs:
+                return self._pypi_dependency(name, version)
+            path = dbt_tgzs[name].absolute()
+            return HomebrewDependency(
+                name=name,
+                url=f"file://{path}",
+                sha256=self._sha256_at_path(path),
+                version=version,
+            )
 
+        pins = list(self.get_pip_versions(self.env_path))
+        yield from map_concurrently(
+            get_dependency, pins, self.max_workers, _describe_pin
+        )
+
+    @traced
     def run_tests(self, formula_path: Path, audit: bool = True):
         self.uninstall_reinstall_basics(formula_path=formula_path, audit=audit)
         python_bin = self._get_env_python_path()
         dev_requirements = self.dbt_path / "dev-requirements.txt"
-        stream_output([python_bin, "-m", "pip", "install", "-r", dev_requirements])
+        cmd = [python_bin, "-m", "pip", "install", "-r", dev_requirements]
+        run_with_retry(cmd, PIP_NETWORK)
         env_path = python_bin.parent.parent
         runner = PytestRunner(env_path, self.dbt_path)
         # no postgres - it's too much work to set it up locally on macs and
         # this is just a very basic smoke test
-        for name in ["bigquery", "redshift", "snowflake"]:
-            runner.test(name)
+        runner.test_matrix(["bigquery", "redshift", "snowflake"])
 
     def test(self, template):
         self.create_versioned_formula_file(template)
@@ -378,6 +436,7 @@ class HomebrewLocalBuilder(BaseHomebrewBuilder):
     @classmethod
     def from_env_info(cls, env: EnvironmentInformation) -> "HomebrewLocalBuilder":
         release = ReleaseFile.from_artifacts(env)
+        env.artifact_store.checkout("dist/")
         return cls(
             version=release.version,
             env_path=env.homebrew_test_venv,
@@ -403,10 +462,13 @@ class HomebrewPypiBuilder(BaseHomebrewBuilder):
         self.set_default = set_default
 
     def get_packages(self) -> Iterator[HomebrewDependency]:
-        for name, version in self.get_pip_versions(self.env_path):
-            url, sha256 = self.get_pypi_info(name, version)
-            dep = HomebrewDependency(name=name, url=url, sha256=sha256, version=version)
-            yield dep
+        pins = list(self.get_pip_versions(self.env_path))
+        yield from map_concurrently(
+            lambda pin: self._pypi_dependency(*pin),
+            pins,
+            self.max_workers,
+            _describe_pin,
+        )
 
     @classmethod
     def from_env_info(cls, env: EnvironmentInformation) -> "HomebrewPypiBuilder":
@@ -441,20 +503,24 @@ class HomebrewPypiBuilder(BaseHomebrewBuilder):
             # this should maybe be an error!
             print(
                 "WARNING: Unexpected sha256.\n"
-                "{dep.url} had sha256sum of {dep.sha256}, but\n"
-                "{url} has sha256sum of {sha256}"
+                f"{dep.url} had sha256sum of {dep.sha256}, but\n"
+                f"{url} has sha256sum of {sha256}"
             )
         return replace(dep, url=url, sha256=sha256)
 
     def add_dbt_template(self, template: HomebrewTemplate) -> HomebrewTemplate:
-        dbt_package = self._replaced_dep(template.dbt_package)
-        dbt_dependencies = [
-            self._replaced_dep(dep) for dep in template.dbt_dependencies
-        ]
+        deps = [template.dbt_package] + list(template.dbt_dependencies)
+        dbt_package, *dbt_dependencies = map_concurrently(
+            self._replaced_dep,
+            deps,
+            self.max_workers,
+            lambda dep: f"{dep.name}=={dep.version}",
+        )
         return replace(
             template, dbt_package=dbt_package, dbt_dependencies=dbt_dependencies
         )
 
+    @traced
     def build_and_test(self, template: HomebrewTemplate):
         template = self.add_dbt_template(template)
         self.create_versioned_formula_file(template)
@@ -471,6 +537,7 @@ class HomebrewPypiBuilder(BaseHomebrewBuilder):
             self.commit_default_formula()
 
 
+@traced
 def homebrew_test(args=None):
     """Given the produced wheels, build a test homebrew formula and install it
     locally, running some tests.
@@ -485,6 +552,7 @@ def homebrew_test(args=None):
     builder.test(template)
 
 
+@traced
 def homebrew_upload(args=None):
     env = EnvironmentInformation()
     repository = HomebrewRepository(env.homebrew_checkout_path)
@@ -0,0 +1,226 @@
+"""Decide which smoke test suites a release needs, based on what changed in
+dbt since a base ref (usually the previous release's commit).
+"""
+from configparser import ConfigParser
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Dict, Iterable, List, Optional, Set, Tuple
+import fnmatch
+import json
+import subprocess
+
+from .cmd import collect_output, iter_output
+
+ALL_SUITES = ("rpc", "postgres", "redshift", "bigquery", "snowflake")
+PLUGIN_SUITES = ("postgres", "redshift", "bigquery", "snowflake")
+
+# Path prefix -> the suites that have to run when something under it changes.
+# The rpc tests and the redshift adapter are both built on postgres.
+SUITE_IMPACT: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("core/", ALL_SUITES),
+    ("plugins/postgres/", ("postgres", "redshift", "rpc")),
+    ("plugins/redshift/", ("redshift",)),
+    ("plugins/bigquery/", ("bigquery",)),
+    ("plugins/snowflake/", ("snowflake",)),
+    ("test/rpc/", ("rpc",)),
+    ("test/integration/029_docs_generate_tests/", PLUGIN_SUITES),
+)
+
+# Changes that can't affect the smoke tests. Anything that is neither here nor
+# in SUITE_IMPACT runs every suite, to be safe. That includes the rest of
+# test/integration/, like the shared base.py.
+IGNORED_PATTERNS = (
+    "*.md",
+    "docker/*",
+    "test/unit/*",
+    ".github/*",
+    ".circleci/*",
+    "scripts/*",
+)
+
+
+@dataclass
+class SuiteDecision:
+    name: str
+    run: bool
+    reasons: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ImpactReport:
+    base_ref: Optional[str]
+    head: Optional[str]
+    changed_files: List[str]
+    ignored_files: List[str]
+    decisions: List[SuiteDecision]
+
+    @property
+    def selected(self) -> List[str]:
+        return [d.name for d in self.decisions if d.run]
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "base_ref": self.base_ref,
+            "head": self.head,
+            "changed_files": self.changed_files,
+            "ignored_files": self.ignored_files,
+            "suites": {
+                d.name: {"run": d.run, "reasons": d.reasons} for d in self.decisions
+            },
+        }
+
+    def write(self, fp: IO[str]) -> None:
+        json.dump(self.to_dict(), fp, indent=2)
+
+    def summary(self) -> str:
+        lines = [f"Test impact since {self.base_ref} ({self.head}):"]
+        for decision in self.decisions:
+            status = "run" if decision.run else "skip"
+            reason = "; ".join(decision.reasons[:3])
+            if len(decision.reasons) > 3:
+                reason += f"; and {len(decision.reasons) - 3} more"
+            lines.append(f"  {decision.name}: {status} ({reason})")
+        return "\n".join(lines)
+
+
+def _read_config(text: str) -> ConfigParser:
+    config = ConfigParser(interpolation=None)
+    config.read_string(text)
+    return config
+
+
+def _current_version(config: ConfigParser) -> Optional[str]:
+    return config.get("bumpversion", "current_version", fallback=None)
+
+
+def _changed_lines(diff: Iterable[str]) -> Dict[str, Tuple[List[str], List[str]]]:
+    """Map each file in a `git diff -U0` to its removed and added lines."""
+    changes: Dict[str, Tuple[List[str], List[str]]] = {}
+    lines: Optional[Tuple[List[str], List[str]]] = None
+    in_header = False
+    old_path = ""
+    for line in diff:
+        if line.startswith("diff --git "):
+            in_header = True
+        elif in_header and line.startswith("--- "):
+            old_path = line[len("--- a/") :]
+        elif in_header and line.startswith("+++ "):
+            path = old_path if line == "+++ /dev/null" else line[len("+++ b/") :]
+            lines = changes.setdefault(path, ([], []))
+        elif line.startswith("@@"):
+            in_header = False
+        elif in_header or lines is None:
+            continue
+        elif line.startswith("-"):
+            lines[0].append(line[1:])
+        elif line.startswith("+"):
+            lines[1].append(line[1:])
+    return changes
+
+
+def version_bumps(dbt_path: Path, base_ref: str, changed: Iterable[str]) -> Set[str]:
+    """The changed files from .bumpversion.cfg (and the config itself) whose
+    only change is replacing the version at base_ref with the current one. A
+    change to these is just the previous version bump. Any other edit, like a
+    new dependency pin in a setup.py, counts as a real change.
+    """
+    config_path = dbt_path / ".bumpversion.cfg"
+    if not config_path.exists():
+        return set()
+    config = _read_config(config_path.read_text())
+    cmd = ["git", "show", f"{base_ref}:.bumpversion.cfg"]
+    try:
+        base_config = _read_config(collect_output(cmd, cwd=dbt_path))
+    except subprocess.CalledProcessError:
+        return set()
+    old_version = _current_version(base_config)
+    new_version = _current_version(config)
+    if old_version is None or new_version is None:
+        return set()
+
+    prefix = "bumpversion:file:"
+    candidates = {s[len(prefix) :] for s in config.sections() if s.startswith(prefix)}
+    candidates.add(".bumpversion.cfg")
+    candidates.intersection_update(changed)
+    if not candidates:
+        return set()
+    cmd = ["git", "diff", "-U0", f"{base_ref}...HEAD", "--"] + sorted(candidates)
+    changes = _changed_lines(iter_output(cmd, cwd=dbt_path))
+    bumps = set()
+    for path, (removed, added) in changes.items():
+        before = sorted(line.replace(old_version, "{version}") for line in removed)
+        after = sorted(line.replace(new_version, "{version}") for line in added)
+        if before == after:
+            bumps.add(path)
+    return bumps
+
+
+def _is_ignored(path: str, bumps: Set[str]) -> bool:
+    if path in bumps or path.startswith("docker/requirements/"):
+        return True
+    if any(path.startswith(prefix) for prefix, _ in SUITE_IMPACT):
+        return False
+    return any(fnmatch.fnmatch(path, pattern) for pattern in IGNORED_PATTERNS)
+
+
+def decide(
+    changed_files: Iterable[str], suites: Iterable[str], bumps: Set[str]
+) -> Tuple[List[SuiteDecision], List[str]]:
+    decisions = {name: SuiteDecision(name=name, run=False) for name in suites}
+    ignored = []
+    for path in changed_files:
+        if _is_ignored(path, bumps):
+            ignored.append(path)
+            continue
+        impacted: Tuple[str, ...] = ALL_SUITES
+        for prefix, names in SUITE_IMPACT:
+            if path.startswith(prefix):
+                impacted = names
+                break
+        for name in impacted:
+            if name in decisions:
+                decisions[name].run = True
+                decisions[name].reasons.append(f"{path} changed")
+    for decision in decisions.values():
+        if not decision.run:
+            decision.reasons.append("no relevant changes")
+    return list(decisions.values()), ignored
+
+
+def run_all(
+    suites: Iterable[str], reason: str, base_ref: Optional[str]
+) -> ImpactReport:
+    decisions = [SuiteDecision(name=n, run=True, reasons=[reason]) for n in suites]
+    return ImpactReport(
+        base_ref=base_ref,
+        head=None,
+        changed_files=[],
+        ignored_files=[],
+        decisions=decisions,
+    )
+
+
+def compute_impact(dbt_path: Path, base_ref: str, suites: List[str]) -> ImpactReport:
+    """Work out which of suites have to run for the changes in dbt_path since
+    base_ref. If the base ref isn't available (e.g. in a shallow clone),
+    everything runs.
+    """
+    try:
+        head = collect_output(["git", "rev-parse", "HEAD"], cwd=dbt_path).strip()
+        collect_output(
+            ["git", "rev-parse", "--verify", f"{base_ref}^{{commit}}"], cwd=dbt_path
+        )
+    except subprocess.CalledProcessError:
+        return run_all(suites, f"base ref {base_ref} is not available", base_ref)
+
+    cmd = ["git", "diff", "--name-only", f"{base_ref}...HEAD"]
+    changed = [line for line in iter_output(cmd, cwd=dbt_path) if line]
+    bumps = version_bumps(dbt_path, base_ref, changed)
+    decisions, ignored = decide(changed, suites, bumps)
+    return ImpactReport(
+        base_ref=base_ref,
+        head=head,
+        changed_files=changed,
+        ignored_files=ignored,
+        decisions=decisions,
+    )
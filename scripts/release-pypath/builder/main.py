@@ -7,6 +7,8 @@ from .native import add_native_parsers
 from .docker import add_docker_parsers
 from .github import add_github_parsers
 from .artifact_schemas import add_artifact_schema_parsers
+from .common import EnvironmentInformation
+from .trace import TRACER
 
 
 if sys.version_info < (3, 8):
@@ -31,4 +33,8 @@ def main():
     if not hasattr(parsed, "func"):
         print("No arguments passed!")
         sys.exit(2)
-    parsed.func(parsed)
+    env = EnvironmentInformation()
+    try:
+        parsed.func(parsed)
+    finally:
+        TRACER.write(env.trace_path(parsed.func.__name__))
@@ -0,0 +1,149 @@
+"""Read the dependencies of built packages from their own metadata, without
+installing them, and work out what order to install them in.
+
+Wheels have `Requires-Dist` in `<name>.dist-info/METADATA`. Sdists built with
+older setuptools only list them in `<name>.egg-info/requires.txt`, so that is
+used when `PKG-INFO` doesn't have any.
+"""
+from dataclasses import dataclass
+from email.parser import HeaderParser
+from pathlib import Path
+from typing import Dict, Iterable, List
+import re
+import tarfile
+import zipfile
+
+_NAME = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+
+def normalize_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+@dataclass
+class PackageMetadata:
+    path: Path
+    name: str
+    requires: List[str]
+
+
+def _requirement_name(requirement: str) -> str:
+    match = _NAME.match(requirement)
+    if match is None:
+        raise ValueError(f"Invalid requirement: {requirement}")
+    return normalize_name(match.group(1))
+
+
+def _without_extras(requirements: Iterable[str]) -> List[str]:
+    """Drop the requirements that only apply to an extra."""
+    return [r for r in requirements if not re.search(r";.*\bextra\b", r)]
+
+
+def _read_wheel(path: Path) -> str:
+    with zipfile.ZipFile(path) as zf:
+        for name in zf.namelist():
+            parts = name.split("/")
+            if (
+                len(parts) == 2
+                and parts[0].endswith(".dist-info")
+                and parts[1] == "METADATA"
+            ):
+                return zf.read(name).decode("utf-8")
+    raise ValueError(f"No METADATA found in {path}")
+
+
+def _read_sdist(path: Path) -> Dict[str, str]:
+    """Return the PKG-INFO and requires.txt of an sdist (the latter may be
+    missing).
+    """
+    found: Dict[str, str] = {}
+    with tarfile.open(path, "r:gz") as tf:
+        for member in tf.getmembers():
+            parts = member.name.split("/")
+            if len(parts) == 2 and parts[1] == "PKG-INFO":
+                key = "PKG-INFO"
+            elif (
+                len(parts) == 3
+                and parts[1].endswith(".egg-info")
+                and parts[2] == "requires.txt"
+            ):
+                key = "requires.txt"
+            else:
+                continue
+            fp = tf.extractfile(member)
+            if fp is not None:
+                found[key] = fp.read().decode("utf-8")
+    if "PKG-INFO" not in found:
+        raise ValueError(f"No PKG-INFO found in {path}")
+    return found
+
+
+def _parse_requires_txt(text: str) -> List[str]:
+    requires = []
+    for line in text.splitlines():
+        line = line.strip()
+        # everything after the first [section] is for extras or markers
+        if line.startswith("["):
+            break
+        if line:
+            requires.append(line)
+    return requires
+
+
+def read_metadata(path: Path) -> PackageMetadata:
+    if path.name.endswith(".whl"):
+        text = _read_wheel(path)
+        requires_txt = None
+    elif path.name.endswith(".tar.gz"):
+        files = _read_sdist(path)
+        text = files["PKG-INFO"]
+        requires_txt = files.get("requires.txt")
+    else:
+        raise ValueError(f"Unknown suffix: {path.name}")
+
+    headers = HeaderParser().parsestr(text)
+    if headers["Name"] is None:
+        raise ValueError(f"No Name in the metadata of {path}")
+    requires = headers.get_all("Requires-Dist") or []
+    if not requires and requires_txt is not None:
+        requires = _parse_requires_txt(requires_txt)
+    return PackageMetadata(
+        path=path,
+        name=normalize_name(headers["Name"]),
+        requires=sorted({_requirement_name(r) for r in _without_extras(requires)}),
+    )
+
+
+def install_waves(paths: Iterable[Path]) -> List[List[Path]]:
+    """Group packages into waves that can be installed in order. Every package
+    only depends on packages in earlier waves, so the packages within a wave
+    can be installed at the same time. Dependencies on anything other than
+    the given packages are ignored.
+    """
+    packages: Dict[str, PackageMetadata] = {}
+    for path in paths:
+        meta = read_metadata(path)
+        if meta.name in packages:
+            raise ValueError(
+                f"Got two packages for {meta.name}: "
+                f"{packages[meta.name].path} and {path}"
+            )
+        packages[meta.name] = meta
+
+    remaining = {
+        name: {r for r in meta.requires if r in packages and r != name}
+        for name, meta in packages.items()
+    }
+    waves = []
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError(
+                f"Dependency cycle between packages: {', '.join(sorted(remaining))}"
+            )
+        waves.append([packages[name].path for name in ready])
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return waves
@@ -1,12 +1,33 @@
+from contextlib import ExitStack
 from dataclasses import replace
 from pathlib import Path
-from typing import List, Iterator, Optional
+from typing import IO, Dict, List, Iterator, Optional, Tuple
+import argparse
+import hashlib
+import platform
 import shutil
+import sys
 
-from .cmd import stream_output, collect_output
+from .buildcache import BuildCache
+from .cmd import CommandExecutor, collect_output, iter_output
 from .common import EnvironmentInformation, ReleaseFile, PytestRunner
-from .git import DbtRepository
-from .virtualenvs import EnvBuilder, DevelopmentWheelEnv, DBTPackageEnv, PackagingEnv
+from .git import MERGE_CLONE, RELEASE_COMMIT_CLONE, DbtRepository
+from .impact import compute_impact
+from .staging import sha256_file, stage_file
+from .timings import DurationHistory
+from .trace import traced
+from .upload import Uploader
+from .virtualenvs import (
+    EnvBuilder,
+    DevelopmentWheelEnv,
+    DBTPackageEnv,
+    PackagingEnv,
+    RequirementsEnv,
+    requirements_inputs,
+)
+
+
+PREVIOUS_RELEASE = "previous-release"
 
 
 class PypiBuilder:
@@ -18,9 +39,17 @@ class PypiBuilder:
         "plugins/snowflake",
     )
 
-    def __init__(self, dbt_path: Path, pkg_env_path: Path):
+    def __init__(
+        self,
+        dbt_path: Path,
+        pkg_env_path: Path,
+        log_dir: Path,
+        cache: Optional[BuildCache] = None,
+    ):
         self.dbt_path = dbt_path
         self.pkg_env_path = pkg_env_path.absolute()
+        self.log_dir = log_dir
+        self.cache = cache
 
     @staticmethod
     def _dist_for(path: Path, make=False) -> Path:
@@ -34,12 +63,36 @@ class PypiBuilder:
             shutil.rmtree(build_path)
         return dist_path
 
-    def _build_pypi_package(self, path: Path):
-        print(f"building package in {path}")
+    def _build_cmd(self):
         env_python = self.pkg_env_path / "bin" / "python"
-        cmd = [env_python, "setup.py", "sdist", "bdist_wheel"]
-        stream_output(cmd, cwd=path)
-        print(f"finished building package in {path}")
+        return [env_python, "setup.py", "sdist", "bdist_wheel"]
+
+    def _backend_versions(self) -> str:
+        env_python = self.pkg_env_path / "bin" / "python"
+        cmd = [
+            env_python,
+            "-c",
+            "import sys, setuptools, wheel; "
+            "print(sys.version, setuptools.__version__, wheel.__version__)",
+        ]
+        return collect_output(cmd).strip()
+
+    def _restore_cached(self, packages: List[Tuple[str, Path]]) -> Dict[str, str]:
+        """Restore the dists of unchanged packages from the cache. Return the
+        cache keys of the packages that still have to be built.
+        """
+        if self.cache is None:
+            return {}
+        backend = self._backend_versions()
+        to_build = {}
+        for name, path in packages:
+            key = self.cache.source_key(path, backend)
+            if self.cache.restore(name, key, path / "dist"):
+                print(f"build cache hit for {name} ({key[:12]}), not rebuilding")
+            else:
+                print(f"build cache miss for {name} ({key[:12]})")
+                to_build[name] = key
+        return to_build
 
     @staticmethod
     def _all_packages_in(path: Path) -> Iterator[Path]:
@@ -50,52 +103,87 @@ class PypiBuilder:
     def built_packages(self) -> Iterator[Path]:
         return self._all_packages_in(self.dbt_path)
 
-    def _build_subpackage(self, name: str) -> Iterator[Path]:
-        subpath = self.dbt_path / name
-        self._dist_for(subpath)
-        self._build_pypi_package(subpath)
-        return self._all_packages_in(subpath)
-
+    @traced
     def build(self):
+        """Build the subpackages at the same time, then the main package. Each
+        one builds in its own directory, with its own build/ and dist/, and
+        its output is also written to a log file in log_dir.
+        """
         print("building pypi packages")
         dist_path = self._dist_for(self.dbt_path)
+        packages = [(name, self.dbt_path / name) for name in self._SUBPACKAGES]
+        for _, path in packages:
+            self._dist_for(path)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        cache_keys = self._restore_cached(packages)
+
+        with ExitStack() as stack:
+
+            def submit(executor: CommandExecutor, name: str, path: Path) -> None:
+                log_path = self.log_dir / f"{name.replace('/', '-')}.log"
+                log = stack.enter_context(log_path.open("w"))
+                executor.submit(
+                    self._build_cmd(),
+                    cwd=path,
+                    name=name,
+                    on_line=lambda line: print(line, file=log),
+                )
+
+            executor = CommandExecutor()
+            for name, path in packages:
+                if self.cache is None or name in cache_keys:
+                    submit(executor, name, path)
+            executor.run()
+
+            # the main package is tiny, but its sdist is built from the root of
+            # the tree, so don't build it while the subpackages are changing
+            submit(executor, "dbt", self.dbt_path)
+            executor.run()
+
+        if self.cache is not None:
+            for name, path in packages:
+                if name in cache_keys:
+                    built = self._all_packages_in(path)
+                    self.cache.store(name, cache_keys[name], built)
+
+        # now copy everything from the subpackages in, in a stable order
         sub_pkgs: List[Path] = []
-        for path in self._SUBPACKAGES:
-            sub_pkgs.extend(self._build_subpackage(path))
-
-        # now build the main package
-        self._build_pypi_package(self.dbt_path)
-        # now copy everything from the subpackages in
+        for _, path in packages:
+            sub_pkgs.extend(sorted(self._all_packages_in(path)))
         for package in sub_pkgs:
-            shutil.copy(str(package), dist_path)
+            stage_file(package, dist_path / package.name)
 
         print("built pypi packages")
 
-    def write_wheel_ordering(self, dest_path: Path):
+    def write_wheel_ordering(self, fp: IO[str]):
         dbtenv = DBTPackageEnv(package_dir=self.dbt_path / "dist")
-        pkgs = dbtenv.get_pkg_install_order()
-        with dest_path.open("w") as fp:
-            for path in pkgs:
-                fp.write(f"./dist/{path.name}\n")
+        for path in dbtenv.get_pkg_install_order():
+            fp.write(f"./dist/{path.name}\n")
 
     def store_artifacts(self, env: EnvironmentInformation):
-        artifact_dist_dir = env.dist_dir
-        print(f"storing packaging artifacts in {artifact_dist_dir}")
-        artifact_dist_dir.mkdir(parents=True, exist_ok=True)
+        store = env.artifact_store
+        print(f"storing packaging artifacts in {env.dist_dir}")
         for path in self.built_packages():
-            shutil.copyfile(path, artifact_dist_dir / path.name)
-            print(f"Copied {path.name} to {artifact_dist_dir}")
+            digest = store.put(f"dist/{path.name}", path)
+            print(f"Stored {path.name} in {env.dist_dir} (sha256:{digest[:12]})")
         print("stored all packaging artifacts")
-        self.write_wheel_ordering(env.wheel_file)
+        with store.write(env.wheel_file) as fp:
+            self.write_wheel_ordering(fp)
 
 
 class WheelManager:
     """Manage the installing, testing and uploading of wheels."""
 
-    def __init__(self, wheel_dir: Path, dbt_dir: Path):
+    def __init__(
+        self,
+        wheel_dir: Path,
+        dbt_dir: Path,
+        history: Optional[DurationHistory] = None,
+    ):
         self.wheel_dir = wheel_dir
         self.dbt_dir = dbt_dir
         self.test_root = self.dbt_dir / "test/integration"
+        self.history = history
 
     def wheel_paths(self):
         return DBTPackageEnv(package_dir=self.wheel_dir).packages
@@ -116,42 +204,102 @@ class WheelManager:
             )
         virtualenv.create(env_path)
 
-    def test(self, env_path: Path, name: str):
-        runner = PytestRunner(env_path=env_path, dbt_path=self.dbt_dir)
+    def _runner(
+        self,
+        env_path: Path,
+        shard: Optional[Tuple[int, int]],
+        workers: Optional[int],
+        shard_durations: Optional[Path],
+    ) -> PytestRunner:
+        return PytestRunner(
+            env_path=env_path,
+            dbt_path=self.dbt_dir,
+            history=self.history,
+            shard=shard,
+            workers=workers,
+            shard_durations=DurationHistory(shard_durations),
+        )
+
+    def test(
+        self,
+        env_path: Path,
+        name: str,
+        shard: Optional[Tuple[int, int]] = None,
+        workers: Optional[int] = None,
+        shard_durations: Optional[Path] = None,
+    ):
+        runner = self._runner(env_path, shard, workers, shard_durations)
         return runner.test(name)
 
-    def upload(self):
+    def test_matrix(
+        self,
+        env_path: Path,
+        names: List[str],
+        shard: Optional[Tuple[int, int]] = None,
+        workers: Optional[int] = None,
+        shard_durations: Optional[Path] = None,
+    ):
+        runner = self._runner(env_path, shard, workers, shard_durations)
+        return runner.test_matrix(names)
+
+    @traced
+    def upload(self, progress_file: Path, max_workers: int = 4):
         # to use this with the pypitest repository, either export the
         # environment variable TWINE_REPOSITORY=pypitest if you have a pypirc,
         # or  all of TWINE_REPOSITORY_URL, TWINE_USERNAME, and TWINE_PASSWORD
         # environment variables to your test information.
-        cmd = ["twine", "check"]
-        cmd.extend(str(p) for p in self.wheel_paths())
-        stream_output(cmd)
-        cmd = ["twine", "upload"]
-        cmd.extend(str(p) for p in self.wheel_paths())
-        print("uploading packages: {}".format(" ".join(cmd)))
-        stream_output(cmd)
+        uploader = Uploader(progress_file, max_workers=max_workers)
+        uploader.upload(self.wheel_paths())
         print("uploaded packages")
 
     @classmethod
     def from_env_info(cls, env: EnvironmentInformation) -> "WheelManager":
-        return cls(env.dist_dir, env.dbt_dir)
+        env.artifact_store.checkout("dist/")
+        return cls(env.dist_dir, env.dbt_dir, DurationHistory(env.test_durations_file))
 
 
-def make_requirements_txt(env_dir: Path, dbt_dir: Path, requirements_path: Path):
+def requirements_cache_key(dbt_dir: Path) -> str:
+    """Hash everything that affects make_requirements_txt's result: the input
+    files, the interpreter version and the platform.
+    """
+    value = hashlib.sha256()
+    for part in (sys.version, platform.system(), platform.machine()):
+        value.update(part.encode("utf-8") + b"\0")
+    inputs = sorted(set(requirements_inputs(dbt_dir / "requirements.txt")))
+    for path in inputs:
+        value.update(str(path.relative_to(dbt_dir)).encode("utf-8") + b"\0")
+        value.update(sha256_file(path).encode("utf-8"))
+    return value.hexdigest()
+
+
+@traced
+def make_requirements_txt(
+    env_dir: Path,
+    dbt_dir: Path,
+    requirements_path: Path,
+    cache_dir: Optional[Path] = None,
+    refresh: bool = False,
+):
     """pip install the 'requirements.txt' file in the branch into a new
     virtualenv and collect all the non-dbt dependencies.
+
+    If cache_dir is given, the result is cached there and reused while its
+    inputs stay the same, unless refresh is set.
     """
+    cached = None
+    if cache_dir is not None:
+        key = requirements_cache_key(dbt_dir)
+        cached = cache_dir / f"{key}.txt"
+        if cached.exists() and not refresh:
+            stage_file(cached, requirements_path, allow_hardlink=False)
+            print(f"Reused cached requirements ({key[:12]}) at {requirements_path}")
+            return
     print("Generating requirements.txt file")
-    reqenv = EnvBuilder(with_pip=True, upgrade_deps=True)
+    reqenv = RequirementsEnv(dbt_dir / "requirements.txt")
     reqenv.create(env_dir)
     pip = str(env_dir / "bin/pip")
-    cmd = [pip, "install", "-r", "requirements.txt"]
-    stream_output(cmd, cwd=dbt_dir)
-    stdout = collect_output([pip, "freeze", "-l"], cwd=dbt_dir)
     with requirements_path.open("w") as fp:
-        for line in stdout.split("\n"):
+        for line in iter_output([pip, "freeze", "-l"], cwd=dbt_dir):
             if not line:
                 continue
             parts = line.split("==")
@@ -161,6 +309,8 @@ def make_requirements_txt(env_dir: Path, dbt_dir: Path, requirements_path: Path)
                 continue
             fp.write(line + "\n")
     print(f"Wrote requirements.txt file to {requirements_path}")
+    if cached is not None:
+        stage_file(requirements_path, cached, allow_hardlink=False)
 
 
 def set_output(name: str, value: str):
@@ -168,26 +318,29 @@ def set_output(name: str, value: str):
     print(f"::set-output name={name}::{value}")
 
 
+@traced
 def create_build_commit(args=None):
     env = EnvironmentInformation()
     release = ReleaseFile.from_git()
     release.store_artifacts(env)
-    pkgenv = PackagingEnv()
-    pkgenv.create(env.packaging_venv)
 
     repository = DbtRepository(env.dbt_dir)
-    repository.clone(branch=release.branch)
+    repository.clone(branch=release.branch, profile=RELEASE_COMMIT_CLONE)
 
     # git checkout the release name
     repository.checkout_branch(release.release_branch_name, new=True)
 
     requirements_path = env.get_dbt_requirements_file(str(release.version))
 
-    make_requirements_txt(env.linux_requirements_venv, env.dbt_dir, requirements_path)
-
-    new_commit = repository.perform_version_update(
-        release, requirements_path, env.packaging_venv
+    make_requirements_txt(
+        env.linux_requirements_venv,
+        env.dbt_dir,
+        requirements_path,
+        cache_dir=env.requirements_cache_dir,
+        refresh=args is not None and args.refresh_requirements,
     )
+
+    new_commit = repository.perform_version_update(release, requirements_path)
     replace(release, commit=new_commit).store_artifacts(env)
     if args is None or args.push_updates:
         repository.push_updates(origin_name=release.release_branch_name)
@@ -197,26 +350,44 @@ def create_build_commit(args=None):
     set_output("DBT_RELEASE_BRANCH", release.release_branch_name)
 
 
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a 1-based "I/N" shard into a 0-based (index, count)"""
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard {value}, expected I/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Invalid shard {value}, expected I/N")
+    return index - 1, count
+
+
 def set_env(name: str, value: str):
     print(f"::set-env name={name}::{value}")
 
 
+@traced
 def build_wheels(args=None):
     env = EnvironmentInformation()
     pkgenv = PackagingEnv()
     pkgenv.create(env.packaging_venv)
-    pypi_builder = PypiBuilder(env.dbt_dir, env.packaging_venv)
+    cache = None
+    if args is None or args.build_cache:
+        cache = BuildCache(env.build_cache_dir)
+    pypi_builder = PypiBuilder(
+        env.dbt_dir, env.packaging_venv, env.package_log_dir, cache=cache
+    )
     pypi_builder.build()
     pypi_builder.store_artifacts(env)
 
 
+@traced
 def merge_pr(args=None):
     print("Merging the temporary branch into the release branch")
     env = EnvironmentInformation()
 
     release = ReleaseFile.from_artifacts(env)
     repository = DbtRepository(env.dbt_dir)
-    repository.clone(branch=release.branch)
+    repository.clone(branch=release.branch, profile=MERGE_CLONE)
     repository.merge(release.release_branch_name)
     repository.push_updates()
 
@@ -227,30 +398,66 @@ def merge_pr(args=None):
     set_output("DBT_RELEASE_BRANCH", release.branch)
 
 
+@traced
 def test_wheels(args=None):
+    base_ref = None
     if args is None:
-        target = "postgres"
+        targets = ["postgres"]
+        shard = None
+        workers = None
+        shard_durations = None
     else:
-        target = args.test_name
+        targets = args.test_name
+        shard = args.shard
+        workers = args.workers
+        base_ref = args.base_ref
+        shard_durations = args.shard_durations
 
     env = EnvironmentInformation()
 
     release = ReleaseFile.from_artifacts(env)
 
+    if base_ref == PREVIOUS_RELEASE:
+        previous = release.previous_release(env.releases_dir)
+        if previous is None:
+            print(f"No release before {release.version} found, running all tests")
+            base_ref = None
+        else:
+            print(f"Comparing against previous release {previous.version}")
+            base_ref = previous.commit
+
+    if base_ref is not None:
+        report = compute_impact(env.dbt_dir, base_ref, targets)
+        with env.artifact_store.write(env.test_impact_file) as fp:
+            report.write(fp)
+        print(report.summary())
+        targets = report.selected
+        if not targets:
+            print("No test suites are affected by the changes, skipping tests")
+            return
+
     tester = WheelManager.from_env_info(env)
     requirements = env.get_dbt_requirements_file(str(release.version))
     dev_requirements = env.dbt_dir / "dev-requirements.txt"
     tester.install(
         env.test_venv, requirements=requirements, dev_requirements=dev_requirements
     )
-    tester.test(env.test_venv, target)
+    tester.test_matrix(
+        env.test_venv,
+        targets,
+        shard=shard,
+        workers=workers,
+        shard_durations=shard_durations,
+    )
 
 
+@traced
 def upload_artifacts(args=None):
     env = EnvironmentInformation()
 
     tester = WheelManager.from_env_info(env)
-    tester.upload()
+    max_workers = 4 if args is None else args.max_workers
+    tester.upload(env.upload_progress_file, max_workers=max_workers)
 
 
 def add_native_parsers(subparsers):
@@ -265,14 +472,62 @@ def add_native_parsers(subparsers):
         ),
     )
     create_sub.add_argument("--no-push", dest="push_updates", action="store_false")
+    create_sub.add_argument(
+        "--refresh-requirements",
+        action="store_true",
+        help="Re-resolve the pinned requirements file even if it's cached",
+    )
     create_sub.set_defaults(func=create_build_commit)
 
     pkg_sub = native_subs.add_parser("package", help="build the wheels/tarfiles")
+    pkg_sub.add_argument(
+        "--no-build-cache",
+        dest="build_cache",
+        action="store_false",
+        help="Rebuild every subpackage, even if its sources didn't change",
+    )
     pkg_sub.set_defaults(func=build_wheels)
 
-    test_sub = native_subs.add_parser("test", help="Run the given tests")
+    test_sub = native_subs.add_parser(
+        "test", help="Run the given tests, in parallel if there are several"
+    )
+    test_sub.add_argument(
+        "test_name",
+        nargs="+",
+        choices=["rpc", "postgres", "redshift", "bigquery", "snowflake"],
+    )
+    test_sub.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help=(
+            "Only run shard I of N (e.g. 2/4) of each suite, split evenly by "
+            "test count, or by the durations in --shard-durations"
+        ),
+    )
+    test_sub.add_argument(
+        "--shard-durations",
+        type=Path,
+        default=None,
+        help=(
+            "A JSON file of test durations to balance the shards by. Every "
+            "shard must use the same file, e.g. one committed to the repository"
+        ),
+    )
     test_sub.add_argument(
-        "test_name", choices=["rpc", "postgres", "redshift", "bigquery", "snowflake"]
+        "--base-ref",
+        default=None,
+        help=(
+            "Only run the suites affected by changes in dbt since this ref. Pass "
+            f'"{PREVIOUS_RELEASE}" to use the commit of the previous release in '
+            "releases/. The decisions are written to artifacts/test_impact.json"
+        ),
+    )
+    test_sub.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of xdist workers (default: based on cores and memory)",
     )
     test_sub.set_defaults(func=test_wheels)
 
@@ -282,4 +537,10 @@ def add_native_parsers(subparsers):
     merge_sub.set_defaults(func=merge_pr)
 
     upload_sub = native_subs.add_parser("upload", help="Upload the package to pypi")
+    upload_sub.add_argument(
+        "--max-workers",
+        type=int,
+        default=4,
+        help="Number of files to upload at the same time",
+    )
     upload_sub.set_defaults(func=upload_artifacts)
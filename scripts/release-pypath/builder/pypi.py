@@ -0,0 +1,149 @@
+"""A persistent cache of PyPI JSON API responses.
+
+Entries for a specific release (`/pypi/<pkg>/<version>/json`) don't change once
+the release has its files, so they are only fetched once. Project-level entries
+(`/pypi/<pkg>/json`) change with every release, so they expire after `ttl`
+seconds and are then revalidated with ETag/Last-Modified.
+"""
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import json
+import os
+import re
+import tempfile
+import time
+
+PYPI_JSON_URL = "https://pypi.org/pypi"
+
+
+def truthy(value: Optional[str]) -> bool:
+    return value is not None and value.lower() in ("1", "true", "yes")
+
+
+class PypiMetadataCache:
+    def __init__(
+        self,
+        cache_dir: Path,
+        index_url: Optional[str] = None,
+        ttl: float = 300.0,
+        max_bytes: int = 64 * 1024 * 1024,
+        offline: Optional[bool] = None,
+    ) -> None:
+        if index_url is None:
+            index_url = os.getenv("DBT_RELEASE_PYPI_URL", PYPI_JSON_URL)
+        if offline is None:
+            offline = truthy(os.getenv("DBT_RELEASE_OFFLINE"))
+        self.cache_dir = cache_dir
+        self.index_url = index_url.rstrip("/")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+    def url_for(self, package: str, version: Optional[str] = None) -> str:
+        if version is None:
+            return f"{self.index_url}/{package}/json"
+        return f"{self.index_url}/{package}/{version}/json"
+
+    def _entry_path(self, package: str, version: Optional[str]) -> Path:
+        name = re.sub(r"[-_.]+", "-", package).lower()
+        filename = "project.json" if version is None else f"{version}.json"
+        return self.cache_dir / name / filename
+
+    @staticmethod
+    def _load(path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with path.open() as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, path: Path, entry: Dict[str, Any]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write-then-rename so concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, path)
+
+    def _is_fresh(self, entry: Dict[str, Any], version: Optional[str]) -> bool:
+        if version is not None:
+            return True
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def get(
+        self, package: str, version: Optional[str] = None, refresh: bool = False
+    ) -> Dict[str, Any]:
+        """Get the JSON API data for package (at version, if given). With
+        refresh, a cached entry is always revalidated against the index.
+        """
+        path = self._entry_path(package, version)
+        entry = self._load(path)
+        if entry is not None:
+            if self.offline or (not refresh and self._is_fresh(entry, version)):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+                return entry["data"]
+        elif self.offline:
+            raise LookupError(
+                f"No cached PyPI metadata for {package} {version or ''} "
+                "and offline mode is enabled"
+            )
+
+        url = self.url_for(package, version)
+        headers = {"Accept": "application/json"}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            with urlopen(Request(url, headers=headers)) as fp:
+                data = json.load(fp)
+                etag = fp.headers.get("ETag")
+                last_modified = fp.headers.get("Last-Modified")
+        except HTTPError as exc:
+            if exc.code == 304 and entry is not None:
+                entry["fetched_at"] = time.time()
+                self._store(path, entry)
+                return entry["data"]
+            raise
+
+        self._store(
+            path,
+            {
+                "url": url,
+                "fetched_at": time.time(),
+                "etag": etag,
+                "last_modified": last_modified,
+                "data": data,
+            },
+        )
+        self.evict()
+        return data
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits in
+        max_bytes.
+        """
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
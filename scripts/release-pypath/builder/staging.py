@@ -0,0 +1,158 @@
+"""Put files in place with as little copying as possible.
+
+Staging tries a copy-on-write clone (reflink) first, then a hardlink, and only
+copies the bytes if neither works, e.g. across filesystems. A hardlinked file
+is the source file, so a change to one in place shows up in the other. Only
+allow hardlinks for files that are replaced rather than rewritten, like built
+sdists and wheels or the artifact store's objects. Reflinks and copies get
+the source's permissions.
+"""
+from pathlib import Path
+from typing import Callable, Optional
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _read_umask() -> int:
+    # there's no way to read the umask without setting it
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+_UMASK = _read_umask()
+
+
+def new_file_mode() -> int:
+    """The mode open() gives new files, for files created with mkstemp()
+    (which makes them private) that replace regular ones.
+    """
+    return 0o666 & ~_UMASK
+
+
+def sha256_file(path: Path) -> str:
+    value = hashlib.sha256()
+    with path.open("rb") as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b""):
+            value.update(chunk)
+    return value.hexdigest()
+
+
+def _reflink(source: Path, dest: str) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with source.open("rb") as src, open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def _hardlink(source: Path, dest: str) -> bool:
+    try:
+        os.unlink(dest)
+        os.link(source, dest)
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        return False
+    return True
+
+
+def _clone_file(source: str, dest: str, allow_hardlink: bool = True) -> str:
+    if _reflink(Path(source), dest):
+        shutil.copystat(source, dest)
+        return "reflink"
+    if allow_hardlink:
+        if os.path.exists(dest):
+            os.unlink(dest)
+        try:
+            os.link(source, dest)
+            return "hardlink"
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    shutil.copy2(source, dest)
+    return "copy"
+
+
+def clone_tree(
+    source: Path, dest: Path, private: Optional[Callable[[Path], bool]] = None
+) -> None:
+    """Copy the directory source to dest, which must not exist, sharing file
+    contents wherever possible like stage_file does. Symlinks are copied as
+    symlinks. Files for which private returns True are never hardlinked, so
+    they can be written in place. Other files in dest must be replaced rather
+    than written in place, as they may be hardlinks to the files in source.
+    """
+
+    def copy_function(src: str, dst: str) -> str:
+        allow_hardlink = private is None or not private(Path(src))
+        return _clone_file(src, dst, allow_hardlink=allow_hardlink)
+
+    shutil.copytree(source, dest, symlinks=True, copy_function=copy_function)
+
+
+def same_file(source: Path, dest: Path) -> bool:
+    try:
+        return os.path.samefile(source, dest)
+    except FileNotFoundError:
+        return False
+
+
+def stage_file(
+    source: Path,
+    dest: Path,
+    digest: Optional[str] = None,
+    allow_hardlink: bool = True,
+) -> str:
+    """Atomically put the contents of source at dest and return how it was
+    done: "same", "reflink", "hardlink" or "copy".
+
+    The size of dest is always checked. A byte copy is also checked against
+    digest, which is computed from source if not given.
+    """
+    if same_file(source, dest):
+        return "same"
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.")
+    os.close(fd)
+    try:
+        if _reflink(source, tmp):
+            method = "reflink"
+        elif allow_hardlink and _hardlink(source, tmp):
+            method = "hardlink"
+        else:
+            method = "copy"
+            shutil.copyfile(source, tmp)
+        if method != "hardlink":
+            shutil.copymode(source, tmp)
+
+        size = source.stat().st_size
+        if os.stat(tmp).st_size != size:
+            raise ValueError(f"Staging {source} to {dest} gave the wrong size")
+        if method == "copy":
+            if digest is None:
+                digest = sha256_file(source)
+            if sha256_file(Path(tmp)) != digest:
+                raise ValueError(f"Staging {source} to {dest} gave the wrong digest")
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return method
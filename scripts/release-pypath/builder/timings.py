@@ -0,0 +1,136 @@
+"""Test duration history, used to balance and order pytest runs."""
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+import os
+import re
+import statistics
+import tempfile
+
+# A line of pytest's `--durations` report, e.g.
+# "12.34s call     test/rpc/test_base.py::test_rpc_basics[postgres]"
+DURATION_LINE = re.compile(
+    r"^(?P<seconds>\d+\.\d+)s (setup|call|teardown)\s+(?P<nodeid>\S+)"
+)
+
+# How much a new measurement moves the recorded duration
+_SMOOTHING = 0.5
+
+# Conservative memory use of one xdist worker running dbt integration tests
+WORKER_MEMORY_BYTES = 1024 ** 3
+# The suites mostly wait on the databases, so they use more workers than
+# there are cores. This was the fixed -n4 of every suite before.
+MIN_WORKERS = 4
+
+
+def parse_duration_line(line: str) -> Optional[Tuple[str, float]]:
+    match = DURATION_LINE.match(line)
+    if match is None:
+        return None
+    return match.group("nodeid"), float(match.group("seconds"))
+
+
+class DurationCollector:
+    """Sum the setup/call/teardown times of each test from pytest's output."""
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, float] = {}
+
+    def __call__(self, line: str) -> None:
+        parsed = parse_duration_line(line)
+        if parsed is not None:
+            nodeid, seconds = parsed
+            self.durations[nodeid] = self.durations.get(nodeid, 0.0) + seconds
+
+
+class DurationHistory:
+    """Recorded test durations, smoothed over runs. Without a path, nothing is
+    known and every test is estimated to take the same time.
+    """
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self.durations: Dict[str, float] = {}
+        if path is not None and path.exists():
+            with path.open() as fp:
+                self.durations = json.load(fp)
+
+    def update(self, durations: Dict[str, float]) -> None:
+        for nodeid, seconds in durations.items():
+            previous = self.durations.get(nodeid)
+            if previous is not None:
+                seconds = previous + _SMOOTHING * (seconds - previous)
+            self.durations[nodeid] = round(seconds, 3)
+
+    def save(self) -> None:
+        if self.path is None:
+            raise ValueError("This duration history has no file to save to")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(self.durations, fp, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def estimate(self, nodeids: Iterable[str]) -> Dict[str, float]:
+        """Estimate how long each test takes. Tests we haven't seen are
+        assumed to take as long as the median known test.
+        """
+        nodeids = list(nodeids)
+        known = [self.durations[n] for n in nodeids if n in self.durations]
+        default = statistics.median(known) if known else 1.0
+        return {n: self.durations.get(n, default) for n in nodeids}
+
+    def slowest_first(self, nodeids: Iterable[str]) -> List[str]:
+        estimates = self.estimate(nodeids)
+        return sorted(estimates, key=lambda n: (-estimates[n], n))
+
+    def shard(self, nodeids: Iterable[str], index: int, count: int) -> List[str]:
+        """Split nodeids into count shards of about equal total duration, and
+        return shard index (0-based), slowest test first.
+
+        Each test goes to the currently lightest shard, slowest tests first.
+        Every CI job computes the same split only if they all use the same
+        durations, so don't shard with a history that only this host has.
+        Without any durations, the tests are dealt out in order of their IDs.
+        """
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        estimates = self.estimate(nodeids)
+        totals = [0.0] * count
+        shards: List[List[str]] = [[] for _ in range(count)]
+        for nodeid in self.slowest_first(estimates):
+            lightest = totals.index(min(totals))
+            shards[lightest].append(nodeid)
+            totals[lightest] += estimates[nodeid]
+        return shards[index]
+
+
+def _available_memory() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as fp:
+            for line in fp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+def xdist_workers(concurrent_suites: int = 1) -> int:
+    """Pick a number of xdist workers for one of concurrent_suites pytest runs:
+    a share of the available cores, but at least MIN_WORKERS unless there
+    isn't enough memory for them.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    concurrent_suites = max(1, concurrent_suites)
+    workers = max(MIN_WORKERS, cores // concurrent_suites)
+    memory = _available_memory()
+    if memory is not None:
+        workers = min(workers, memory // WORKER_MEMORY_BYTES // concurrent_suites)
+    return max(1, workers)
@@ -0,0 +1,149 @@
+"""Record where release time goes.
+
+Stages and commands are recorded as nested spans and written out in the Chrome
+trace event format, which can be opened in chrome://tracing or
+https://ui.perfetto.dev.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+import json
+import os
+import resource
+import threading
+import time
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    start: float
+    duration: float
+    tid: int
+    args: Dict[str, Any] = field(default_factory=dict)
+
+    def to_event(self, pid: int) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "cat": self.category,
+            "ph": "X",
+            "ts": round(self.start * 1e6),
+            "dur": round(self.duration * 1e6),
+            "pid": pid,
+            "tid": self.tid,
+            "args": self.args,
+        }
+
+
+def _rusage_args(
+    before: resource.struct_rusage, after: resource.struct_rusage
+) -> Dict[str, Any]:
+    # ru_maxrss of RUSAGE_CHILDREN is the peak RSS of the largest child waited
+    # for so far, so it only ever grows across spans.
+    return {
+        "child_user_s": round(after.ru_utime - before.ru_utime, 3),
+        "child_sys_s": round(after.ru_stime - before.ru_stime, 3),
+        "child_max_rss_kb": after.ru_maxrss,
+    }
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._tracks: Dict[Any, int] = {}
+        self._track_names: Dict[int, str] = {}
+
+    def now(self) -> float:
+        return time.perf_counter() - self._origin
+
+    def track(self, key: Any, name: str) -> int:
+        """Get the trace "thread" id used to group spans for key."""
+        with self._lock:
+            if key not in self._tracks:
+                tid = len(self._tracks) + 1
+                self._tracks[key] = tid
+                self._track_names[tid] = name
+            return self._tracks[key]
+
+    def _current_track(self) -> int:
+        thread = threading.current_thread()
+        return self.track(thread.ident, thread.name)
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, category: str = "stage", **args) -> Iterator[dict]:
+        """Record a span around the body of the with statement. The yielded
+        dict can be updated to attach more args to the span.
+        """
+        tid = self._current_track()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = self.now()
+        try:
+            yield args
+        finally:
+            duration = self.now() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            args.update(_rusage_args(before, after))
+            self.add(Span(name, category, start, duration, tid, args))
+
+    def to_json(self) -> Dict[str, Any]:
+        pid = os.getpid()
+        events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in self._track_names.items()
+        ]
+        events.extend(s.to_event(pid) for s in self.spans)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w") as fp:
+            json.dump(self.to_json(), fp)
+        print(f"Wrote trace of {len(self.spans)} spans to {path}")
+
+
+TRACER = Tracer()
+
+
+def span(name: str, category: str = "stage", **args):
+    return TRACER.span(name, category, **args)
+
+
+def traced(func):
+    """Record every call of func as a span."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with TRACER.span(func.__qualname__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def describe_cmd(cmd) -> str:
+    """Make a short span name like "git clone" or "pip install" for cmd."""
+    args = [str(c) for c in cmd]
+    words = [Path(args[0]).name]
+    for arg in args[1:]:
+        if arg in ("-m", "-Im"):
+            continue
+        if arg.startswith("-") or "/" in arg:
+            break
+        words.append(arg)
+        if len(words) == 3:
+            break
+    return " ".join(words)
@@ -0,0 +1,247 @@
+"""Upload release files to a package index, skipping what's already there.
+
+Before uploading, each file is looked up on the index's simple API (PEP 503),
+which both pypi.org and pypiserver serve with `#sha256=` digests. Files that
+are already there with the same digest are skipped, and a file that is there
+with a different digest is an error, because indexes don't allow replacing a
+file. Each finished upload is recorded in a progress file, so rerunning after
+a failure only uploads what is left.
+
+Packages are uploaded in dependency order, with the dbt metapackage last, so
+a release is never installable from the index before everything it needs is
+there. Uploads are retried with `--skip-existing`, since an upload whose
+response was lost may have reached the index anyway.
+
+The repository comes from twine's own settings (TWINE_REPOSITORY_URL, or
+TWINE_REPOSITORY and ~/.pypirc). Set DBT_RELEASE_SIMPLE_URL if its simple API
+isn't at the usual place next to the upload URL.
+"""
+from configparser import ConfigParser
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urldefrag
+from urllib.request import Request, urlopen
+import json
+import os
+import re
+import tempfile
+
+from .cmd import (
+    CommandExecutor,
+    CommandResult,
+    RetryPolicy,
+    TWINE_UPLOAD,
+    stream_output,
+)
+from .metadata import install_waves, read_metadata
+from .staging import sha256_file
+
+PYPI_UPLOAD_URL = "https://upload.pypi.org/legacy/"
+PYPI_SIMPLE_URL = "https://pypi.org/simple/"
+TESTPYPI_UPLOAD_URL = "https://test.pypi.org/legacy/"
+
+
+def repository_url() -> str:
+    """The upload URL twine will use, following its own precedence."""
+    url = os.getenv("TWINE_REPOSITORY_URL")
+    if url:
+        return url
+    name = os.getenv("TWINE_REPOSITORY", "pypi")
+    config = ConfigParser()
+    config.read(Path.home() / ".pypirc")
+    if config.has_option(name, "repository"):
+        return config.get(name, "repository")
+    if name == "pypi":
+        return PYPI_UPLOAD_URL
+    if name == "testpypi":
+        return TESTPYPI_UPLOAD_URL
+    raise ValueError(
+        f"Don't know the URL of repository {name}, set TWINE_REPOSITORY_URL"
+    )
+
+
+def simple_url(upload_url: str) -> str:
+    """Guess the simple API of the index that upload_url belongs to."""
+    url = os.getenv("DBT_RELEASE_SIMPLE_URL")
+    if url:
+        return url.rstrip("/") + "/"
+    if upload_url == PYPI_UPLOAD_URL:
+        return PYPI_SIMPLE_URL
+    base = upload_url.rstrip("/")
+    if base.endswith("/legacy"):
+        base = base[: -len("/legacy")]
+    return base + "/simple/"
+
+
+def project_name(path: Path) -> str:
+    """The normalized project name of a wheel or sdist filename."""
+    if path.name.endswith(".whl"):
+        name = path.name.split("-", 1)[0]
+    else:
+        name = re.sub(r"\.(tar\.gz|zip)$", "", path.name).rsplit("-", 1)[0]
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def upload_waves(paths: List[Path]) -> List[List[Path]]:
+    """Group files into waves that can be uploaded one after another, so no
+    package is on the index before the packages it depends on. All files of a
+    package are in the same wave, and the dbt metapackage is always last.
+    """
+    files: Dict[str, List[Path]] = {}
+    for path in paths:
+        files.setdefault(read_metadata(path).name, []).append(path)
+    # install_waves takes one file per package
+    names = {group[0]: name for name, group in files.items()}
+    waves = [[names[p] for p in wave] for wave in install_waves(list(names))]
+    if "dbt" in files:
+        waves = [[n for n in wave if n != "dbt"] for wave in waves] + [["dbt"]]
+    return [sorted(p for n in wave for p in files[n]) for wave in waves if wave]
+
+
+class _LinkParser(HTMLParser):
+    def __init__(self, base_url: str) -> None:
+        super().__init__()
+        self.base_url = base_url
+        self.digests: Dict[str, Optional[str]] = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if not href:
+            return
+        url, fragment = urldefrag(urljoin(self.base_url, href))
+        filename = url.rstrip("/").rsplit("/", 1)[-1]
+        digest = None
+        if fragment.startswith("sha256="):
+            digest = fragment[len("sha256=") :]
+        self.digests[filename] = digest
+
+
+@dataclass
+class IndexFile:
+    path: Path
+    sha256: str
+    on_index: bool
+    # some indexes don't publish digests
+    remote_sha256: Optional[str]
+
+
+class Uploader:
+    def __init__(
+        self,
+        progress_file: Path,
+        upload_url: Optional[str] = None,
+        index_url: Optional[str] = None,
+        max_workers: int = 4,
+        retry: RetryPolicy = TWINE_UPLOAD,
+    ) -> None:
+        if upload_url is None:
+            upload_url = repository_url()
+        if index_url is None:
+            index_url = simple_url(upload_url)
+        self.progress_file = progress_file
+        self.upload_url = upload_url
+        self.index_url = index_url
+        self.max_workers = max_workers
+        self.retry = retry
+
+    def _load_progress(self) -> Dict[str, Dict[str, str]]:
+        if not self.progress_file.exists():
+            return {}
+        with self.progress_file.open() as fp:
+            return json.load(fp)
+
+    def _record(self, path: Path, digest: str) -> None:
+        progress = self._load_progress()
+        progress.setdefault(self.upload_url, {})[path.name] = digest
+        self.progress_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.progress_file.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(progress, fp, indent=2, sort_keys=True)
+        os.replace(tmp, self.progress_file)
+
+    def index_digests(self, project: str) -> Dict[str, Optional[str]]:
+        """Map the filenames the index has for project to their sha256."""
+        url = f"{self.index_url}{project}/"
+        try:
+            with urlopen(Request(url, headers={"Accept": "text/html"})) as fp:
+                page = fp.read().decode("utf-8")
+        except HTTPError as exc:
+            if exc.code == 404:
+                return {}
+            raise
+        parser = _LinkParser(url)
+        parser.feed(page)
+        return parser.digests
+
+    def lookup(self, paths: List[Path]) -> List[IndexFile]:
+        found: Dict[str, Dict[str, Optional[str]]] = {}
+        files = []
+        for path in paths:
+            project = project_name(path)
+            if project not in found:
+                found[project] = self.index_digests(project)
+            digests = found[project]
+            files.append(
+                IndexFile(
+                    path=path,
+                    sha256=sha256_file(path),
+                    on_index=path.name in digests,
+                    remote_sha256=digests.get(path.name),
+                )
+            )
+        return files
+
+    def pending(self, paths: List[Path]) -> List[Path]:
+        """Return the paths that still have to be uploaded. Raises ValueError if
+        any of them is already on the index with different contents.
+        """
+        done = self._load_progress().get(self.upload_url, {})
+        result = []
+        mismatched = []
+        for item in self.lookup(paths):
+            if done.get(item.path.name) == item.sha256:
+                print(f"Skipping {item.path.name}, already uploaded")
+            elif not item.on_index:
+                result.append(item.path)
+            elif item.remote_sha256 in (item.sha256, None):
+                print(f"Skipping {item.path.name}, already on {self.index_url}")
+                self._record(item.path, item.sha256)
+            else:
+                mismatched.append(item.path.name)
+        if mismatched:
+            raise ValueError(
+                f"Files already on {self.index_url} with different contents: "
+                + ", ".join(mismatched)
+            )
+        return result
+
+    def upload(self, paths: List[Path]) -> None:
+        paths = self.pending(paths)
+        if not paths:
+            print(f"Nothing left to upload to {self.upload_url}")
+            return
+        stream_output(["twine", "check"] + [str(p) for p in paths])
+
+        waves = upload_waves(paths)
+        print(f"Uploading {len(paths)} files to {self.upload_url}")
+        for number, wave in enumerate(waves, 1):
+            print(f"Upload wave {number}/{len(waves)}: {[p.name for p in wave]}")
+            executor = CommandExecutor(max_workers=self.max_workers)
+            for path in wave:
+
+                def on_exit(result: CommandResult, path: Path = path) -> None:
+                    if result.ok:
+                        self._record(path, sha256_file(path))
+
+                executor.submit(
+                    ["twine", "upload", "--skip-existing", str(path)],
+                    name=path.name,
+                    retry=self.retry,
+                    on_exit=on_exit,
+                )
+            executor.run()
@@ -1,33 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from dataclasses import dataclass
+from email.parser import HeaderParser
 from pathlib import Path
-from typing import Optional, List
-import re
+from typing import Dict, Iterator, Optional, List, Set, Tuple
+from urllib.parse import unquote, urlparse
+import base64
+import csv
+import hashlib
+import io
+import json
+import os
 import shutil
+import stat
+import sys
 import tempfile
+import threading
+import time
 import venv
 import subprocess
-from .cmd import stream_output
-from .common import PackageType, VERSION_PATTERN_STR
+import zipfile
+from .cmd import PIP_NETWORK, collect_output, run_with_retry, stream_output
+from .common import EnvironmentInformation, PackageType
+from .metadata import install_waves, normalize_name
+from .staging import clone_tree, sha256_file
+from .trace import span
+from .wheelhouse import Wheelhouse
 
 CORE_VENV_DEPS = ("pip", "setuptools")
 
+# templates are rebuilt after a week, to pick up new pip/setuptools releases
+TEMPLATE_MAX_AGE = 7 * 24 * 60 * 60
+TEMPLATE_STAMP = ".dbt-release-template"
+FINGERPRINT_FILE = ".dbt-release-fingerprint"
+
+
+def requirements_inputs(requirements: Path) -> Iterator[Path]:
+    """Find the files that decide what installing requirements resolves to:
+    the requirements files themselves and the packaging metadata of any local
+    packages they install.
+    """
+    yield requirements
+    for line in requirements.read_text().splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line.startswith(("-r ", "--requirement ")):
+            nested = line.split(None, 1)[1]
+            yield from requirements_inputs(requirements.parent / nested)
+            continue
+        if line.startswith(("-e ", "--editable ")):
+            line = line.split(None, 1)[1]
+        if line.startswith((".", "/")):
+            package_dir = requirements.parent / line
+            for name in ("setup.py", "setup.cfg", "pyproject.toml"):
+                if (package_dir / name).exists():
+                    yield package_dir / name
+
+
+def _private_files(venv_path: Path) -> List[Path]:
+    """The files of a venv that refer to its location, or that pip and
+    setuptools write in place (like scripts and easy-install.pth), so a clone
+    needs copies of its own.
+    """
+    paths = [p for p in venv_path.iterdir() if p.is_file()]
+    paths.extend((venv_path / "bin").iterdir())
+    for site_packages in venv_path.glob("lib*/python*/site-packages"):
+        paths.extend(site_packages.glob("*.pth"))
+        paths.extend(site_packages.glob("*.egg-link"))
+    return [p for p in paths if p.is_file() and not p.is_symlink()]
+
+
+def _relocate(venv_path: Path, old: Path, new: Path) -> None:
+    """Rewrite the absolute paths (and the prompt) in the files of a venv that
+    was copied from old to new.
+    """
+    replacements = [
+        (str(old).encode("utf-8"), str(new).encode("utf-8")),
+        (f"({old.name}) ".encode("utf-8"), f"({new.name}) ".encode("utf-8")),
+    ]
+    for path in _private_files(venv_path):
+        contents = original = path.read_bytes()
+        for before, after in replacements:
+            contents = contents.replace(before, after)
+        if contents == original:
+            continue
+        # replace rather than rewrite, so a failure can't leave half a file
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_bytes(contents)
+        os.chmod(tmp, stat.S_IMODE(path.stat().st_mode))
+        os.replace(tmp, path)
+
 
 class EnvBuilder(venv.EnvBuilder):
-    def __init__(self, upgrade_deps=False, **kwargs):
-        self.upgrade_deps = upgrade_deps  # this is included in 3.9!
+    def __init__(
+        self,
+        upgrade_deps=False,
+        use_template=True,
+        use_wheelhouse=True,
+        reuse=True,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
+        # this is included in 3.9, and set to False by its __init__
+        self.upgrade_deps = upgrade_deps
+        self.use_template = use_template
+        self.use_wheelhouse = use_wheelhouse
+        self.reuse = reuse
+
+    def fingerprint_inputs(self) -> List[str]:
+        """Everything that decides what create() puts in the venv. Subclasses
+        add the requirements and packages they install.
+        """
+        return [
+            type(self).__name__,
+            os.path.realpath(sys.executable),
+            sys.version,
+            f"with_pip={self.with_pip}",
+            f"upgrade_deps={self.upgrade_deps}",
+            f"system_site_packages={self.system_site_packages}",
+        ]
+
+    def fingerprint(self) -> str:
+        value = hashlib.sha256()
+        for item in self.fingerprint_inputs():
+            value.update(item.encode("utf-8") + b"\0")
+        return value.hexdigest()
+
+    @staticmethod
+    def _installed(venv_path: Path) -> List[str]:
+        return sorted({p.name for p in venv_path.glob("lib*/python*/*/*.dist-info")})
+
+    def _can_reuse(self, venv_path: Path, fingerprint: str) -> bool:
+        """A venv can be reused if it was created with the same fingerprint,
+        and nothing was installed into or removed from it since.
+        """
+        try:
+            with (venv_path / FINGERPRINT_FILE).open() as fp:
+                stamp = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        if stamp.get("fingerprint") != fingerprint:
+            return False
+        return stamp.get("installed") == self._installed(venv_path)
+
+    def _stamp(self, venv_path: Path, fingerprint: str) -> None:
+        stamp = {"fingerprint": fingerprint, "installed": self._installed(venv_path)}
+        # replace, don't rewrite: a cloned venv may share the file
+        fd, tmp = tempfile.mkstemp(dir=venv_path, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(stamp, fp, indent=2)
+        os.replace(tmp, venv_path / FINGERPRINT_FILE)
 
     def dbt_pip_install(self, cwd, context, *pkgs, upgrade=True):
         cmd = [context.env_exe, "-m", "pip", "install"]
         if upgrade:
             cmd.append("--upgrade")
+        if self.use_wheelhouse:
+            wheelhouse = Wheelhouse(EnvironmentInformation().wheelhouse_dir)
+            links = wheelhouse.find_links(context.env_exe, Path(cwd), pkgs)
+            if links is not None:
+                cmd.extend(["--no-index", "--find-links", str(links)])
         cmd.extend(pkgs)
-        stream_output(cmd, cwd=cwd)
+        run_with_retry(cmd, PIP_NETWORK, cwd=cwd)
+
+    def _template(self) -> "Optional[VenvTemplate]":
+        if not (self.use_template and self.with_pip and self.upgrade_deps):
+            return None
+        if self.system_site_packages:
+            return None
+        return VenvTemplate(EnvironmentInformation().venv_template_dir)
 
     def create(self, venv_path: Path):
-        venv_path.parent.mkdir(parents=True, exist_ok=True)
-        if venv_path.exists():
-            shutil.rmtree(venv_path)
-        super().create(venv_path)
+        with span(f"create venv {venv_path.name}", builder=type(self).__name__):
+            fingerprint = self.fingerprint()
+            if self.reuse and self._can_reuse(venv_path, fingerprint):
+                print(f"Reusing {venv_path} (fingerprint {fingerprint[:12]})")
+                return
+            venv_path.parent.mkdir(parents=True, exist_ok=True)
+            if venv_path.exists():
+                shutil.rmtree(venv_path)
+            template = self._template()
+            if template is None:
+                super().create(venv_path)
+            else:
+                # the template has everything venv's create() would set up
+                template.clone(venv_path.absolute())
+                context = self.ensure_directories(venv_path.absolute())
+                self.post_setup(context)
+            if self.reuse:
+                self._stamp(venv_path, fingerprint)
 
     def _setup_pip(self, context):
         """
@@ -41,7 +201,8 @@ class EnvBuilder(venv.EnvBuilder):
         # intended for the global Python environment
         cmd = [context.env_exe, "-Im", "ensurepip", "--upgrade", "--default-pip"]
         subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        if self.upgrade_deps:
+        # venv's create() upgrades them itself from 3.9
+        if self.upgrade_deps and sys.version_info < (3, 9):
             self.upgrade_dependencies(context)
 
     def upgrade_dependencies(self, context):
@@ -50,6 +211,330 @@ class EnvBuilder(venv.EnvBuilder):
         subprocess.check_call(cmd)
 
 
+class VenvTemplate:
+    """A venv with upgraded pip and setuptools for the running interpreter.
+
+    Builder venvs are cloned from it (sharing file contents where the
+    filesystem allows) instead of each one running ensurepip and upgrading
+    pip from the network. A clone gets its own copies of the files that refer
+    to the venv's location or are written in place. pip replaces the other
+    files rather than writing into them, so sharing those is safe.
+    """
+
+    def __init__(self, root: Path, max_age: float = TEMPLATE_MAX_AGE) -> None:
+        self.root = root
+        self.max_age = max_age
+        key = hashlib.sha256()
+        for part in (os.path.realpath(sys.executable), sys.version) + CORE_VENV_DEPS:
+            key.update(part.encode("utf-8") + b"\0")
+        self.path = root / key.hexdigest()[:16]
+
+    def is_fresh(self) -> bool:
+        try:
+            age = time.time() - (self.path / TEMPLATE_STAMP).stat().st_mtime
+        except FileNotFoundError:
+            return False
+        return age < self.max_age
+
+    def ensure(self) -> Path:
+        """Build the template if it's missing or too old, and return its path."""
+        if self.is_fresh():
+            return self.path
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.root, prefix=f".{self.path.name}."))
+        builder = EnvBuilder(
+            with_pip=True, upgrade_deps=True, use_template=False, reuse=False
+        )
+        try:
+            with span("create venv template", path=str(self.path)):
+                builder.create(tmp)
+            _relocate(tmp, tmp, self.path)
+            (tmp / TEMPLATE_STAMP).touch()
+            self._replace(tmp)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp)
+        return self.path
+
+    def _replace(self, new: Path) -> None:
+        try:
+            if self.path.exists():
+                stale = Path(tempfile.mkdtemp(dir=self.root, prefix=".stale."))
+                os.rename(self.path, stale / self.path.name)
+                shutil.rmtree(stale)
+            os.rename(new, self.path)
+        except OSError:
+            # fine if another build got there first
+            if not self.is_fresh():
+                raise
+
+    def clone(self, venv_path: Path) -> None:
+        template = self.ensure()
+        private = set(_private_files(template))
+        clone_tree(template, venv_path, private=private.__contains__)
+        (venv_path / TEMPLATE_STAMP).unlink()
+        _relocate(venv_path, template, venv_path)
+
+
+CONSOLE_SCRIPT = """#!{python}
+# -*- coding: utf-8 -*-
+import re
+import sys
+from {module} import {name}
+if __name__ == "__main__":
+    sys.argv[0] = re.sub(r"(-script\\.pyw|\\.exe)?$", "", sys.argv[0])
+    sys.exit({call}())
+"""
+
+
+def _record_hash(contents: bytes) -> str:
+    digest = hashlib.sha256(contents).digest()
+    return "sha256=" + base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def resolve_wheels(python: str, find_links: Path, pkgs: List[str], cwd) -> List[Path]:
+    """Have pip resolve pkgs against the wheels in find_links without installing
+    anything, and return the wheel files it would install.
+    """
+    report = Path(cwd) / "install-report.json"
+    cmd = [python, "-m", "pip", "install", "--dry-run", "--quiet"]
+    cmd.extend(["--no-index", "--find-links", str(find_links)])
+    cmd.extend(["--report", str(report)])
+    cmd.extend(pkgs)
+    collect_output(cmd, cwd=cwd)
+    with report.open() as fp:
+        data = json.load(fp)
+    wheels = []
+    for item in data["install"]:
+        url = urlparse(item["download_info"]["url"])
+        path = Path(unquote(url.path))
+        if url.scheme != "file" or path.suffix != ".whl":
+            raise ValueError(f"Not a local wheel: {item['download_info']['url']}")
+        wheels.append(path)
+    return wheels
+
+
+@dataclass
+class _WheelPlan:
+    wheel: Path
+    name: str
+    info_dir: str
+    root: Path
+    # module, attribute path, by console script name
+    entry_points: Dict[str, Tuple[str, str]]
+    # every path the wheel will write, except its own metadata
+    dests: Set[Path]
+
+
+class WheelInstaller:
+    """Install wheels that have already been resolved into a venv, several at a
+    time, without pip.
+
+    This writes what pip would: the files (with `.data` directories mapped to
+    their install schemes), console scripts, byte-compiled modules, and the
+    INSTALLER and RECORD metadata, so pip can check and uninstall the result.
+    Files are replaced atomically, as namespace packages share files between
+    wheels. Every wheel is checked before anything is written, and other
+    versions of the packages are uninstalled before any wheel is unpacked.
+    """
+
+    def __init__(self, python: str, max_workers: Optional[int] = None) -> None:
+        self.python = python
+        self.max_workers = max_workers
+        code = (
+            "import json, sys, sysconfig; "
+            "print(json.dumps([sysconfig.get_paths(), sys.implementation.cache_tag]))"
+        )
+        paths, cache_tag = json.loads(collect_output([python, "-c", code]))
+        self.paths: Dict[str, str] = paths
+        self.cache_tag: str = cache_tag
+
+    def plan(self, wheels: List[Path]) -> List[_WheelPlan]:
+        """Work out where the files of every wheel go, without writing
+        anything. Raises ValueError for a wheel that can't be installed this
+        way, e.g. one with C headers, so the caller can use pip instead.
+        """
+        plans = []
+        for wheel in wheels:
+            try:
+                plans.append(self._plan(wheel))
+            except (KeyError, StopIteration, zipfile.BadZipFile) as exc:
+                raise ValueError(f"Can't install {wheel.name}: {exc!r}") from None
+        return plans
+
+    def install(self, wheels: List[Path]) -> None:
+        self.install_plans(self.plan(wheels))
+
+    def install_plans(self, plans: List[_WheelPlan]) -> None:
+        # files like dbt/__init__.py belong to several packages, so keep the
+        # ones that a new wheel ships when removing the old versions
+        shipped = set().union(*(plan.dests for plan in plans))
+        for plan in plans:
+            self._remove_existing(plan.root, plan.name, keep=shipped)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            # list() so the first error is raised here
+            list(pool.map(self._unpack, plans))
+
+    def install_wheel(self, wheel: Path) -> None:
+        self.install([wheel])
+
+    @staticmethod
+    def _write(dest: Path, contents: bytes, executable: bool) -> None:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(contents)
+        if executable:
+            os.chmod(tmp, 0o755)
+        os.replace(tmp, dest)
+
+    def _remove_existing(self, root: Path, name: str, keep: Set[Path]) -> None:
+        """Uninstall any other version of name, like the pip and setuptools
+        that come with the venv, except for the files in keep.
+        """
+        for info_dir in root.glob("*.dist-info"):
+            metadata = info_dir / "METADATA"
+            if not metadata.exists():
+                continue
+            headers = HeaderParser().parsestr(metadata.read_text())
+            if normalize_name(headers["Name"] or "") != name:
+                continue
+            record = info_dir / "RECORD"
+            if record.exists():
+                with record.open(newline="") as fp:
+                    for row in csv.reader(fp):
+                        path = Path(os.path.normpath(root / row[0]))
+                        if path in keep:
+                            continue
+                        if path.is_file() or path.is_symlink():
+                            path.unlink()
+            shutil.rmtree(info_dir, ignore_errors=True)
+
+    def _dest(self, root: Path, data_dir: str, name: str) -> Tuple[Path, str]:
+        if not name.startswith(data_dir + "/"):
+            return root / name, "lib"
+        _, scheme, rest = name.split("/", 2)
+        # pip puts headers in a per-package directory; none of the wheels dbt
+        # needs have any, so leave those to pip
+        if scheme not in ("purelib", "platlib", "scripts", "data"):
+            raise ValueError(f"Can't install {name}: unsupported scheme {scheme}")
+        return Path(self.paths[scheme]) / rest, scheme
+
+    def _entry_points(
+        self, zf: zipfile.ZipFile, info_dir: str, wheel: Path
+    ) -> Dict[str, Tuple[str, str]]:
+        try:
+            text = zf.read(f"{info_dir}/entry_points.txt").decode("utf-8")
+        except KeyError:
+            return {}
+        parser = ConfigParser(delimiters=("=",), interpolation=None)
+        parser.optionxform = str  # type: ignore
+        parser.read_string(text)
+        scripts = {}
+        for section in ("console_scripts", "gui_scripts"):
+            if not parser.has_section(section):
+                continue
+            for script, target in parser.items(section):
+                module, _, attrs = target.split("[")[0].strip().partition(":")
+                if not module or not attrs:
+                    raise ValueError(
+                        f"Can't install {wheel.name}: the entry point for "
+                        f"{script} must look like module:attr, got {target}"
+                    )
+                scripts[script] = (module.strip(), attrs.strip())
+        return scripts
+
+    def _compile(self, modules: List[Path]) -> List[Tuple[Path, str, int]]:
+        """Byte-compile modules with the venv's python, like pip does, and
+        return the RECORD entries of the results. Like pip, modules that don't
+        compile are left as they are.
+        """
+        if not modules:
+            return []
+        cmd = [self.python, "-m", "compileall", "-q", "-i", "-"]
+        paths = "".join(f"{path}\n" for path in modules)
+        collect_output(cmd, check=False, input=paths)
+        records = []
+        for path in modules:
+            pyc = path.parent / "__pycache__" / f"{path.stem}.{self.cache_tag}.pyc"
+            if pyc.exists():
+                contents = pyc.read_bytes()
+                records.append((pyc, _record_hash(contents), len(contents)))
+        return records
+
+    def _plan(self, wheel: Path) -> _WheelPlan:
+        with zipfile.ZipFile(wheel) as zf:
+            info_dir = next(
+                n.split("/")[0]
+                for n in zf.namelist()
+                if n.split("/")[0].endswith(".dist-info")
+            )
+            parser = HeaderParser()
+            metadata = parser.parsestr(zf.read(f"{info_dir}/METADATA").decode())
+            wheel_info = parser.parsestr(zf.read(f"{info_dir}/WHEEL").decode())
+            purelib = (wheel_info["Root-Is-Purelib"] or "").strip() == "true"
+            root = Path(self.paths["purelib" if purelib else "platlib"])
+            data_dir = info_dir[: -len(".dist-info")] + ".data"
+            dests = {
+                Path(os.path.normpath(self._dest(root, data_dir, m.filename)[0]))
+                for m in zf.infolist()
+                if not m.is_dir() and not m.filename.startswith(info_dir + "/")
+            }
+            entry_points = self._entry_points(zf, info_dir, wheel)
+        scripts = Path(self.paths["scripts"])
+        dests.update(Path(os.path.normpath(scripts / s)) for s in entry_points)
+        return _WheelPlan(
+            wheel=wheel,
+            name=normalize_name(metadata["Name"]),
+            info_dir=info_dir,
+            root=root,
+            entry_points=entry_points,
+            dests=dests,
+        )
+
+    def _unpack(self, plan: _WheelPlan) -> None:
+        root = plan.root
+        info_dir = plan.info_dir
+        with zipfile.ZipFile(plan.wheel) as zf:
+            data_dir = info_dir[: -len(".dist-info")] + ".data"
+            records = []
+            modules = []
+            for member in zf.infolist():
+                if member.is_dir() or member.filename == f"{info_dir}/RECORD":
+                    continue
+                dest, scheme = self._dest(root, data_dir, member.filename)
+                contents = zf.read(member)
+                if scheme == "scripts" and contents.startswith(b"#!python"):
+                    contents = b"#!" + self.python.encode() + contents[8:]
+                mode = member.external_attr >> 16
+                executable = scheme == "scripts" or bool(mode & 0o111)
+                self._write(dest, contents, executable)
+                records.append((dest, _record_hash(contents), len(contents)))
+                if dest.suffix == ".py" and scheme in ("lib", "purelib", "platlib"):
+                    modules.append(dest)
+        records.extend(self._compile(modules))
+
+        for script, (module, attrs) in sorted(plan.entry_points.items()):
+            name = attrs.split(".")[0]
+            contents = CONSOLE_SCRIPT.format(
+                python=self.python, module=module, name=name, call=attrs
+            ).encode("utf-8")
+            dest = Path(self.paths["scripts"]) / script
+            self._write(dest, contents, executable=True)
+            records.append((dest, _record_hash(contents), len(contents)))
+
+        contents = b"dbt-release\n"
+        dest = root / info_dir / "INSTALLER"
+        self._write(dest, contents, executable=False)
+        records.append((dest, _record_hash(contents), len(contents)))
+
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        for dest, digest, size in records:
+            writer.writerow((os.path.relpath(dest, root), digest, size))
+        writer.writerow((f"{info_dir}/RECORD", "", ""))
+        self._write(root / info_dir / "RECORD", out.getvalue().encode(), False)
+
+
 class DBTPackageEnv(EnvBuilder):
     def __init__(
         self,
@@ -67,67 +552,77 @@ class DBTPackageEnv(EnvBuilder):
         self.requirements = requirements
         self.ext = ext
 
-    @staticmethod
-    def is_pkg_name_pattern(filename: str, ending: Optional[str]) -> bool:
-        # wheels are '{name.replace('-', '_')}-{version}-py3-none-any' (for us)
-        # sdists are '{name}-{version}.tar.gz'
-
-        name = "dbt"
-        if filename.endswith(PackageType.Sdist.suffix):
-            namesep = "-"
-            search = r"^{name}-{version}\.tar\.gz$"
-        elif filename.endswith(PackageType.Wheel.suffix):
-            namesep = "_"
-            search = r"^{name}-{version}-py3-none-any\.whl$"
-        else:
-            raise ValueError(f"Unknown suffix: {filename}")
-
-        if ending is not None:
-            name = f"{name}{namesep}{ending}"
-
-        pat = search.format(name=name, version=VERSION_PATTERN_STR)
-        return bool(re.match(pat, filename))
+    def fingerprint_inputs(self) -> List[str]:
+        inputs = super().fingerprint_inputs()
+        if self.requirements is not None:
+            inputs.append(f"requirements:{sha256_file(self.requirements)}")
+        for path in sorted(self.packages):
+            inputs.append(f"{path.name}:{sha256_file(path)}")
+        return inputs
+
+    def get_install_waves(self) -> List[List[Path]]:
+        return install_waves(self.packages)
 
     def get_pkg_install_order(self) -> List[Path]:
         """This method is important regardless of installation method, because
         pip needs to install the dependency first, and find it already
         installed when it goes to install the dependent.
         """
-        core = []
-        plugins = []
-        final = []
-        for package in self.packages:
-            # order matters for these if-statements!
-            if self.is_pkg_name_pattern(package.name, r"core"):
-                core.append(package)
-            elif self.is_pkg_name_pattern(package.name, r"[\w\d-]+"):
-                plugins.append(package)
-            elif self.is_pkg_name_pattern(package.name, None):
-                final.append(package)
-            else:
-                raise ValueError(f"Unmatched package: {package}")
-
-        if len(core) == 0:
-            raise ValueError(f"Could not find package for dbt-core in {self.packages}")
-        if len(final) == 0:
-            raise ValueError(f"Could not find package for dbt in {self.packages}")
-        if len(plugins) != 4:
-            raise ValueError(f"Expected 4 plugins, got {len(plugins)}: {plugins}")
-        # If you sort plugins() by name postgres is before redshift, so it
-        # works
-        plugins.sort(key=lambda p: p.name)
-        return core + plugins + final
+        return [path for wave in self.get_install_waves() for path in wave]
+
+    def install_packages(self, tmp_dir: str, context):
+        waves = self.get_install_waves()
+        if self.requirements is None:
+            # pip still has to resolve everything else, so give it everything
+            pkglist = [path for wave in waves for path in wave]
+            self.dbt_pip_install(tmp_dir, context, *pkglist)
+            return
+        # all the other dependencies are already installed from the pinned
+        # requirements, so each wave only needs one pip run. The plugins share
+        # namespace files (dbt/__init__.py, dbt/adapters/__init__.py), so
+        # several pip runs must never write to site-packages at once.
+        for wave in waves:
+            cmd = [context.env_exe, "-m", "pip", "install", "--upgrade"]
+            cmd.extend(["--no-deps"] + [str(path) for path in wave])
+            stream_output(cmd, cwd=tmp_dir)
 
     def post_dbt_install(self, tmp_dir: str, context):
         pass
 
+    def install_resolved(self, tmp_dir: str, context) -> bool:
+        """Install the pinned requirements and the packages with WheelInstaller,
+        if they can all be resolved from the wheelhouse. Returns whether it
+        did.
+        """
+        if self.requirements is None or self.ext != PackageType.Wheel:
+            return False
+        if not self.use_wheelhouse:
+            return False
+        pkgs = ["-r", str(self.requirements)]
+        wheelhouse = Wheelhouse(EnvironmentInformation().wheelhouse_dir)
+        links = wheelhouse.find_links(context.env_exe, Path(tmp_dir), pkgs)
+        if links is None:
+            return False
+        pkgs.extend(str(p) for p in self.packages)
+        installer = WheelInstaller(context.env_exe)
+        try:
+            wheels = resolve_wheels(context.env_exe, links, pkgs, cwd=tmp_dir)
+            plans = installer.plan(wheels)
+        except (subprocess.CalledProcessError, ValueError) as exc:
+            print(f"Could not install everything from the wheelhouse: {exc}")
+            return False
+        with span("install wheels", count=len(wheels)):
+            installer.install_plans(plans)
+        stream_output([context.env_exe, "-m", "pip", "check"])
+        return True
+
     def post_setup(self, context):
         with tempfile.TemporaryDirectory() as tmp:
-            if self.requirements is not None:
-                requirements = str(self.requirements)
-                self.dbt_pip_install(tmp, context, "-r", requirements)
-            pkglist = self.get_pkg_install_order()
-            self.dbt_pip_install(tmp, context, *pkglist)
+            if not self.install_resolved(tmp, context):
+                if self.requirements is not None:
+                    requirements = str(self.requirements)
+                    self.dbt_pip_install(tmp, context, "-r", requirements)
+                self.install_packages(tmp, context)
 
             self.post_dbt_install(tmp, context)
 
@@ -139,41 +634,70 @@ class DevelopmentWheelEnv(DBTPackageEnv):
         super().__init__(package_dir=package_dir, requirements=requirements)
         self.dev_requirements = dev_requirements.absolute()
 
+    def fingerprint_inputs(self) -> List[str]:
+        inputs = super().fingerprint_inputs()
+        inputs.append(f"dev_requirements:{sha256_file(self.dev_requirements)}")
+        return inputs
+
     def post_dbt_install(self, tmp_dir: str, context):
         self.dbt_pip_install(tmp_dir, context, "-r", str(self.dev_requirements))
 
 
 class PackagingEnv(EnvBuilder):
+    PACKAGES = (
+        "wheel",
+        "setuptools",
+        "virtualenv==20.0.3",
+        "twine",
+    )
+
     def __init__(self):
         super().__init__(with_pip=True, upgrade_deps=True)
 
+    def fingerprint_inputs(self) -> List[str]:
+        return super().fingerprint_inputs() + list(self.PACKAGES)
+
     def post_setup(self, context):
         with tempfile.TemporaryDirectory() as tmp:
-            self.dbt_pip_install(
-                tmp,
-                context,
-                "wheel",
-                "setuptools",
-                "virtualenv==20.0.3",
-                "bumpversion==0.5.3",
-                "twine",
-            )
+            self.dbt_pip_install(tmp, context, *self.PACKAGES)
+
+
+class RequirementsEnv(EnvBuilder):
+    """A venv with PACKAGES and a requirements file installed. The file is
+    installed from its own directory, so relative paths in it (like dbt's
+    `-e ./core`) work.
+    """
 
+    PACKAGES: Tuple[str, ...] = ()
 
-class SchemaArtifactEnv(EnvBuilder):
     def __init__(self, requirements: Path):
         super().__init__(with_pip=True, upgrade_deps=True)
+        self.requirements = requirements.absolute()
+
+    def fingerprint_inputs(self) -> List[str]:
+        inputs = super().fingerprint_inputs() + list(self.PACKAGES)
+        # editable installs point into the checkout, so where it is matters too
+        inputs.append(f"requirements:{self.requirements}")
+        for path in sorted(set(requirements_inputs(self.requirements))):
+            name = os.path.relpath(path, self.requirements.parent)
+            inputs.append(f"{name}:{sha256_file(path)}")
+        return inputs
 
     def post_setup(self, context):
-        with tempfile.TemporaryDirectory() as tmp:
-            self.dbt_pip_install(
-                tmp,
-                context,
-                "wheel",
-                "setuptools",
-                "deepdiff[cli]",
-                "json-schema-for-humans",
-            )
+        if self.PACKAGES:
+            with tempfile.TemporaryDirectory() as tmp:
+                self.dbt_pip_install(tmp, context, *self.PACKAGES)
+        cmd = [context.env_exe, "-m", "pip", "install", "-r", str(self.requirements)]
+        run_with_retry(cmd, PIP_NETWORK, cwd=self.requirements.parent)
+
+
+class SchemaArtifactEnv(RequirementsEnv):
+    PACKAGES = (
+        "wheel",
+        "setuptools",
+        "deepdiff[cli]",
+        "json-schema-for-humans",
+    )
 
 
 class PipInstalledDbtEnv(EnvBuilder):
@@ -181,6 +705,9 @@ class PipInstalledDbtEnv(EnvBuilder):
         super().__init__(with_pip=True, upgrade_deps=True)
         self.dbt_version = dbt_version
 
+    def fingerprint_inputs(self) -> List[str]:
+        return super().fingerprint_inputs() + [f"dbt=={self.dbt_version}"]
+
     def post_setup(self, context):
         with tempfile.TemporaryDirectory() as tmp:
             self.dbt_pip_install(tmp, context, f"dbt=={self.dbt_version}")
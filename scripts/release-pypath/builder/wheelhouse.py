@@ -0,0 +1,209 @@
+"""A local directory of wheels that builder venvs install from.
+
+The first install of a requirements set resolves it with `pip wheel` (which
+also builds any sdists into wheels) into a directory of its own, and records
+the set as complete. Later installs of the same set use `--no-index
+--find-links` with that directory, so they don't touch the network and get
+exactly the wheels the set resolved to, rather than the newest matching wheel
+that any set brought in. Sets that aren't fully pinned are resolved again once
+they are a day old, to pick up new releases. Pinned requirements
+(`name==version`) are fetched concurrently before pip resolves the rest.
+
+All wheels are also kept in `wheels/`, where the sets' directories share
+storage with them and later sets find them without downloading them again.
+
+Sets are keyed by their arguments, the contents of any requirement files or
+local packages they name, and the interpreter. Requirements that refer to
+local source trees (`-e`, directories, VCS URLs) can change without their
+specifier changing, so installs that use them bypass the wheelhouse.
+"""
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from .cmd import CommandExecutor, PIP_NETWORK, run_with_retry
+from .pypi import truthy
+from .staging import sha256_file, stage_file
+
+_PINNED = re.compile(
+    r"^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)(\[[^\]]*\])?"
+    r"\s*==\s*(?P<version>[^\s;]+)\s*(;.*)?$"
+)
+# editable installs, pip options (like -c or --index-url) and VCS URLs
+_UNCACHEABLE = ("-", "git+", "hg+", "svn+", "bzr+")
+
+# how long a set with unpinned requirements is used before resolving it again
+UNPINNED_MAX_AGE = 24 * 60 * 60
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _requirement_lines(path: Path) -> Iterator[str]:
+    """The requirements in a requirements file, following `-r` includes."""
+    for line in path.read_text().splitlines():
+        line = line.split(" #", 1)[0].strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith(("-r ", "--requirement ")):
+            yield from _requirement_lines(path.parent / line.split(None, 1)[1])
+        else:
+            yield line
+
+
+class Wheelhouse:
+    def __init__(
+        self,
+        root: Path,
+        offline: Optional[bool] = None,
+        max_age: float = UNPINNED_MAX_AGE,
+    ) -> None:
+        if offline is None:
+            offline = truthy(os.getenv("DBT_RELEASE_OFFLINE"))
+        self.root = root
+        self.wheel_dir = root / "wheels"
+        self.sets_dir = root / "sets"
+        self.offline = offline
+        self.max_age = max_age
+
+    def _requirements(self, cwd: Path, pkgs: Sequence[str]) -> Optional[List[str]]:
+        """Flatten the pip arguments into requirement lines, or return None if
+        they can't be cached.
+        """
+        lines: List[str] = []
+        args = iter(pkgs)
+        for arg in args:
+            if arg in ("-r", "--requirement"):
+                lines.extend(_requirement_lines(cwd / next(args)))
+            else:
+                lines.append(arg)
+        for line in lines:
+            if line.startswith(_UNCACHEABLE) or (cwd / line).is_dir():
+                return None
+        return lines
+
+    def _key(self, cwd: Path, pkgs: Sequence[str], lines: List[str]) -> str:
+        value = hashlib.sha256()
+        for part in (sys.version, platform.system(), platform.machine()):
+            value.update(part.encode("utf-8") + b"\0")
+        for item in list(pkgs) + lines:
+            path = cwd / item
+            if path.is_file():
+                item = f"{path.name}:{sha256_file(path)}"
+            value.update(item.encode("utf-8") + b"\0")
+        return value.hexdigest()
+
+    def _has_wheel(self, name: str, version: str) -> bool:
+        for path in self.wheel_dir.glob("*.whl"):
+            parts = path.name.split("-")
+            if _normalize(parts[0]) == _normalize(name) and parts[1] == version:
+                return True
+        return False
+
+    def _fetch_pinned(self, python: str, cwd: Path, lines: List[str]) -> None:
+        executor = CommandExecutor(max_workers=8)
+        for line in lines:
+            match = _PINNED.match(line)
+            if match is None:
+                continue
+            if self._has_wheel(match.group("name"), match.group("version")):
+                continue
+            cmd = [python, "-m", "pip", "wheel", "--no-deps", "--quiet"]
+            cmd.extend(["--wheel-dir", str(self.wheel_dir), line])
+            executor.submit(cmd, cwd=cwd, name=match.group("name"), retry=PIP_NETWORK)
+        executor.run()
+
+    def _is_fresh(self, stamp: Path, lines: List[str]) -> bool:
+        try:
+            age = time.time() - stamp.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        if all(_PINNED.match(line) for line in lines):
+            return True
+        return age < self.max_age
+
+    def _share(self, set_dir: Path) -> List[str]:
+        """Make the wheels in set_dir share storage with the ones in wheel_dir,
+        adding the new ones to it, and return their names.
+        """
+        names = []
+        for path in sorted(set_dir.glob("*.whl")):
+            shared = self.wheel_dir / path.name
+            if shared.exists():
+                stage_file(shared, path)
+            else:
+                stage_file(path, shared)
+            names.append(path.name)
+        return names
+
+    def _replace(self, new: Path, set_dir: Path) -> None:
+        if set_dir.exists():
+            stale = Path(tempfile.mkdtemp(dir=self.sets_dir, prefix=".stale."))
+            os.rename(set_dir, stale / set_dir.name)
+            shutil.rmtree(stale)
+        try:
+            os.rename(new, set_dir)
+        except OSError:
+            # fine if another build got there first
+            if not set_dir.exists():
+                raise
+
+    def find_links(
+        self, python: str, cwd: Path, pkgs: Sequence[str]
+    ) -> Optional[Path]:
+        """Make sure the wheelhouse has everything needed to install pkgs with
+        python, and return the directory to install from. Returns None if pkgs
+        can't be installed from the wheelhouse.
+        """
+        lines = self._requirements(cwd, pkgs)
+        if lines is None:
+            return None
+        key = self._key(cwd, pkgs, lines)
+        stamp = self.sets_dir / f"{key}.json"
+        set_dir = self.sets_dir / key
+        if self._is_fresh(stamp, lines) and set_dir.is_dir():
+            return set_dir
+        if self.offline:
+            if stamp.exists() and set_dir.is_dir():
+                print(f"Using the old resolution of {' '.join(pkgs)} while offline")
+                return set_dir
+            raise LookupError(
+                f"The wheelhouse in {self.root} doesn't have {' '.join(pkgs)} "
+                "and offline mode is enabled"
+            )
+
+        print(f"Filling the wheelhouse in {self.root} for {' '.join(pkgs)}")
+        self.wheel_dir.mkdir(parents=True, exist_ok=True)
+        self.sets_dir.mkdir(parents=True, exist_ok=True)
+        self._fetch_pinned(python, cwd, lines)
+        tmp = Path(tempfile.mkdtemp(dir=self.sets_dir, prefix=f".{key}."))
+        try:
+            # resolve the full set, reusing what is already there
+            cmd = [python, "-m", "pip", "wheel", "--wheel-dir", str(tmp)]
+            cmd.extend(["--find-links", str(self.wheel_dir)])
+            cmd.extend(pkgs)
+            if any(line.endswith((".tar.gz", ".zip")) for line in lines):
+                # installing an sdist offline needs its build requirements
+                cmd.extend(["setuptools", "wheel"])
+            run_with_retry(cmd, PIP_NETWORK, cwd=cwd)
+            wheels = self._share(tmp)
+            self._replace(tmp, set_dir)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp)
+
+        fd, tmp_stamp = tempfile.mkstemp(dir=self.sets_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            data = {"args": list(pkgs), "requirements": lines, "wheels": wheels}
+            json.dump(data, fp, indent=2)
+        os.replace(tmp_stamp, stamp)
+        return set_dir
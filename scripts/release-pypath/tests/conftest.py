@@ -0,0 +1,150 @@
+"""Fixtures shared by the builder tests.
+
+`local_index` is a stand-in for a package index, served by `http.server` on
+localhost, so the tests never touch pypi.org. Besides fixed pages (like the
+JSON API), it serves a PEP 503 simple API for the files uploaded to it, and
+the files themselves.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set
+import hashlib
+import json
+import threading
+
+import pytest
+
+from builder.upload import project_name
+
+
+class Page(NamedTuple):
+    body: bytes
+    content_type: str
+    etag: Optional[str]
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    headers: Dict[str, str]
+
+
+class LocalIndex:
+    def __init__(self) -> None:
+        self.pages: Dict[str, Page] = {}
+        self.requests: List[Request] = []
+        self.files: Dict[str, bytes] = {}
+        # the filenames in the order they were uploaded
+        self.uploads: List[str] = []
+        # filenames to store, but answer with a 500 (as many times as given)
+        self.lost_responses: Dict[str, int] = {}
+        # filenames to reject without storing them
+        self.rejected: Set[str] = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def add_json(self, path: str, data, etag: Optional[str] = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.pages[path] = Page(body, "application/json", etag)
+
+    def paths(self, method: str = "GET") -> List[str]:
+        return [r.path for r in self.requests if r.method == method]
+
+    def simple_page(self, project: str) -> Optional[bytes]:
+        links = [
+            f'<a href="/files/{name}#sha256={hashlib.sha256(body).hexdigest()}">'
+            f"{name}</a>"
+            for name, body in sorted(self.files.items())
+            if project_name(Path(name)) == project
+        ]
+        if not links:
+            return None
+        return ("<html><body>" + "\n".join(links) + "</body></html>").encode()
+
+    def get(self, path: str, headers: Dict[str, str]):
+        """Return the status, headers and body of a GET request."""
+        if path.startswith("/simple/"):
+            body = self.simple_page(path[len("/simple/") :].strip("/"))
+            if body is None:
+                return 404, {}, b"Not Found"
+            return 200, {"Content-Type": "text/html"}, body
+        if path.startswith("/files/"):
+            body = self.files.get(path[len("/files/") :])
+            if body is None:
+                return 404, {}, b"Not Found"
+            return 200, {"Content-Type": "application/octet-stream"}, body
+        page = self.pages.get(path)
+        if page is None:
+            return 404, {}, b"Not Found"
+        if page.etag is not None and headers.get("If-None-Match") == page.etag:
+            return 304, {"ETag": page.etag}, b""
+        response_headers = {"Content-Type": page.content_type}
+        if page.etag is not None:
+            response_headers["ETag"] = page.etag
+        return 200, response_headers, page.body
+
+    def upload(self, filename: str, body: bytes) -> int:
+        """Store an uploaded file and return the status to answer with."""
+        if filename in self.rejected:
+            return 400
+        if filename in self.files:
+            return 409
+        self.files[filename] = body
+        self.uploads.append(filename)
+        if self.lost_responses.get(filename):
+            self.lost_responses[filename] -= 1
+            return 500
+        return 200
+
+    def _handler(self):
+        index = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, status, headers, body):
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                headers = dict(self.headers.items())
+                with index.lock:
+                    index.requests.append(Request("GET", self.path, headers))
+                    response = index.get(self.path, headers)
+                self._respond(*response)
+
+            def do_POST(self):
+                headers = dict(self.headers.items())
+                body = self.rfile.read(int(headers["Content-Length"]))
+                with index.lock:
+                    index.requests.append(Request("POST", self.path, headers))
+                    status = index.upload(headers["X-Filename"], body)
+                self._respond(status, {}, b"")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> None:
+        thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+        thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def local_index():
+    index = LocalIndex()
+    index.start()
+    yield index
+    index.stop()
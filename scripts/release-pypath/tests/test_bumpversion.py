@@ -0,0 +1,99 @@
+from pathlib import Path
+import textwrap
+
+import pytest
+
+from builder.bumpversion import BumpversionConfig, set_version
+
+CONFIG = """\
+[bumpversion]
+current_version = 0.20.0rc1
+parse = (?P<major>\\d+)\\.(?P<minor>\\d+)\\.(?P<patch>\\d+)
+commit = False
+
+[bumpversion:file:core/setup.py]
+
+[bumpversion:file:core/dbt/version.py]
+search = __version__ = '{current_version}'
+replace = __version__ = '{new_version}'
+
+[bumpversion:file:docker/requirements.txt]
+search = dbt-core%={current_version}
+replace = dbt-core%={new_version}
+"""
+
+
+@pytest.fixture
+def checkout(tmp_path: Path) -> Path:
+    files = {
+        ".bumpversion.cfg": CONFIG,
+        "core/setup.py": 'package_version = "0.20.0rc1"\n',
+        "core/dbt/version.py": "__version__ = '0.20.0rc1'\nother = '0.20.0rc1'\n",
+        "docker/requirements.txt": "dbt-core%=0.20.0rc1\r\n",
+    }
+    for name, contents in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(contents.encode("utf-8"))
+    return tmp_path
+
+
+def test_config(checkout):
+    config = BumpversionConfig.from_dir(checkout)
+    assert config.current_version == "0.20.0rc1"
+    assert [(f.path, f.search, f.replace) for f in config.files] == [
+        ("core/setup.py", "{current_version}", "{new_version}"),
+        (
+            "core/dbt/version.py",
+            "__version__ = '{current_version}'",
+            "__version__ = '{new_version}'",
+        ),
+        (
+            "docker/requirements.txt",
+            "dbt-core%={current_version}",
+            "dbt-core%={new_version}",
+        ),
+    ]
+
+
+def test_set_version(checkout):
+    changed = set_version(checkout, "0.20.0")
+    assert sorted(p.relative_to(checkout).as_posix() for p in changed) == [
+        ".bumpversion.cfg",
+        "core/dbt/version.py",
+        "core/setup.py",
+        "docker/requirements.txt",
+    ]
+    assert (checkout / "core/setup.py").read_text() == 'package_version = "0.20.0"\n'
+    # only the search string is replaced
+    assert (checkout / "core/dbt/version.py").read_text() == textwrap.dedent(
+        """\
+        __version__ = '0.20.0'
+        other = '0.20.0rc1'
+        """
+    )
+    # line endings are kept
+    assert (checkout / "docker/requirements.txt").read_bytes() == (
+        b"dbt-core%=0.20.0\r\n"
+    )
+    config = (checkout / ".bumpversion.cfg").read_text()
+    assert config == CONFIG.replace(
+        "current_version = 0.20.0rc1", "current_version = 0.20.0"
+    )
+    assert BumpversionConfig.from_dir(checkout).current_version == "0.20.0"
+
+
+def test_missing_search_writes_nothing(checkout):
+    before = {p: p.read_bytes() for p in checkout.rglob("*") if p.is_file()}
+    (checkout / "docker/requirements.txt").write_text("dbt-core==0.19.0\n")
+    before[checkout / "docker/requirements.txt"] = b"dbt-core==0.19.0\n"
+    with pytest.raises(ValueError, match="dbt-core%=0.20.0rc1"):
+        set_version(checkout, "0.20.0")
+    assert {p: p.read_bytes() for p in checkout.rglob("*") if p.is_file()} == before
+
+
+def test_unsupported_template_variable(checkout):
+    config = checkout / ".bumpversion.cfg"
+    config.write_text(config.read_text().replace("{new_version}'", "{release}'"))
+    with pytest.raises(ValueError, match="Unsupported variable"):
+        set_version(checkout, "0.20.0")
@@ -0,0 +1,31 @@
+from pathlib import Path
+from typing import List
+import time
+
+from builder.cmd import CommandExecutor, CommandResult, RetryPolicy
+
+# fails with a transient error the first time it runs in a directory
+FLAKY = (
+    "if [ -e attempted ]; then exit 0; fi; "
+    "touch attempted; echo 'Connection reset by peer' >&2; exit 1"
+)
+
+
+def test_retry_backoff_does_not_hold_a_slot(tmp_path: Path):
+    retry = RetryPolicy(name="test", base_delay=0.5, patterns=("connection reset",))
+    finished: List[str] = []
+
+    def on_exit(result: CommandResult) -> None:
+        finished.append(result.name)
+
+    executor = CommandExecutor(max_workers=1)
+    executor.submit(
+        ["sh", "-c", FLAKY], cwd=tmp_path, name="flaky", retry=retry, on_exit=on_exit
+    )
+    executor.submit(["true"], name="quick", on_exit=on_exit)
+    started = time.monotonic()
+    results = executor.run()
+    assert [r.attempts for r in results] == [2, 1]
+    # the quick command ran while the flaky one waited to retry
+    assert finished == ["quick", "flaky"]
+    assert time.monotonic() - started < 5
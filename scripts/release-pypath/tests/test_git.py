@@ -0,0 +1,170 @@
+from pathlib import Path
+import shutil
+import subprocess
+
+import pytest
+
+from builder.git import (
+    FULL_CLONE,
+    SCHEMAS_CLONE,
+    DbtRepository,
+    GitMirror,
+    Repository,
+)
+
+
+def git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=repo, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout.strip()
+
+
+@pytest.fixture(autouse=True)
+def environment(tmp_path: Path, monkeypatch) -> None:
+    for kind in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{kind}_NAME", "test")
+        monkeypatch.setenv(f"GIT_{kind}_EMAIL", "test@example.com")
+    monkeypatch.setenv("DBT_RELEASE_CACHE_DIR", str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def work(tmp_path: Path) -> Path:
+    """A clone of the remote to make changes in."""
+    remote = tmp_path / "remotes/dbt.git"
+    remote.mkdir(parents=True)
+    git(remote, "init", "--quiet", "--bare", "--initial-branch=main")
+    work = tmp_path / "work"
+    work.mkdir()
+    git(work, "init", "--quiet", "--initial-branch=main")
+    (work / "README.md").write_text("dbt\n")
+    (work / "dbt").mkdir()
+    (work / "dbt/manifest.json").write_text("{}\n")
+    (work / "docs").mkdir()
+    (work / "docs/index.md").write_text("docs\n")
+    git(work, "add", "README.md", "dbt", "docs")
+    git(work, "commit", "--quiet", "-m", "first")
+    git(work, "remote", "add", "origin", remote.as_uri())
+    git(work, "push", "--quiet", "origin", "main")
+    return work
+
+
+@pytest.fixture
+def url(work: Path) -> str:
+    return git(work, "remote", "get-url", "origin")
+
+
+def remote_branches(mirror: GitMirror):
+    output = git(mirror.path, "for-each-ref", "--format=%(refname)", "refs/remotes")
+    return sorted(output.split())
+
+
+def test_update_creates_the_mirror(tmp_path, url, work):
+    mirror = GitMirror(tmp_path / "cache/git", url)
+    assert not mirror.exists()
+    mirror.update()
+    assert mirror.exists()
+    assert git(mirror.path, "rev-parse", "--is-bare-repository") == "true"
+    head = git(work, "rev-parse", "HEAD")
+    assert git(mirror.path, "rev-parse", "origin/main") == head
+    assert mirror.default_branch() == "main"
+
+
+def test_update_fetches_new_commits_and_prunes(tmp_path, url, work):
+    mirror = GitMirror(tmp_path / "cache/git", url)
+    git(work, "checkout", "--quiet", "-b", "feature")
+    git(work, "push", "--quiet", "origin", "feature")
+    mirror.update()
+    assert "refs/remotes/origin/feature" in remote_branches(mirror)
+
+    git(work, "checkout", "--quiet", "main")
+    git(work, "commit", "--quiet", "--allow-empty", "-m", "second")
+    git(work, "push", "--quiet", "origin", "main", ":feature")
+    mirror.update()
+    assert "refs/remotes/origin/feature" not in remote_branches(mirror)
+    head = git(work, "rev-parse", "HEAD")
+    assert git(mirror.path, "rev-parse", "origin/main") == head
+
+
+def test_reference_clone_works_without_the_mirror(tmp_path, url, work):
+    repository = Repository(tmp_path / "build/dbt", url)
+    assert repository.mirror is not None
+    repository.mirror.update()
+    cmd = repository.clone_command()
+    assert "--reference-if-able" in cmd and "--dissociate" in cmd
+    subprocess.run(cmd, check=True)
+    repository.finish_clone()
+
+    shutil.rmtree(repository.mirror.path)
+    clone = repository.path
+    assert not (clone / ".git/objects/info/alternates").exists()
+    git(clone, "fsck", "--no-progress")
+    assert git(clone, "rev-parse", "HEAD") == git(work, "rev-parse", "HEAD")
+    assert (clone / "README.md").read_text() == "dbt\n"
+
+
+def test_worktrees_share_the_mirror_without_local_branches(tmp_path, url, work):
+    first = Repository(tmp_path / "build/first", url)
+    second = Repository(tmp_path / "build/second", url)
+    first.clone(branch="main", profile=FULL_CLONE)
+    second.clone(branch="main", profile=SCHEMAS_CLONE)
+    assert first.is_worktree and second.is_worktree
+    mirror = first.mirror
+    assert mirror is not None
+    assert git(mirror.path, "for-each-ref", "refs/heads") == ""
+    # the sparse checkout only applies to the worktree that asked for it
+    assert not (second.path / "docs").exists()
+    assert (second.path / "dbt/manifest.json").exists()
+    assert (first.path / "docs/index.md").exists()
+    assert git(mirror.path, "config", "--list").count("sparsecheckout") == 0
+    assert git(first.path, "rev-parse", "--is-bare-repository") == "false"
+    assert git(mirror.path, "rev-parse", "--is-bare-repository") == "true"
+
+
+def test_worktree_pushes_a_new_branch(tmp_path, url, work):
+    repository = Repository(tmp_path / "build/dbt", url)
+    repository.clone(branch="main")
+    repository.checkout_branch("release-1", new=True)
+    git(repository.path, "commit", "--quiet", "--allow-empty", "-m", "release")
+    repository.push_updates()
+    head = git(repository.path, "rev-parse", "HEAD")
+    assert git(work, "ls-remote", "origin", "refs/heads/release-1").split()[0] == head
+    assert git(repository.mirror.path, "for-each-ref", "refs/heads") == ""
+
+
+def test_commit_files_makes_one_commit(tmp_path):
+    repository = DbtRepository(tmp_path / "dbt")
+    path = repository.path
+    path.mkdir()
+    git(path, "init", "--quiet", "--initial-branch=main")
+    (path / "CHANGELOG.md").write_text("## dbt 0.20.0 (Release TBD)\n")
+    (path / "run.sh").write_text("#!/bin/sh\n")
+    (path / "run.sh").chmod(0o755)
+    git(path, "add", "CHANGELOG.md", "run.sh")
+    git(path, "commit", "--quiet", "-m", "first")
+    parent = git(path, "rev-parse", "HEAD")
+
+    # modes on disk don't count for tracked files, e.g. on a checkout
+    # without core.fileMode
+    git(path, "config", "core.fileMode", "false")
+    (path / "CHANGELOG.md").write_text("## dbt 0.20.0 (July 12, 2021)\n")
+    (path / "CHANGELOG.md").chmod(0o755)
+    (path / "run.sh").write_text("#!/bin/sh\necho\n")
+    (path / "run.sh").chmod(0o644)
+    (path / "requirements.txt").write_text("six==1.16.0\n")
+    (path / "notes.txt").write_text("not part of the release\n")
+    paths = [path / "CHANGELOG.md", path / "run.sh", path / "requirements.txt"]
+    repository.commit_files(paths, "Release dbt v0.20.0")
+
+    assert git(path, "rev-list", "--count", f"{parent}..HEAD") == "1"
+    assert git(path, "rev-parse", "HEAD^") == parent
+    assert git(path, "log", "-1", "--format=%s") == "Release dbt v0.20.0"
+    assert git(path, "symbolic-ref", "--short", "HEAD") == "main"
+    tree = git(path, "ls-tree", "HEAD").splitlines()
+    modes = {line.split("\t")[1]: line.split()[0] for line in tree}
+    assert modes == {
+        "CHANGELOG.md": "100644",
+        "requirements.txt": "100644",
+        "run.sh": "100755",
+    }
+    assert git(path, "show", "HEAD:run.sh") == "#!/bin/sh\necho"
+    assert git(path, "status", "--porcelain") == "?? notes.txt"
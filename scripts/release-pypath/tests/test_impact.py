@@ -0,0 +1,81 @@
+from pathlib import Path
+import subprocess
+
+import pytest
+
+from builder.impact import ALL_SUITES, compute_impact
+
+BUMPVERSION_CFG = """\
+[bumpversion]
+current_version = {version}
+
+[bumpversion:file:core/setup.py]
+
+[bumpversion:file:plugins/snowflake/setup.py]
+"""
+
+SETUP_PY = """\
+package_version = "{version}"
+install_requires = [
+    "dbt-core=={{}}".format(package_version),
+    "snowflake-connector-python{pin}",
+]
+"""
+
+
+def git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=repo, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout.strip()
+
+
+def write_release(repo: Path, version: str, pin: str = "==2.3.6") -> None:
+    (repo / ".bumpversion.cfg").write_text(BUMPVERSION_CFG.format(version=version))
+    for path in ("core/setup.py", "plugins/snowflake/setup.py"):
+        (repo / path).parent.mkdir(parents=True, exist_ok=True)
+        (repo / path).write_text(SETUP_PY.format(version=version, pin=pin))
+
+
+def commit(repo: Path, message: str) -> str:
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", message)
+    return git(repo, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def repo(tmp_path: Path) -> Path:
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "config", "user.name", "test")
+    git(tmp_path, "config", "user.email", "test@example.com")
+    write_release(tmp_path, "0.19.0")
+    (tmp_path / "test/integration").mkdir(parents=True)
+    (tmp_path / "test/integration/base.py").write_text("# harness\n")
+    return tmp_path
+
+
+def selected(repo: Path, base: str):
+    return compute_impact(repo, base, list(ALL_SUITES)).selected
+
+
+def test_version_bump_alone_runs_nothing(repo):
+    base = commit(repo, "0.19.0")
+    write_release(repo, "0.19.1")
+    commit(repo, "0.19.1")
+    assert selected(repo, base) == []
+
+
+def test_dependency_change_in_a_version_file_runs_its_suite(repo):
+    base = commit(repo, "0.19.0")
+    write_release(repo, "0.19.1")
+    (repo / "plugins/snowflake/setup.py").write_text(
+        SETUP_PY.format(version="0.19.1", pin="==2.4.1")
+    )
+    commit(repo, "0.19.1")
+    assert selected(repo, base) == ["snowflake"]
+
+
+def test_integration_harness_change_runs_everything(repo):
+    base = commit(repo, "0.19.0")
+    (repo / "test/integration/base.py").write_text("# harness, changed\n")
+    commit(repo, "harness")
+    assert selected(repo, base) == list(ALL_SUITES)
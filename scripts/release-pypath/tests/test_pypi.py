@@ -0,0 +1,98 @@
+from pathlib import Path
+import os
+
+import pytest
+
+from builder.pypi import PypiMetadataCache
+
+
+def release_data(version: str):
+    return {"info": {"version": version}, "urls": []}
+
+
+@pytest.fixture
+def cache(tmp_path: Path, local_index) -> PypiMetadataCache:
+    return PypiMetadataCache(
+        tmp_path / "pypi", index_url=f"{local_index.url}/pypi", offline=False
+    )
+
+
+def test_release_entries_are_fetched_once(cache, local_index):
+    local_index.add_json("/pypi/dbt/0.19.0/json", release_data("0.19.0"))
+    assert cache.get("dbt", "0.19.0")["info"]["version"] == "0.19.0"
+    assert cache.get("dbt", "0.19.0")["info"]["version"] == "0.19.0"
+    assert local_index.paths() == ["/pypi/dbt/0.19.0/json"]
+
+
+def test_project_entries_expire_after_ttl(cache, local_index):
+    local_index.add_json("/pypi/dbt/json", release_data("0.19.0"))
+    cache.get("dbt")
+    cache.get("dbt")
+    assert local_index.paths() == ["/pypi/dbt/json"]
+
+    local_index.add_json("/pypi/dbt/json", release_data("0.19.1"))
+    cache.ttl = 0
+    assert cache.get("dbt")["info"]["version"] == "0.19.1"
+    assert local_index.paths() == ["/pypi/dbt/json", "/pypi/dbt/json"]
+
+
+def test_expired_entries_are_revalidated_with_etag(cache, local_index):
+    local_index.add_json("/pypi/dbt/json", release_data("0.19.0"), etag='"v1"')
+    cache.ttl = 0
+    cache.get("dbt")
+    # the server answers 304, so the cached data is kept
+    assert cache.get("dbt")["info"]["version"] == "0.19.0"
+    revalidation = local_index.requests[-1]
+    assert revalidation.headers.get("If-None-Match") == '"v1"'
+
+    local_index.add_json("/pypi/dbt/json", release_data("0.19.1"), etag='"v2"')
+    assert cache.get("dbt")["info"]["version"] == "0.19.1"
+
+
+def test_refresh_revalidates_release_entries(cache, local_index):
+    local_index.add_json("/pypi/dbt/0.19.0/json", release_data("0.19.0"), etag='"a"')
+    cache.get("dbt", "0.19.0")
+    cache.get("dbt", "0.19.0", refresh=True)
+    assert len(local_index.paths()) == 2
+    assert local_index.requests[-1].headers.get("If-None-Match") == '"a"'
+
+
+def test_least_recently_used_entries_are_evicted(cache, local_index):
+    for name in ("a", "b", "c"):
+        local_index.add_json(f"/pypi/{name}/1.0/json", release_data("1.0"))
+    a_path = cache._entry_path("a", "1.0")
+    b_path = cache._entry_path("b", "1.0")
+    cache.get("a", "1.0")
+    cache.get("b", "1.0")
+    cache.max_bytes = int(a_path.stat().st_size * 2.5)
+    os.utime(a_path, (1000, 1000))
+    os.utime(b_path, (2000, 2000))
+    # a hit makes a the most recently used entry
+    cache.get("a", "1.0")
+    cache.get("c", "1.0")
+
+    assert a_path.exists()
+    assert not b_path.exists()
+    assert cache._entry_path("c", "1.0").exists()
+
+
+def test_offline_mode_only_uses_the_cache(cache, local_index):
+    local_index.add_json("/pypi/dbt/json", release_data("0.19.0"))
+    local_index.add_json("/pypi/dbt/0.19.0/json", release_data("0.19.0"))
+    cache.get("dbt")
+    offline = PypiMetadataCache(
+        cache.cache_dir, index_url=cache.index_url, ttl=0, offline=True
+    )
+    # expired entries are still used
+    assert offline.get("dbt")["info"]["version"] == "0.19.0"
+    assert offline.get("dbt", refresh=True)["info"]["version"] == "0.19.0"
+    with pytest.raises(LookupError):
+        offline.get("dbt", "0.19.0")
+    assert local_index.paths() == ["/pypi/dbt/json"]
+
+
+def test_offline_mode_from_the_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("DBT_RELEASE_OFFLINE", "1")
+    assert PypiMetadataCache(tmp_path).offline
+    monkeypatch.setenv("DBT_RELEASE_OFFLINE", "0")
+    assert not PypiMetadataCache(tmp_path).offline
@@ -0,0 +1,33 @@
+from pathlib import Path
+import os
+import stat
+
+import pytest
+
+from builder.artifacts import ArtifactStore
+from builder.staging import new_file_mode, stage_file
+
+
+def mode(path: Path) -> int:
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@pytest.mark.parametrize("allow_hardlink", [True, False])
+def test_stage_file_keeps_the_mode(tmp_path, allow_hardlink):
+    source = tmp_path / "dbt-core.tar.gz"
+    source.write_bytes(b"sdist")
+    source.chmod(0o644)
+    dest = tmp_path / "dist/dbt-core.tar.gz"
+    stage_file(source, dest, allow_hardlink=allow_hardlink)
+    assert dest.read_bytes() == b"sdist"
+    assert mode(dest) == 0o644
+
+
+def test_written_artifacts_are_not_private(tmp_path):
+    store = ArtifactStore(tmp_path / "artifacts")
+    path = store.root / "release.txt"
+    with store.write(path) as fp:
+        fp.write("version=0.21.0\n")
+    assert store.get("release.txt") == path
+    assert mode(path) == new_file_mode()
+    assert mode(store.index_path) == new_file_mode()
@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import pytest
+
+from builder import timings
+from builder.timings import DurationHistory, xdist_workers
+
+GB = 1024 ** 3
+
+
+def history(tmp_path: Path, durations) -> DurationHistory:
+    result = DurationHistory(tmp_path / "durations.json")
+    result.update(durations)
+    result.save()
+    return DurationHistory(tmp_path / "durations.json")
+
+
+def test_slowest_first_estimates_unknown_tests_as_the_median(tmp_path):
+    known = history(tmp_path, {"a": 1.0, "b": 5.0, "c": 3.0})
+    assert known.slowest_first(["a", "b", "c", "new"]) == ["b", "c", "new", "a"]
+
+
+def test_shards_are_balanced_by_duration(tmp_path):
+    known = history(tmp_path, {"a": 10.0, "b": 6.0, "c": 5.0, "d": 1.0})
+    shards = [known.shard("abcd", index, 2) for index in range(2)]
+    assert shards == [["a", "d"], ["b", "c"]]
+
+
+def test_shards_without_durations_split_by_count():
+    nodeids = [f"test_{n}" for n in "edcba"]
+    shards = [DurationHistory().shard(nodeids, index, 2) for index in range(2)]
+    assert shards == [["test_a", "test_c", "test_e"], ["test_b", "test_d"]]
+    # the order the tests were collected in doesn't matter
+    assert DurationHistory().shard(sorted(nodeids), 0, 2) == shards[0]
+
+
+def test_every_test_is_in_exactly_one_shard(tmp_path):
+    known = history(tmp_path, {f"t{n}": float(n % 7) for n in range(50)})
+    nodeids = [f"t{n}" for n in range(60)]
+    shards = [known.shard(nodeids, index, 4) for index in range(4)]
+    assert sorted(n for shard in shards for n in shard) == sorted(nodeids)
+
+
+def test_invalid_shard():
+    with pytest.raises(ValueError):
+        DurationHistory().shard(["a"], 2, 2)
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    def configure(cores: int, memory):
+        monkeypatch.setattr(
+            timings.os, "sched_getaffinity", lambda pid: range(cores), raising=False
+        )
+        monkeypatch.setattr(timings, "_available_memory", lambda: memory)
+
+    return configure
+
+
+def test_xdist_workers_keeps_a_floor_on_small_runners(machine):
+    machine(cores=2, memory=7 * GB)
+    assert xdist_workers() == 4
+
+
+def test_xdist_workers_uses_more_cores(machine):
+    machine(cores=16, memory=64 * GB)
+    assert xdist_workers() == 16
+    assert xdist_workers(concurrent_suites=4) == 4
+
+
+def test_xdist_workers_is_limited_by_memory(machine):
+    machine(cores=2, memory=3 * GB)
+    assert xdist_workers() == 3
+    machine(cores=16, memory=8 * GB)
+    assert xdist_workers(concurrent_suites=4) == 2
+    machine(cores=2, memory=GB // 2)
+    assert xdist_workers() == 1
+    machine(cores=2, memory=None)
+    assert xdist_workers(concurrent_suites=2) == 4
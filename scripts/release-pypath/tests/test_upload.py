@@ -0,0 +1,158 @@
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Sequence
+import io
+import json
+import os
+import stat
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+from builder.cmd import TWINE_UPLOAD
+from builder.upload import Uploader
+
+# Stands in for twine: posts the file to TWINE_REPOSITORY_URL and reports
+# errors the way twine does.
+FAKE_TWINE = """\
+import os, sys, urllib.error, urllib.request
+
+command, *args = sys.argv[1:]
+if command == "check":
+    sys.exit(0)
+skip_existing = "--skip-existing" in args
+path = [a for a in args if not a.startswith("-")][0]
+with open(path, "rb") as fp:
+    body = fp.read()
+request = urllib.request.Request(
+    os.environ["TWINE_REPOSITORY_URL"],
+    data=body,
+    headers={"X-Filename": os.path.basename(path)},
+)
+try:
+    urllib.request.urlopen(request)
+except urllib.error.HTTPError as exc:
+    if exc.code == 409 and skip_existing:
+        print(f"Skipping {os.path.basename(path)} because it appears to already exist")
+        sys.exit(0)
+    print(f"HTTPError: {exc.code} {exc.reason}", file=sys.stderr)
+    sys.exit(1)
+"""
+
+
+def make_wheel(dist_dir: Path, name: str, requires: Sequence[str] = ()) -> Path:
+    dist = name.replace("-", "_")
+    path = dist_dir / f"{dist}-0.19.0-py3-none-any.whl"
+    metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: 0.19.0\n"
+    metadata += "".join(f"Requires-Dist: {r}\n" for r in requires)
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr(f"{dist}-0.19.0.dist-info/METADATA", metadata)
+    return path
+
+
+def make_sdist(dist_dir: Path, name: str, requires: Sequence[str] = ()) -> Path:
+    path = dist_dir / f"{name}-0.19.0.tar.gz"
+    metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: 0.19.0\n"
+    metadata += "".join(f"Requires-Dist: {r}\n" for r in requires)
+    data = metadata.encode("utf-8")
+    with tarfile.open(path, "w:gz") as tf:
+        info = tarfile.TarInfo(f"{name}-0.19.0/PKG-INFO")
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.fixture
+def twine(tmp_path: Path, monkeypatch, local_index) -> None:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "twine"
+    script.write_text(f"#!{sys.executable}\n{FAKE_TWINE}")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("TWINE_REPOSITORY_URL", f"{local_index.url}/legacy/")
+    monkeypatch.setenv("DBT_RELEASE_SIMPLE_URL", f"{local_index.url}/simple/")
+
+
+@pytest.fixture
+def release(tmp_path: Path) -> List[Path]:
+    dist_dir = tmp_path / "dist"
+    dist_dir.mkdir()
+    return [
+        make_wheel(dist_dir, "dbt", ["dbt-core==0.19.0", "dbt-postgres==0.19.0"]),
+        make_sdist(dist_dir, "dbt", ["dbt-core==0.19.0", "dbt-postgres==0.19.0"]),
+        make_wheel(dist_dir, "dbt-postgres", ["dbt-core==0.19.0", "psycopg2"]),
+        make_wheel(dist_dir, "dbt-core", ["Jinja2"]),
+    ]
+
+
+def make_uploader(tmp_path: Path) -> Uploader:
+    fast_retry = replace(TWINE_UPLOAD, base_delay=0.01)
+    return Uploader(tmp_path / "upload_progress.json", retry=fast_retry)
+
+
+def progress(tmp_path: Path, local_index) -> List[str]:
+    with (tmp_path / "upload_progress.json").open() as fp:
+        return sorted(json.load(fp)[f"{local_index.url}/legacy/"])
+
+
+@pytest.mark.usefixtures("twine")
+def test_uploads_in_dependency_order(tmp_path, local_index, release):
+    make_uploader(tmp_path).upload(release)
+    uploads = local_index.uploads
+    assert uploads[0] == "dbt_core-0.19.0-py3-none-any.whl"
+    assert uploads[1] == "dbt_postgres-0.19.0-py3-none-any.whl"
+    assert sorted(uploads[2:]) == ["dbt-0.19.0-py3-none-any.whl", "dbt-0.19.0.tar.gz"]
+    assert progress(tmp_path, local_index) == sorted(p.name for p in release)
+
+
+@pytest.mark.usefixtures("twine")
+def test_skips_files_already_on_the_index(tmp_path, local_index, release):
+    core = release[3]
+    local_index.files[core.name] = core.read_bytes()
+    make_uploader(tmp_path).upload(release)
+    assert core.name not in local_index.uploads
+    assert len(local_index.uploads) == 3
+    assert core.name in progress(tmp_path, local_index)
+
+
+@pytest.mark.usefixtures("twine")
+def test_refuses_files_on_the_index_with_other_contents(
+    tmp_path, local_index, release
+):
+    local_index.files[release[3].name] = b"something else"
+    with pytest.raises(ValueError, match="different contents"):
+        make_uploader(tmp_path).upload(release)
+    assert local_index.uploads == []
+
+
+@pytest.mark.usefixtures("twine")
+def test_resumes_from_the_progress_file(tmp_path, local_index, release):
+    postgres = release[2]
+    local_index.rejected.add(postgres.name)
+    with pytest.raises(subprocess.CalledProcessError):
+        make_uploader(tmp_path).upload(release)
+    # dbt depends on dbt-postgres, so it wasn't uploaded
+    assert local_index.uploads == ["dbt_core-0.19.0-py3-none-any.whl"]
+    assert progress(tmp_path, local_index) == ["dbt_core-0.19.0-py3-none-any.whl"]
+
+    # without the index listing it, only the progress file knows about dbt-core
+    local_index.files.clear()
+    local_index.rejected.clear()
+    make_uploader(tmp_path).upload(release)
+    assert local_index.uploads.count("dbt_core-0.19.0-py3-none-any.whl") == 1
+    assert progress(tmp_path, local_index) == sorted(p.name for p in release)
+
+
+@pytest.mark.usefixtures("twine")
+def test_retries_an_upload_whose_response_was_lost(tmp_path, local_index, release):
+    core = release[3]
+    local_index.lost_responses[core.name] = 1
+    make_uploader(tmp_path).upload(release)
+    posts = [r for r in local_index.requests if r.method == "POST"]
+    assert [r.headers["X-Filename"] for r in posts].count(core.name) == 2
+    assert local_index.uploads.count(core.name) == 1
+    assert progress(tmp_path, local_index) == sorted(p.name for p in release)
@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import pytest
+
+from builder.common import (
+    ReleaseFile,
+    Version,
+    parse_versions,
+    sort_versions,
+    unique_versions,
+)
+
+
+def test_finals_sort_after_prereleases():
+    versions = parse_versions(["0.20.0", "0.20.0rc1", "0.19.2", "0.20.0b1"])
+    assert [str(v) for v in sort_versions(versions)] == [
+        "0.19.2",
+        "0.20.0b1",
+        "0.20.0rc1",
+        "0.20.0",
+    ]
+
+
+def test_parse_versions_can_skip_invalid():
+    with pytest.raises(ValueError):
+        parse_versions(["0.19.0", "latest"])
+    assert parse_versions(["0.19.0", "latest"], skip_invalid=True) == [
+        Version("0.19.0")
+    ]
+
+
+def test_unique_versions_keeps_the_first_spelling():
+    versions = parse_versions(["0.20.0rc1", "0.19.0", "0.20.0c1"])
+    assert [v.raw for v in unique_versions(versions)] == ["0.19.0", "0.20.0rc1"]
+
+
+def write_release(path: Path, version: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(f"version: {version}\ncommit: abc123\nbranch: main\n")
+
+
+def test_previous_release(tmp_path):
+    releases = tmp_path / "releases"
+    for version in ("0.19.0", "0.20.0rc1", "0.20.0", "0.21.0b1"):
+        write_release(releases / f"{version}.txt", version)
+    (releases / "notes.txt").write_text("not a release\n")
+    current = ReleaseFile.from_path(releases / "0.20.0.txt")
+    previous = current.previous_release(releases)
+    assert previous is not None and previous.version.raw == "0.20.0rc1"
+    first = ReleaseFile.from_path(releases / "0.19.0.txt")
+    assert first.previous_release(releases) is None
+
+
+def test_latest_version_is_the_highest_final_release(
+    tmp_path, local_index, monkeypatch
+):
+    monkeypatch.setenv("DBT_RELEASE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("DBT_RELEASE_PYPI_URL", f"{local_index.url}/pypi")
+    files = [{"filename": "dbt.tar.gz"}]
+    releases = {"0.19.2": files, "0.20.0": files, "0.21.0rc1": files, "0.21.0": []}
+    # the listing decides, not info.version
+    data = {"info": {"version": "0.19.2"}, "releases": releases}
+    local_index.add_json("/pypi/dbt/json", data)
+    assert Version.get_latest_dbt_version() == Version("0.20.0")
@@ -0,0 +1,125 @@
+from pathlib import Path
+import os
+import subprocess
+import venv
+import zipfile
+
+import pytest
+
+from builder.virtualenvs import EnvBuilder, VenvTemplate, WheelInstaller
+
+
+@pytest.fixture
+def template(tmp_path: Path, monkeypatch) -> VenvTemplate:
+    # keep the pip and setuptools that ensurepip installs, rather than
+    # upgrading them from the network
+    monkeypatch.setattr(EnvBuilder, "upgrade_dependencies", lambda self, ctx: None)
+    template = VenvTemplate(tmp_path / "templates")
+    template.ensure()
+    site_packages = next(template.path.glob("lib*/python*/site-packages"))
+    (site_packages / "extra.pth").write_text(f"{template.path / 'src'}\n")
+    return template
+
+
+def run(*cmd) -> str:
+    return subprocess.run(
+        [str(c) for c in cmd], check=True, stdout=subprocess.PIPE, text=True
+    ).stdout.strip()
+
+
+def test_cloned_venv_runs_its_own_scripts(tmp_path, template):
+    venv = tmp_path / "venvs/test"
+    template.clone(venv)
+    python = venv / "bin/python"
+    assert run(python, "-c", "import sys; print(sys.prefix)") == str(venv)
+    assert str(venv) in run(venv / "bin/pip", "--version")
+    # the .pth file points into the clone (site skips missing directories)
+    (venv / "src").mkdir()
+    paths = run(python, "-c", "import sys; print('\\n'.join(sys.path))")
+    assert str(venv / "src") in paths.splitlines()
+    assert str(template.path) not in paths
+    for path in venv.rglob("*"):
+        if path.is_file() and not path.is_symlink() and path.suffix != ".pyc":
+            assert str(template.path).encode() not in path.read_bytes(), path
+
+
+def test_writing_a_clone_in_place_leaves_the_template_alone(tmp_path, template):
+    first = tmp_path / "venvs/first"
+    second = tmp_path / "venvs/second"
+    template.clone(first)
+    template.clone(second)
+    site_packages = next(first.glob("lib*/python*/site-packages"))
+    names = ["pyvenv.cfg", "bin/pip", f"{site_packages.relative_to(first)}/extra.pth"]
+    before = {name: (template.path / name).read_bytes() for name in names}
+    for name in names:
+        # like pip writing a script, or setuptools appending to a .pth file
+        with open(first / name, "ab") as fp:
+            fp.write(b"# changed\n")
+    for name in names:
+        assert (template.path / name).read_bytes() == before[name]
+        assert b"# changed" not in (second / name).read_bytes()
+        assert not os.path.samefile(first / name, template.path / name)
+    assert str(second) in run(second / "bin/pip", "--version")
+
+
+def make_wheel(dist_dir: Path, name: str, files) -> Path:
+    info = f"{name}-1.0.dist-info"
+    files = dict(files)
+    files[f"{info}/METADATA"] = f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n"
+    files[f"{info}/WHEEL"] = "Wheel-Version: 1.0\nRoot-Is-Purelib: true\n"
+    files[f"{info}/RECORD"] = ""
+    path = dist_dir / f"{name}-1.0-py3-none-any.whl"
+    with zipfile.ZipFile(path, "w") as zf:
+        for member, contents in files.items():
+            zf.writestr(member, contents)
+    return path
+
+
+@pytest.fixture
+def bare_venv(tmp_path: Path) -> Path:
+    path = tmp_path / "venv"
+    venv.create(path, with_pip=False)
+    return path
+
+
+def test_installed_modules_are_byte_compiled(tmp_path, bare_venv):
+    wheel = make_wheel(
+        tmp_path,
+        "greet",
+        {
+            "greet/__init__.py": "def main():\n    print('hello')\n",
+            "greet-1.0.dist-info/entry_points.txt": (
+                "[console_scripts]\ngreet = greet:main\n"
+            ),
+        },
+    )
+    python = bare_venv / "bin/python"
+    installer = WheelInstaller(str(python))
+    installer.install([wheel])
+    assert run(bare_venv / "bin/greet") == "hello"
+
+    site_packages = Path(installer.paths["purelib"])
+    pyc = f"greet/__pycache__/__init__.{installer.cache_tag}.pyc"
+    assert (site_packages / pyc).exists()
+    record = (site_packages / "greet-1.0.dist-info/RECORD").read_text()
+    assert pyc in [line.split(",")[0] for line in record.splitlines()]
+
+
+def test_unsupported_wheels_are_rejected_before_writing(tmp_path, bare_venv):
+    plain = make_wheel(tmp_path, "plain", {"plain/__init__.py": ""})
+    headers = make_wheel(
+        tmp_path,
+        "native",
+        {
+            "native/__init__.py": "",
+            "native-1.0.data/headers/native.h": "int native(void);\n",
+        },
+    )
+    installer = WheelInstaller(str(bare_venv / "bin/python"))
+    site_packages = Path(installer.paths["purelib"])
+    before = sorted(site_packages.rglob("*"))
+    with pytest.raises(ValueError, match="headers"):
+        installer.plan([plain, headers])
+    with pytest.raises(ValueError, match="headers"):
+        installer.install([plain, headers])
+    assert sorted(site_packages.rglob("*")) == before
@@ -0,0 +1,108 @@
+from pathlib import Path
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+from builder.wheelhouse import Wheelhouse
+
+
+def wheel_bytes(name: str, version: str) -> bytes:
+    info = f"{name}-{version}.dist-info"
+    files = {
+        f"{name}/__init__.py": f"VERSION = {version!r}\n",
+        f"{info}/METADATA": (
+            f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n"
+        ),
+        f"{info}/WHEEL": (
+            "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\n"
+            "Tag: py3-none-any\n"
+        ),
+    }
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as zf:
+        for path, contents in files.items():
+            zf.writestr(path, contents)
+        record = "".join(f"{path},,\n" for path in files) + f"{info}/RECORD,,\n"
+        zf.writestr(f"{info}/RECORD", record)
+    return out.getvalue()
+
+
+def publish(local_index, name: str, version: str) -> None:
+    filename = f"{name}-{version}-py3-none-any.whl"
+    local_index.files[filename] = wheel_bytes(name, version)
+
+
+@pytest.fixture
+def wheelhouse(tmp_path: Path, local_index, monkeypatch) -> Wheelhouse:
+    monkeypatch.setenv("PIP_INDEX_URL", f"{local_index.url}/simple/")
+    monkeypatch.setenv("PIP_NO_CACHE_DIR", "1")
+    monkeypatch.setenv("PIP_DISABLE_PIP_VERSION_CHECK", "1")
+    (tmp_path / "cwd").mkdir()
+    return Wheelhouse(tmp_path / "wheelhouse", offline=False)
+
+
+def wheels(path: Path):
+    return sorted(p.name for p in path.glob("*.whl"))
+
+
+def find_links(wheelhouse: Wheelhouse, *pkgs: str) -> Path:
+    cwd = wheelhouse.root.parent / "cwd"
+    links = wheelhouse.find_links(sys.executable, cwd, pkgs)
+    assert links is not None
+    return links
+
+
+def test_each_set_gets_the_versions_it_resolved(wheelhouse, local_index):
+    publish(local_index, "pkg", "1.0")
+    publish(local_index, "pkg", "2.0")
+    old = find_links(wheelhouse, "pkg==1.0")
+    new = find_links(wheelhouse, "pkg==2.0")
+    assert wheels(old) == ["pkg-1.0-py3-none-any.whl"]
+    assert wheels(new) == ["pkg-2.0-py3-none-any.whl"]
+    assert wheels(wheelhouse.wheel_dir) == [
+        "pkg-1.0-py3-none-any.whl",
+        "pkg-2.0-py3-none-any.whl",
+    ]
+    # going back to the first set doesn't pick up the newer wheel
+    assert find_links(wheelhouse, "pkg==1.0") == old
+    assert wheels(old) == ["pkg-1.0-py3-none-any.whl"]
+
+
+def test_pinned_sets_are_not_resolved_again(wheelhouse, local_index):
+    publish(local_index, "pkg", "1.0")
+    find_links(wheelhouse, "pkg==1.0")
+    requests = len(local_index.requests)
+    wheelhouse.max_age = 0
+    find_links(wheelhouse, "pkg==1.0")
+    assert len(local_index.requests) == requests
+
+
+def test_unpinned_sets_are_refreshed_when_old(wheelhouse, local_index):
+    publish(local_index, "pkg", "1.0")
+    links = find_links(wheelhouse, "pkg")
+    assert wheels(links) == ["pkg-1.0-py3-none-any.whl"]
+
+    publish(local_index, "pkg", "2.0")
+    requests = len(local_index.requests)
+    assert wheels(find_links(wheelhouse, "pkg")) == ["pkg-1.0-py3-none-any.whl"]
+    assert len(local_index.requests) == requests
+
+    for stamp in wheelhouse.sets_dir.glob("*.json"):
+        old = stamp.stat().st_mtime - wheelhouse.max_age - 1
+        os.utime(stamp, (old, old))
+    assert wheels(find_links(wheelhouse, "pkg")) == ["pkg-2.0-py3-none-any.whl"]
+
+
+def test_offline_uses_an_old_unpinned_set(wheelhouse, local_index):
+    publish(local_index, "pkg", "1.0")
+    links = find_links(wheelhouse, "pkg")
+    wheelhouse.max_age = 0
+    wheelhouse.offline = True
+    requests = len(local_index.requests)
+    assert find_links(wheelhouse, "pkg") == links
+    assert len(local_index.requests) == requests
+    with pytest.raises(LookupError):
+        find_links(wheelhouse, "pkg==2.0")